@@ -0,0 +1,437 @@
+"""Banc d'essai hors ligne des gestionnaires d'événements du bot : sans Discord, sans Groq et,
+par défaut, sans PostgreSQL.
+
+Les vrais handlers de bot.py (on_message, on_presence_update, on_member_join et les commandes via
+process_commands) sont appelés avec de faux objets Discord. La base est remplacée par une version
+en mémoire qui compte les requêtes (ou une vraie base avec --db), et Groq par un petit serveur HTTP
+local compatible avec son API.
+
+Usage:
+    python bench.py [scénario] [nombre_d_evenements]
+    python bench.py mixed 20000 --db                    # PostgreSQL de DATABASE_URL (écrit dedans !)
+    python bench.py mixed 5000 --record flux.jsonl      # enregistre le flux généré
+    python bench.py --replay flux.jsonl                 # rejoue un flux enregistré
+
+Scénarios : presence, messages, commands, joins, mixed
+"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import random
+import time
+from types import SimpleNamespace
+
+os.environ.setdefault('GROQ_API_KEY', 'bench')
+
+import discord
+from aiohttp import web
+from discord.ext import commands
+from groq import Groq
+
+import bot
+
+
+# ========== FAUX OBJETS DISCORD ==========
+
+class FakeMessage:
+    _ids = itertools.count(1)
+
+    def __init__(self, content=None, author=None, guild=None, channel=None):
+        self.id = next(self._ids)
+        self.content = content
+        self.author = author
+        self.guild = guild
+        self.channel = channel
+        self.mentions = []
+        self.attachments = []
+        self._state = None
+
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+
+    async def delete(self):
+        pass
+
+
+class FakeChannel:
+    _ids = itertools.count(1000)
+
+    def __init__(self, name, guild=None):
+        self.id = next(self._ids)
+        self.name = name
+        self.guild = guild
+        self.mention = f'<#{self.id}>'
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeMessage(content, guild=self.guild, channel=self)
+
+    def typing(self):
+        return contextlib.nullcontext()
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f'Serveur {guild_id}'
+        self.text_channels = [FakeChannel(name, self) for name in ('général', 'gaming', 'arrivage')] + [
+            FakeChannel(f'salon-{i}', self) for i in range(50)
+        ]
+        self.roles = [SimpleNamespace(id=guild_id * 10 + 1, name='LES BG')]
+        self.members = {}
+
+    def get_member(self, member_id):
+        return self.members.get(member_id)
+
+
+def fake_member(guild, member_id, activities=()):
+    async def add_roles(*roles, **kwargs):
+        pass
+    return SimpleNamespace(
+        id=member_id,
+        bot=False,
+        guild=guild,
+        name=f'membre{member_id}',
+        display_name=f'membre{member_id}',
+        mention=f'<@{member_id}>',
+        activities=activities,
+        roles=[],
+        add_roles=add_roles,
+    )
+
+
+def playing(name):
+    return SimpleNamespace(type=discord.ActivityType.playing, name=name)
+
+
+def listening(name):
+    return SimpleNamespace(type=discord.ActivityType.listening, name=name)
+
+
+async def install_fake_discord():
+    """Le bot n'est pas connecté : réponses des commandes envoyées directement au faux salon"""
+    # Ce que fait login() : rattache le client à la boucle (nécessaire pour dispatch des erreurs)
+    await bot.bot._async_setup_hook()
+    bot.bot._connection.user = SimpleNamespace(id=0, name='bench', bot=True)
+
+    async def send(ctx, content=None, **kwargs):
+        return await ctx.channel.send(content, **kwargs)
+
+    commands.Context.send = send
+    commands.Context.typing = lambda ctx, **kwargs: ctx.channel.typing()
+
+
+# ========== BASE DE DONNÉES ==========
+
+class QueryCounter:
+    def __init__(self):
+        self.queries = 0
+
+
+class FakeConnection:
+    """Connexion en mémoire : répond « vide » à tout (aucun joueur connu, aucune ligne modifiée)"""
+
+    async def execute(self, query, *args, **kwargs):
+        return 'UPDATE 0'
+
+    async def executemany(self, query, args, **kwargs):
+        return None
+
+    async def fetch(self, query, *args, **kwargs):
+        return []
+
+    async def fetchrow(self, query, *args, **kwargs):
+        return None
+
+    async def fetchval(self, query, *args, **kwargs):
+        return 0
+
+    def transaction(self):
+        return contextlib.nullcontext()
+
+
+class FakePool:
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        yield FakeConnection()
+
+    async def close(self):
+        pass
+
+
+class CountingConnection:
+    """Compte chaque requête envoyée par le bot, quelle que soit la base derrière"""
+
+    def __init__(self, conn, counter):
+        self._conn = conn
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if name in ('execute', 'executemany', 'fetch', 'fetchrow', 'fetchval'):
+            self._counter.queries += 1
+        return attr
+
+
+class CountingPool:
+    def __init__(self, pool, counter):
+        self._pool = pool
+        self._counter = counter
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        async with self._pool.acquire() as conn:
+            yield CountingConnection(conn, self._counter)
+
+
+# ========== FAUX SERVEUR GROQ ==========
+
+class StubLLMServer:
+    """Serveur HTTP local qui imite /openai/v1/chat/completions (réponse simple ou streaming SSE) :
+    le vrai client Groq et tout le chemin asynchrone du bot sont exercés"""
+
+    def __init__(self, latency, words=40):
+        self.latency = latency
+        self.words = words
+        self.requests = 0
+        self._runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/openai/v1/chat/completions', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}'
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _handle(self, request):
+        body = await request.json()
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        model = body.get('model', 'stub')
+        text = ' '.join(f'mot{i}' for i in range(self.words))
+        if bot.JOKE_SEPARATOR in body['messages'][-1]['content']:
+            # Lot de blagues : toutes différentes, pour que la réserve se remplisse vraiment
+            jokes = [f'blague {self.requests}-{i} {text}' for i in range(bot.JOKE_BATCH_SIZE)]
+            text = f'\n{bot.JOKE_SEPARATOR}\n'.join(jokes)
+        usage = {'prompt_tokens': 50, 'completion_tokens': self.words, 'total_tokens': 50 + self.words}
+        base = {'id': f'stub-{self.requests}', 'created': int(time.time()), 'model': model}
+        if not body.get('stream'):
+            return web.json_response({
+                **base, 'object': 'chat.completion',
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': text}}],
+                'usage': usage,
+            })
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for word in text.split():
+            chunk = {**base, 'object': 'chat.completion.chunk',
+                     'choices': [{'index': 0, 'delta': {'content': word + ' '}, 'finish_reason': None}]}
+            await response.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+        last = {**base, 'object': 'chat.completion.chunk',
+                'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}], 'x_groq': {'usage': usage}}
+        await response.write(f'data: {json.dumps(last)}\n\ndata: [DONE]\n\n'.encode())
+        await response.write_eof()
+        return response
+
+
+# ========== FLUX D'ÉVÉNEMENTS ==========
+# Un événement est un dict sérialisable en JSON, pour pouvoir enregistrer puis rejouer un flux
+
+BENCH_COMMANDS = ['!level', '!rank', '!leaderboard', '!games', '!gamestats Jeu {game}', '!joke', '!ask {question}']
+
+def generate_events(scenario, count, guilds=3, members=1000, change_ratio=0.1, seed=42):
+    rng = random.Random(seed)
+    games = [f'Jeu {i}' for i in range(30)]
+    weights = {
+        'presence': {'presence': 1},
+        'messages': {'message': 1},
+        'commands': {'command': 1},
+        'joins': {'join': 1},
+        'mixed': {'presence': 60, 'message': 35, 'command': 4, 'join': 1},
+    }[scenario]
+    kinds, kind_weights = list(weights), list(weights.values())
+    current = {}
+    next_member = members + 1
+    events = []
+    for _ in range(count):
+        kind = rng.choices(kinds, kind_weights)[0]
+        guild_id = rng.randint(1, guilds)
+        member_id = rng.randint(1, members)
+        if kind == 'presence':
+            # La plupart des mises à jour ne changent pas le jeu (statut, musique...)
+            before = current.get(member_id)
+            after = before
+            if rng.random() < change_ratio:
+                after = None if before and rng.random() < 0.5 else rng.choice(games)
+                current[member_id] = after
+            events.append({'type': 'presence', 'guild': guild_id, 'member': member_id,
+                           'before': before, 'after': after})
+        elif kind == 'message':
+            events.append({'type': 'message', 'guild': guild_id, 'member': member_id,
+                           'content': f'message {rng.randint(0, 10**6)}'})
+        elif kind == 'command':
+            content = rng.choice(BENCH_COMMANDS).format(game=rng.randint(0, 29), question=f'question {rng.randint(0, 50)}')
+            events.append({'type': 'message', 'guild': guild_id, 'member': member_id, 'content': content})
+        else:
+            events.append({'type': 'join', 'guild': guild_id, 'member': next_member})
+            next_member += 1
+    return events
+
+
+class Replayer:
+    """Transforme les événements en appels aux vrais handlers du bot"""
+
+    def __init__(self):
+        self.guilds = {}
+
+    def guild(self, guild_id):
+        guild = self.guilds.get(guild_id)
+        if guild is None:
+            guild = self.guilds[guild_id] = FakeGuild(guild_id)
+        return guild
+
+    def member(self, guild, member_id, activities=()):
+        member = fake_member(guild, member_id, activities)
+        guild.members[member_id] = member
+        return member
+
+    def prepare(self, event):
+        """Construit les faux objets à l'avance (hors chronomètre) : (type, handler, arguments)"""
+        guild = self.guild(event['guild'])
+        if event['type'] == 'presence':
+            before = fake_member(guild, event['member'], (playing(event['before']),) if event['before'] else ())
+            activities = ((playing(event['after']),) if event['after'] else ()) + (listening('Spotify'),)
+            return 'presence', bot.on_presence_update, (before, self.member(guild, event['member'], activities))
+        if event['type'] == 'message':
+            author = guild.members.get(event['member']) or self.member(guild, event['member'])
+            message = FakeMessage(event['content'], author, guild, guild.text_channels[0])
+            label = f"commande {event['content'].split()[0]}" if event['content'].startswith('!') else 'message'
+            return label, bot.on_message, (message,)
+        if event['type'] == 'join':
+            return 'join', bot.on_member_join, (self.member(guild, event['member']),)
+        raise ValueError(f"Type d'événement inconnu : {event['type']}")
+
+
+# ========== MESURES ==========
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run(events, counter):
+    replayer = Replayer()
+    prepared = [replayer.prepare(event) for event in events]
+    # Format: {type d'événement: [latences]} et {type: requêtes}
+    latencies = {}
+    queries = {}
+    start = time.perf_counter()
+    for label, handler, handler_args in prepared:
+        queries_before = counter.queries
+        event_start = time.perf_counter()
+        await handler(*handler_args)
+        latencies.setdefault(label, []).append(time.perf_counter() - event_start)
+        queries[label] = queries.get(label, 0) + counter.queries - queries_before
+    handlers_elapsed = time.perf_counter() - start
+
+    # Les écritures différées font partie du coût : elles sont comptées à part
+    queries_before = counter.queries
+    flush_start = time.perf_counter()
+    await bot.xp_accumulator.flush()
+    await bot.session_log.flush()
+    flush_elapsed = time.perf_counter() - flush_start
+    flush_queries = counter.queries - queries_before
+    return latencies, queries, handlers_elapsed, flush_elapsed, flush_queries
+
+
+def report(title, events, latencies, queries, handlers_elapsed, flush_elapsed, flush_queries):
+    total = len(events)
+    elapsed = handlers_elapsed + flush_elapsed
+    total_queries = sum(queries.values()) + flush_queries
+    print(title)
+    print(f"{total} événements en {elapsed:.3f}s → {total / elapsed:,.0f} événements/s, "
+          f"{total_queries / total:.3f} requêtes/événement (dont écritures différées)")
+    print(f"{'type':<22}{'nombre':>8}{'p50 (ms)':>11}{'p99 (ms)':>11}{'requêtes/évt':>15}")
+    for label, values in sorted(latencies.items(), key=lambda item: -len(item[1])):
+        print(f"{label:<22}{len(values):>8}{percentile(values, 0.5) * 1000:>11.3f}"
+              f"{percentile(values, 0.99) * 1000:>11.3f}{queries[label] / len(values):>15.3f}")
+    print(f"{'écritures différées':<22}{'':>8}{flush_elapsed * 1000:>11.1f}{'':>11}{flush_queries:>15}")
+    outbound = bot.outbound.stats()
+    print(f"Envois : {outbound['sent']} envoyés, {outbound['coalesced']} regroupés, {outbound['queued']} en file")
+    if 'join' in latencies:
+        print(f"Rôles d'arrivée : {bot.role_grants.granted} donnés, {len(bot.role_grants)} en file, "
+              f"{bot.join_monitor.bursts} vague(s) détectée(s)")
+
+
+async def main(args):
+    if args.replay:
+        with open(args.replay, encoding='utf-8') as f:
+            events = [json.loads(line) for line in f if line.strip()]
+        title = f"Rejeu de {args.replay}"
+    else:
+        events = generate_events(args.scenario, args.count, seed=args.seed)
+        title = f"Scénario {args.scenario}"
+    if args.record:
+        with open(args.record, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(event, ensure_ascii=False) + '\n' for event in events)
+
+    await install_fake_discord()
+    llm = StubLLMServer(args.llm_latency)
+    await llm.start()
+    bot.llm_client.client = Groq(api_key='bench', base_url=llm.url, max_retries=0)
+
+    counter = QueryCounter()
+    if args.db:
+        await bot.init_db()
+        real_pool = bot.db_pool
+        bot.db_pool = CountingPool(real_pool, counter)
+        title += " (PostgreSQL)"
+    else:
+        real_pool = None
+        bot.db_pool = CountingPool(FakePool(), counter)
+        title += " (base en mémoire)"
+    title += f", IA simulée à {args.llm_latency * 1000:.0f} ms"
+
+    try:
+        results = await run(events, counter)
+        report(title, events, *results)
+        print(f"Appels IA : {llm.requests}")
+    finally:
+        # La recharge des blagues tourne en arrière-plan : l'arrêter avant de couper le faux Groq
+        refill = bot.joke_pool._refill_task
+        if refill is not None:
+            refill.cancel()
+            await asyncio.gather(refill, return_exceptions=True)
+        await bot.role_grants.stop()
+        bot.db_pool = real_pool
+        await bot.close_db()
+        await llm.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Banc d'essai hors ligne du bot")
+    parser.add_argument('scenario', nargs='?', default='presence',
+                        choices=['presence', 'messages', 'commands', 'joins', 'mixed'])
+    parser.add_argument('count', nargs='?', type=int, default=200_000)
+    parser.add_argument('--db', action='store_true', help='utiliser la base PostgreSQL de DATABASE_URL')
+    parser.add_argument('--replay', help="rejouer un flux d'événements JSONL")
+    parser.add_argument('--record', help='enregistrer le flux généré en JSONL')
+    parser.add_argument('--llm-latency', type=float, default=0.05, help="latence simulée de l'IA en secondes")
+    parser.add_argument('--seed', type=int, default=42)
+    asyncio.run(main(parser.parse_args()))
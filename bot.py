@@ -1,18 +1,682 @@
+import abc
 import asyncio
 import discord
 import os
+import time
 import asyncpg
+from discord import app_commands
 from discord.ext import commands
+from aiohttp import web, ClientSession, ClientError
 from dotenv import load_dotenv
 from groq import Groq
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from contextlib import aclosing
+import threading
+import sys
+import hashlib
+import logging
+import unicodedata
+import re
+import csv
+import json
+import heapq
+import cProfile
+import pstats
+import io
+import gzip
+import marshal
+import bisect
+import math
+from typing import Optional, Union
+from collections import OrderedDict, deque
+from array import array
 load_dotenv()
 
-# Pool de connexions PostgreSQL
+# ========== MÉTRIQUES (format Prometheus) ==========
+# Exposées sur http://METRICS_HOST:METRICS_PORT/metrics pour savoir si la lenteur vient
+# de PostgreSQL, de Groq ou de Discord
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))           # 0 = pas de serveur de métriques
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')        # local uniquement par défaut
+LOOP_LAG_INTERVAL = 0.5                                      # secondes entre deux mesures du retard de la boucle
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metrics:
+    """Compteurs, histogrammes et valeurs calculées à la demande, rendus au format texte Prometheus"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Format: {nom: (type, aide)}
+        self._meta = {}
+        # Format: {(nom, labels): valeur}
+        self._counters = {}
+        # Format: {(nom, labels): [comptes par intervalle..., au-delà, somme]}
+        self._histograms = {}
+        # Valeurs lues au moment du scrape. Format: {nom: fonction -> nombre ou {labels: nombre}}
+        self._collectors = {}
+        # Reçoit aussi chaque durée mesurée quand un profilage est en cours (sinon None)
+        self.listener = None
+
+    def describe(self, name, kind, help_text):
+        self._meta[name] = (kind, help_text)
+
+    def collector(self, name, kind, help_text, read):
+        self.describe(name, kind, help_text)
+        self._collectors[name] = read
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        self._observe((name, tuple(sorted(labels.items()))), seconds)
+
+    def _observe(self, key, seconds):
+        if self.listener is not None:
+            self.listener(key, seconds)
+        values = self._histograms.get(key)
+        if values is None:
+            values = self._histograms[key] = [0] * (len(self.buckets) + 2)
+        # Un seul intervalle incrémenté : les cumuls sont calculés au scrape
+        values[bisect.bisect_left(self.buckets, seconds)] += 1
+        values[-1] += seconds
+
+    def timed(self, name, **labels):
+        """Décorateur : durée de chaque appel de la coroutine, avec le statut ok/error"""
+        # Clés calculées une fois : le décorateur est posé sur des chemins très fréquents
+        ok_key = (name, tuple(sorted({**labels, 'status': 'ok'}.items())))
+        error_key = (name, tuple(sorted({**labels, 'status': 'error'}.items())))
+
+        def decorator(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                key = error_key
+                try:
+                    result = await func(*args, **kwargs)
+                    key = ok_key
+                    return result
+                finally:
+                    self._observe(key, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def render(self):
+        lines = []
+        samples = {}
+        for (name, labels), value in self._counters.items():
+            samples.setdefault(name, []).append((name, labels, value))
+        for (name, labels), values in self._histograms.items():
+            rows = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                rows.append((f'{name}_bucket', labels + (('le', str(bound)),), cumulative))
+            total = cumulative + values[-2]
+            rows.append((f'{name}_bucket', labels + (('le', '+Inf'),), total))
+            rows.append((f'{name}_sum', labels, values[-1]))
+            rows.append((f'{name}_count', labels, total))
+        for name, read in self._collectors.items():
+            try:
+                value = read()
+            except Exception:
+                continue  # Une source indisponible (pool pas encore créé...) ne casse pas le scrape
+            if isinstance(value, dict):
+                samples[name] = [(name, tuple(labels), v) for labels, v in value.items()]
+            else:
+                samples[name] = [(name, (), value)]
+        for name, rows in samples.items():
+            kind, help_text = self._meta.get(name, ('untyped', ''))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for sample, labels, value in rows:
+                label_text = ','.join(f'{k}="{escape_label(v)}"' for k, v in labels)
+                lines.append(f'{sample}{{{label_text}}} {value}' if label_text else f'{sample} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = Metrics(LATENCY_BUCKETS)
+metrics.describe('discord_event_seconds', 'histogram', "Durée des handlers d'événements Discord")
+metrics.describe('discord_command_seconds', 'histogram', 'Durée des commandes du bot')
+metrics.describe('db_query_seconds', 'histogram', 'Durée des fonctions de base de données')
+metrics.describe('db_pool_acquire_seconds', 'histogram', "Attente d'une connexion du pool")
+metrics.describe('llm_request_seconds', 'histogram', 'Durée des appels Groq')
+metrics.describe('llm_first_token_seconds', 'histogram', 'Délai avant le premier morceau en streaming')
+metrics.describe('llm_tokens_total', 'counter', 'Tokens consommés chez Groq')
+metrics.describe('event_loop_lag_seconds', 'histogram', 'Retard de la boucle asyncio')
+
+
+async def measure_loop_lag():
+    """Une tâche qui dort à intervalle fixe : tout retard au réveil est du temps où la boucle était bloquée"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        metrics.observe('event_loop_lag_seconds', max(0.0, time.perf_counter() - start - LOOP_LAG_INTERVAL))
+
+
+class MetricsServer:
+    """Petit serveur HTTP aiohttp (déjà installé avec discord.py) qui sert /metrics"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._runner = None
+        self._lag_task = None
+
+    async def start(self):
+        if not self.port or self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._lag_task = asyncio.create_task(measure_loop_lag())
+        print(f'📈 Métriques sur http://{self.host}:{self.port}/metrics')
+
+    async def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request):
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+
+metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT)
+
+
+# ========== PROFILAGE À LA DEMANDE ==========
+# !profile start|stop|dump : cProfile sur la boucle du bot pendant une durée bornée, plus les durées
+# de chaque handler, commande, requête et appel IA (via les métriques). Rien n'est mesuré quand c'est éteint.
+PROFILE_DEFAULT_SECONDS = 60     # durée d'un profilage sans durée précisée
+PROFILE_MAX_SECONDS = 600        # durée max d'un profilage
+PROFILE_TOP = 12                 # fonctions affichées dans le résumé
+
+class LiveProfiler:
+    """Profilage cProfile d'une fenêtre bornée, et trace des durées étiquetées par handler ou commande"""
+
+    def __init__(self):
+        self._profile = None
+        self._stop_handle = None
+        self.started_at = None
+        self.duration = None
+        # Dernier profil terminé : (cProfile.Profile, {étiquette: [appels, total, max]}, durée réelle)
+        self.result = None
+        # Format: {étiquette: [appels, durée totale, durée max]}
+        self._traces = {}
+
+    @property
+    def active(self):
+        return self._profile is not None
+
+    def start(self, seconds):
+        if self.active:
+            return False
+        self._traces = {}
+        self._profile = cProfile.Profile()
+        self.started_at = time.perf_counter()
+        self.duration = seconds
+        metrics.listener = self._trace
+        self._profile.enable()
+        # Fenêtre bornée : s'arrête tout seul même si personne ne fait !profile stop
+        self._stop_handle = asyncio.get_running_loop().call_later(seconds, self.stop)
+        return True
+
+    def stop(self):
+        if not self.active:
+            return False
+        self._profile.disable()
+        metrics.listener = None
+        if self._stop_handle is not None:
+            self._stop_handle.cancel()
+            self._stop_handle = None
+        self.result = (self._profile, self._traces, time.perf_counter() - self.started_at)
+        self._profile = None
+        return True
+
+    def _trace(self, key, seconds):
+        name, labels = key
+        tag = ' '.join([name.removesuffix('_seconds')] + [f'{k}={v}' for k, v in labels if k != 'status'])
+        entry = self._traces.get(tag)
+        if entry is None:
+            self._traces[tag] = [1, seconds, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def dump(self):
+        """Dernier profil : (profil pstats compressé, rapport texte compressé, stats, traces triées).
+        Le profil s'ouvre avec pstats ou snakeviz après gunzip."""
+        profile, traces, _ = self.result
+        output = io.StringIO()
+        stats = pstats.Stats(profile, stream=output)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP * 4)
+        ranked = sorted(traces.items(), key=lambda item: -item[1][1])
+        lines = [f'{tag}: {count} appels, {total * 1000:.1f} ms au total, max {worst * 1000:.1f} ms'
+                 for tag, (count, total, worst) in ranked]
+        report = output.getvalue() + '\n\nDurées par handler / commande\n' + '\n'.join(lines)
+        return gzip.compress(marshal.dumps(stats.stats)), gzip.compress(report.encode()), stats, ranked
+
+
+profiler = LiveProfiler()
+
+# Pool de connexions PostgreSQL (créé une seule fois dans setup_hook)
 db_pool = None
 
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))     # connexions ouvertes au démarrage
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))    # connexions simultanées max
+
+# Partitionnement optionnel de la table users par serveur (0 = désactivé)
+DB_GUILD_PARTITIONS = int(os.getenv('DB_GUILD_PARTITIONS', '0'))
+# Serveur auquel rattacher l'XP existante lors du passage au multi-serveurs
+LEGACY_GUILD_ID = int(os.getenv('LEGACY_GUILD_ID', '0')) or None
+MIGRATION_BATCH_SIZE = 5000
+# Verrou PostgreSQL pour qu'une seule instance du bot applique les migrations
+MIGRATION_LOCK_ID = 7_315_001
+
+# Colonnes contenant des identifiants Discord (snowflakes 64 bits)
+ID_COLUMNS = {
+    'users': ('guild_id', 'user_id'),
+    'game_sessions': ('user_id',),
+    'playtime_hourly': ('user_id',),
+    'playtime_daily': ('user_id',),
+    'playtime_monthly': ('user_id',),
+}
+
+USERS_COLUMNS = '''
+    guild_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    username TEXT,
+    xp INTEGER DEFAULT 0,
+    level INTEGER DEFAULT 1,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (guild_id, user_id)
+'''
+
+async def create_users_table(conn):
+    """Crée la table users (XP par serveur), partitionnée par hash du serveur si demandé"""
+    if DB_GUILD_PARTITIONS > 0:
+        await conn.execute(f'CREATE TABLE IF NOT EXISTS users ({USERS_COLUMNS}) PARTITION BY HASH (guild_id)')
+        for i in range(DB_GUILD_PARTITIONS):
+            await conn.execute(
+                f'CREATE TABLE IF NOT EXISTS users_p{i} PARTITION OF users '
+                f'FOR VALUES WITH (MODULUS {DB_GUILD_PARTITIONS}, REMAINDER {i})'
+            )
+    else:
+        await conn.execute(f'CREATE TABLE IF NOT EXISTS users ({USERS_COLUMNS})')
+    # Index du classement par serveur (!leaderboard et !rank)
+    await conn.execute('CREATE INDEX IF NOT EXISTS idx_users_guild_rank ON users (guild_id, level DESC, xp DESC)')
+    # updated_at tenu à jour même pour les modifications faites à la main
+    await conn.execute('''
+        CREATE OR REPLACE FUNCTION update_updated_at_column()
+        RETURNS TRIGGER AS $$
+        BEGIN
+            NEW.updated_at = CURRENT_TIMESTAMP;
+            RETURN NEW;
+        END;
+        $$ language 'plpgsql';
+        DROP TRIGGER IF EXISTS update_users_updated_at ON users;
+        CREATE TRIGGER update_users_updated_at
+            BEFORE UPDATE ON users
+            FOR EACH ROW
+            EXECUTE FUNCTION update_updated_at_column();
+    ''')
+
+async def users_is_legacy(conn):
+    """True si la table users est encore à l'ancien format (XP globale, clé user_id seule)
+    ou si une migration vers l'XP par serveur a été interrompue"""
+    return await conn.fetchval('''
+        SELECT to_regclass('users_legacy') IS NOT NULL OR EXISTS (
+            SELECT 1 FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+            WHERE i.indrelid = to_regclass('users') AND i.indisprimary
+            GROUP BY i.indexrelid HAVING array_agg(a.attname::text) = ARRAY['user_id']
+        )
+    ''')
+
+
+# ========== MIGRATIONS DU SCHÉMA ==========
+# Chaque étape est appliquée une seule fois (numéro enregistré dans schema_migrations) et reste
+# rejouable sans risque si le bot s'arrête au milieu. Ajouter les nouvelles étapes à la fin de MIGRATIONS.
+
+async def migration_base_tables(conn):
+    """Tables de l'XP, des sessions de jeu et des agrégats de temps de jeu"""
+    if not await users_is_legacy(conn):
+        await create_users_table(conn)
+    # Historique des sessions de jeu et totaux par jeu
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS game_sessions (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            game TEXT NOT NULL,
+            started_at TIMESTAMP NOT NULL,
+            ended_at TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_game_sessions_open
+            ON game_sessions (user_id, started_at) WHERE ended_at IS NULL;
+        CREATE TABLE IF NOT EXISTS game_totals (
+            game TEXT PRIMARY KEY,
+            total_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    ''')
+    # Agrégats de temps de jeu par heure / jour / mois, et pics de joueurs simultanés
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS playtime_hourly (
+            bucket TIMESTAMP NOT NULL,
+            game TEXT NOT NULL,
+            user_id BIGINT NOT NULL,
+            seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, game, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS playtime_daily (
+            day DATE NOT NULL,
+            game TEXT NOT NULL,
+            user_id BIGINT NOT NULL,
+            seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, game, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_playtime_daily_user ON playtime_daily (user_id, day);
+        CREATE TABLE IF NOT EXISTS playtime_monthly (
+            month DATE NOT NULL,
+            game TEXT NOT NULL,
+            user_id BIGINT NOT NULL,
+            seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (month, game, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS game_peak_hourly (
+            bucket TIMESTAMP NOT NULL,
+            game TEXT NOT NULL,
+            peak_players INTEGER NOT NULL,
+            PRIMARY KEY (bucket, game)
+        );
+        CREATE TABLE IF NOT EXISTS game_peak_daily (
+            day DATE NOT NULL,
+            game TEXT NOT NULL,
+            peak_players INTEGER NOT NULL,
+            PRIMARY KEY (day, game)
+        );
+    ''')
+
+
+async def migration_users_by_guild(conn):
+    """Passe l'ancienne XP globale à l'XP par serveur"""
+    if not await users_is_legacy(conn):
+        return
+    # L'XP d'avant le multi-serveurs est rattachée à un seul serveur
+    guild_id = LEGACY_GUILD_ID
+    if guild_id is None:
+        guilds = [guild async for guild in bot.fetch_guilds(limit=2)]
+        if len(guilds) != 1:
+            raise RuntimeError('XP à migrer mais plusieurs serveurs : définis LEGACY_GUILD_ID dans le .env')
+        guild_id = guilds[0].id
+    await migrate_users_to_guilds(conn, guild_id)
+
+
+async def migrate_users_to_guilds(conn, guild_id):
+    """Passe la table users à l'XP par serveur, par lots pour ne pas bloquer la base.
+    L'XP existante est rattachée au serveur `guild_id`."""
+    if await conn.fetchval("SELECT to_regclass('users_legacy') IS NULL"):
+        # Les tables créées avec l'ancien init_db.sql n'ont pas de colonne username
+        await conn.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS username TEXT')
+    if DB_GUILD_PARTITIONS > 0:
+        # Table partitionnée : on recopie l'ancienne table dans la nouvelle
+        if await conn.fetchval("SELECT to_regclass('users_legacy') IS NULL"):
+            async with conn.transaction():
+                await conn.execute('ALTER TABLE users RENAME TO users_legacy')
+                await conn.execute('ALTER INDEX IF EXISTS users_pkey RENAME TO users_legacy_pkey')
+                await conn.execute('DROP INDEX IF EXISTS idx_users_level_xp')
+        await create_users_table(conn)
+        last_user_id = ''
+        while True:
+            last_user_id = await conn.fetchval('''
+                WITH batch AS (
+                    SELECT user_id, username, xp, level, created_at, updated_at FROM users_legacy
+                    WHERE user_id > $2 ORDER BY user_id LIMIT $3
+                ), copied AS (
+                    INSERT INTO users (guild_id, user_id, username, xp, level, created_at, updated_at)
+                    SELECT $1, user_id::bigint, username, xp, level, created_at, updated_at FROM batch
+                    ON CONFLICT (guild_id, user_id) DO NOTHING
+                )
+                SELECT max(user_id) FROM batch
+            ''', guild_id, last_user_id, MIGRATION_BATCH_SIZE)
+            if last_user_id is None:
+                break
+        await conn.execute('DROP TABLE users_legacy')
+    else:
+        # Sur place : nouvelle colonne remplie par lots, index construit sans verrou, puis échange de clé
+        await conn.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS guild_id BIGINT')
+        while True:
+            status = await conn.execute('''
+                UPDATE users SET guild_id = $1
+                WHERE user_id IN (SELECT user_id FROM users WHERE guild_id IS NULL LIMIT $2)
+            ''', guild_id, MIGRATION_BATCH_SIZE)
+            if status == 'UPDATE 0':
+                break
+        await conn.execute('CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS users_guild_user_key ON users (guild_id, user_id)')
+        async with conn.transaction():
+            await conn.execute('ALTER TABLE users ALTER COLUMN guild_id SET NOT NULL')
+            await conn.execute('ALTER TABLE users DROP CONSTRAINT users_pkey')
+            await conn.execute('ALTER TABLE users ADD CONSTRAINT users_pkey PRIMARY KEY USING INDEX users_guild_user_key')
+        await conn.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_guild_rank ON users (guild_id, level DESC, xp DESC)')
+        await conn.execute('DROP INDEX IF EXISTS idx_users_level_xp')
+    # Trigger updated_at absent des tables créées par les anciennes versions du bot
+    await create_users_table(conn)
+    print(f'✅ XP migrée vers le serveur {guild_id}')
+
+
+async def text_id_columns(conn):
+    """Liste des colonnes d'identifiants encore au format TEXT : [(table, colonne)]"""
+    rows = await conn.fetch('''
+        SELECT table_name, column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = ANY($1::text[])
+          AND column_name IN ('guild_id', 'user_id') AND data_type = 'text'
+    ''', list(ID_COLUMNS))
+    return [(row['table_name'], row['column_name']) for row in rows
+            if row['column_name'] in ID_COLUMNS[row['table_name']]]
+
+
+async def migrate_ids_to_bigint(conn):
+    """Convertit les identifiants stockés en TEXT vers BIGINT (snowflakes Discord natifs).
+    Appliquée avant que l'XP et les sessions ne soient écrites."""
+    columns = {}
+    for table, column in await text_id_columns(conn):
+        columns.setdefault(table, []).append(column)
+    partitioned = await conn.fetchval(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('users')"
+    )
+    if partitioned and 'guild_id' in columns.get('users', []):
+        # La clé de partition ne peut pas changer de type : on recopie dans une nouvelle table
+        await rebuild_partitioned_users(conn)
+        columns.pop('users')
+    for table, cols in columns.items():
+        # Une seule réécriture par table, index reconstruits au passage
+        alters = ', '.join(f'ALTER COLUMN {col} TYPE BIGINT USING {col}::bigint' for col in cols)
+        await conn.execute(f'ALTER TABLE {table} {alters}')
+        print(f'✅ {table} : {", ".join(cols)} converti(s) en BIGINT')
+
+
+async def rebuild_partitioned_users(conn):
+    """Recopie par lots la table users partitionnée (identifiants TEXT) dans une table BIGINT"""
+    if await conn.fetchval("SELECT to_regclass('users_text') IS NULL"):
+        async with conn.transaction():
+            partitions = await conn.fetch(
+                "SELECT inhrelid::regclass::text AS name FROM pg_inherits WHERE inhparent = 'users'::regclass"
+            )
+            await conn.execute('ALTER TABLE users RENAME TO users_text')
+            for partition in partitions:
+                suffix = partition['name'].removeprefix('users_')
+                await conn.execute(f'ALTER TABLE {partition["name"]} RENAME TO users_text_{suffix}')
+            await conn.execute('ALTER INDEX IF EXISTS users_pkey RENAME TO users_text_pkey')
+            await conn.execute('ALTER INDEX IF EXISTS idx_users_guild_rank RENAME TO idx_users_text_guild_rank')
+    await create_users_table(conn)
+    last = ('', '')
+    while True:
+        row = await conn.fetchrow('''
+            WITH batch AS (
+                SELECT guild_id, user_id, username, xp, level, created_at, updated_at FROM users_text
+                WHERE (guild_id, user_id) > ($1, $2) ORDER BY guild_id, user_id LIMIT $3
+            ), copied AS (
+                INSERT INTO users (guild_id, user_id, username, xp, level, created_at, updated_at)
+                SELECT guild_id::bigint, user_id::bigint, username, xp, level, created_at, updated_at FROM batch
+                ON CONFLICT (guild_id, user_id) DO NOTHING
+            )
+            SELECT guild_id, user_id FROM batch ORDER BY guild_id DESC, user_id DESC LIMIT 1
+        ''', *last, MIGRATION_BATCH_SIZE)
+        if row is None:
+            break
+        last = (row['guild_id'], row['user_id'])
+    await conn.execute('DROP TABLE users_text')
+    print('✅ users : guild_id, user_id convertis en BIGINT')
+
+
+async def migration_purge_jobs(conn):
+    """Points de reprise des purges de salons (!clear, !clearchannel)"""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS purge_jobs (
+            channel_id BIGINT PRIMARY KEY,
+            guild_id BIGINT NOT NULL,
+            status_channel_id BIGINT NOT NULL,
+            status_message_id BIGINT NOT NULL,
+            remaining INTEGER,
+            before_id BIGINT NOT NULL,
+            deleted INTEGER NOT NULL DEFAULT 0,
+            ephemeral BOOLEAN NOT NULL DEFAULT FALSE,
+            state TEXT NOT NULL DEFAULT 'running',
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+async def migration_heartbeat(conn):
+    """Dernier signe de vie du bot (une seule ligne), à la place de last_seen sur chaque session ouverte"""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS bot_heartbeat (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            seen_at TIMESTAMP NOT NULL
+        )
+    ''')
+
+
+async def migration_purge_permission(conn):
+    """Permission nécessaire pour arrêter ou reprendre une purge (celle de la commande qui l'a lancée)"""
+    await conn.execute('''
+        ALTER TABLE purge_jobs ADD COLUMN IF NOT EXISTS permission TEXT NOT NULL DEFAULT 'manage_messages';
+        -- Seul !clearchannel purge un salon entier
+        UPDATE purge_jobs SET permission = 'manage_channels' WHERE remaining IS NULL;
+    ''')
+
+
+async def migration_drop_last_seen(conn):
+    """game_sessions.last_seen (anciennes bases) : repris dans bot_heartbeat puis supprimé"""
+    await conn.execute('''
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM information_schema.columns
+                       WHERE table_name = 'game_sessions' AND column_name = 'last_seen') THEN
+                INSERT INTO bot_heartbeat (id, seen_at)
+                SELECT TRUE, max(last_seen) FROM game_sessions HAVING max(last_seen) IS NOT NULL
+                ON CONFLICT (id) DO NOTHING;
+                ALTER TABLE game_sessions DROP COLUMN last_seen;
+            END IF;
+        END $$;
+    ''')
+
+
+MIGRATIONS = [
+    (1, 'tables de base', migration_base_tables),
+    (2, 'XP par serveur', migration_users_by_guild),
+    (3, 'identifiants BIGINT', migrate_ids_to_bigint),
+    (4, 'purges reprenables', migration_purge_jobs),
+    (5, 'battement du bot', migration_heartbeat),
+    (6, 'permission des purges', migration_purge_permission),
+    (7, 'suppression de last_seen', migration_drop_last_seen),
+]
+
+async def run_migrations(conn):
+    """Applique dans l'ordre les migrations pas encore enregistrées dans schema_migrations"""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    applied = {row['version'] for row in await conn.fetch('SELECT version FROM schema_migrations')}
+    if all(version in applied for version, _, _ in MIGRATIONS):
+        return
+    # Plusieurs instances au démarrage : une seule applique, les autres attendent puis revérifient
+    await conn.execute('SELECT pg_advisory_lock($1)', MIGRATION_LOCK_ID)
+    try:
+        applied = {row['version'] for row in await conn.fetch('SELECT version FROM schema_migrations')}
+        for version, name, migrate in MIGRATIONS:
+            if version in applied:
+                continue
+            await migrate(conn)
+            await conn.execute(
+                'INSERT INTO schema_migrations (version, name) VALUES ($1, $2) ON CONFLICT DO NOTHING',
+                version, name
+            )
+            print(f'✅ Migration {version} appliquée : {name}')
+    finally:
+        await conn.execute('SELECT pg_advisory_unlock($1)', MIGRATION_LOCK_ID)
+
+
+class TimedPool:
+    """Enveloppe du pool asyncpg qui mesure l'attente d'une connexion libre"""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    def acquire(self):
+        return TimedAcquire(self._pool)
+
+
+class TimedAcquire:
+    __slots__ = ('_pool', '_conn')
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        self._conn = await self._pool.acquire()
+        metrics.observe('db_pool_acquire_seconds', time.perf_counter() - start)
+        return self._conn
+
+    async def __aexit__(self, *exc):
+        await self._pool.release(self._conn)
+
+
+def pool_connections():
+    size, idle = db_pool.get_size(), db_pool.get_idle_size()
+    return {(('state', 'busy'),): size - idle, (('state', 'idle'),): idle}
+
+
+metrics.collector('db_pool_connections', 'gauge', 'Connexions du pool PostgreSQL', pool_connections)
+metrics.collector('db_pool_max_connections', 'gauge', 'Taille max du pool PostgreSQL', lambda: db_pool.get_max_size())
+metrics.describe('db_rows_flushed_total', 'counter', 'Lignes écrites par les tampons write-behind')
+
+
 # Initialisation de la base de données PostgreSQL
 async def init_db():
+    """Crée le pool de connexions puis applique les migrations en attente (une seule fois, avant
+    la connexion à Discord)"""
     global db_pool
     # Récupère les informations de connexion depuis .env
     DATABASE_URL = os.getenv('DATABASE_URL')
@@ -27,223 +691,3245 @@ async def init_db():
         DATABASE_URL = f'postgresql://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}'
     
     # Créer le pool de connexions
-    db_pool = await asyncpg.create_pool(DATABASE_URL, min_size=5, max_size=20)
-    
-    # Créer la table si elle n'existe pas
+    db_pool = TimedPool(await asyncpg.create_pool(DATABASE_URL, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE))
     async with db_pool.acquire() as conn:
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id TEXT PRIMARY KEY,
-                username TEXT,
-                xp INTEGER DEFAULT 0,
-                level INTEGER DEFAULT 1,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        await run_migrations(conn)
     print('✅ Base de données PostgreSQL connectée!')
 
+
+async def close_db():
+    """Ferme proprement le pool (après le dernier flush des tampons)"""
+    global db_pool
+    if db_pool is not None:
+        pool, db_pool = db_pool, None
+        await pool.close()
+
+
 # Fonctions pour gérer la base de données
-async def get_user_data(user_id, username=None):
+@metrics.timed('db_query_seconds', query='get_user_data')
+async def get_user_data(guild_id, user_id, username=None):
     async with db_pool.acquire() as conn:
-        result = await conn.fetchrow('SELECT xp, level, username FROM users WHERE user_id = $1', user_id)
+        result = await conn.fetchrow(
+            'SELECT xp, level, username FROM users WHERE guild_id = $1 AND user_id = $2',
+            guild_id, user_id
+        )
         
         if result:
             # Mettre à jour le pseudo s'il a changé
             if username and result['username'] != username:
-                await conn.execute('UPDATE users SET username = $1, updated_at = CURRENT_TIMESTAMP WHERE user_id = $2', username, user_id)
-            return {"xp": result['xp'], "level": result['level'], "username": result['username']}
+                await conn.execute(
+                    'UPDATE users SET username = $1, updated_at = CURRENT_TIMESTAMP WHERE guild_id = $2 AND user_id = $3',
+                    username, guild_id, user_id
+                )
+            return {"xp": result['xp'], "level": result['level'], "username": username or result['username']}
         else:
             # Créer un nouveau utilisateur avec son pseudo
             await conn.execute(
-                'INSERT INTO users (user_id, username, xp, level) VALUES ($1, $2, 0, 1)',
-                user_id, username or "Unknown"
+                'INSERT INTO users (guild_id, user_id, username, xp, level) VALUES ($1, $2, $3, 0, 1)',
+                guild_id, user_id, username or "Unknown"
             )
             return {"xp": 0, "level": 1, "username": username or "Unknown"}
 
-async def update_user_data(user_id, xp, level):
+@metrics.timed('db_query_seconds', query='update_user_data')
+async def update_user_data(guild_id, user_id, xp, level):
+    async with db_pool.acquire() as conn:
+        await conn.execute(
+            'UPDATE users SET xp = $1, level = $2, updated_at = CURRENT_TIMESTAMP WHERE guild_id = $3 AND user_id = $4',
+            xp, level, guild_id, user_id
+        )
+
+@metrics.timed('db_query_seconds', query='get_leaderboard')
+async def get_leaderboard(guild_id, limit=10):
+    async with db_pool.acquire() as conn:
+        results = await conn.fetch(
+            'SELECT user_id, username, xp, level FROM users WHERE guild_id = $1 ORDER BY level DESC, xp DESC LIMIT $2',
+            guild_id, limit
+        )
+        return results
+
+
+# ========== CLASSEMENT EN CACHE ==========
+LEADERBOARD_SIZE = 20   # taille max affichée par !leaderboard
+
+class LeaderboardCache:
+    """Top N du classement de chaque serveur gardé en mémoire et corrigé à chaque gain d'XP,
+    au lieu d'un ORDER BY à chaque !leaderboard"""
+
+    def __init__(self, size):
+        self.size = size
+        # Format: {guild_id: [entrées triées]} (absent = à recharger depuis la base)
+        self._guilds = {}
+        # Chargements en cours : une seule requête par serveur, partagée
+        self._loads = {}
+        # Gains d'XP reçus pendant un chargement, rejoués sur les lignes lues
+        # Format: {guild_id: {user_id: (pseudo, xp, niveau)}} (None = invalidé pendant le chargement)
+        self._changes = {}
+        self.loads = 0
+
+    async def top(self, guild_id, limit):
+        entries = self._guilds.get(guild_id)
+        if entries is None:
+            load = self._loads.get(guild_id)
+            if load is None:
+                load = self._loads[guild_id] = asyncio.create_task(self._load(guild_id))
+            entries = await asyncio.shield(load)
+        return entries[:limit]
+
+    async def _load(self, guild_id):
+        self._changes[guild_id] = {}
+        try:
+            # Les écritures en attente doivent être en base avant de recharger
+            await xp_accumulator.flush()
+            records = await get_leaderboard(guild_id, self.size)
+        finally:
+            changes = self._changes.pop(guild_id)
+            del self._loads[guild_id]
+        entries = [dict(record) for record in records]
+        self.loads += 1
+        if changes is None:
+            return entries  # Mise à jour en masse pendant la lecture : à relire au prochain appel
+        self._guilds[guild_id] = entries
+        for user_id, (username, xp, level) in changes.items():
+            self.observe(guild_id, user_id, username, xp, level)
+        return entries
+
+    def observe(self, guild_id, user_id, username, xp, level):
+        """Met à jour le cache après un changement d'XP"""
+        entries = self._guilds.get(guild_id)
+        if entries is None:
+            changes = self._changes.get(guild_id)
+            if changes is not None:
+                changes[user_id] = (username, xp, level)
+            return
+        for entry in entries:
+            if entry['user_id'] == user_id:
+                if (level, xp) < (entry['level'], entry['xp']) and len(entries) >= self.size:
+                    # Le joueur descend : quelqu'un hors du cache peut le dépasser
+                    self.invalidate(guild_id)
+                    return
+                entry.update(username=username or entry['username'], xp=xp, level=level)
+                break
+        else:
+            last = entries[-1] if entries else None
+            if len(entries) >= self.size and (level, xp) <= (last['level'], last['xp']):
+                return  # Pas dans le top : rien à faire
+            entries.append({'user_id': user_id, 'username': username, 'xp': xp, 'level': level})
+        entries.sort(key=lambda e: (e['level'], e['xp']), reverse=True)
+        del entries[self.size:]
+
+    def invalidate(self, guild_id=None):
+        if guild_id is None:
+            self._guilds.clear()
+            self._changes = dict.fromkeys(self._changes)
+        else:
+            self._guilds.pop(guild_id, None)
+            if guild_id in self._changes:
+                self._changes[guild_id] = None
+
+
+leaderboard_cache = LeaderboardCache(LEADERBOARD_SIZE)
+
+
+RANK_TOTAL_TTL = 300   # secondes de validité du nombre de joueurs par serveur affiché par !rank
+
+# Nombre de joueurs par serveur. Format: {guild_id: (nombre, instant du comptage)}
+guild_player_counts = {}
+
+@metrics.timed('db_query_seconds', query='get_rank')
+async def get_rank(guild_id, user_id, xp, level):
+    """Position exacte d'un joueur dans son serveur, sans attendre le flush de l'XP : la base compte
+    ceux devant lui grâce à l'index (guild_id, level, xp), hors joueurs dont l'XP n'est pas encore
+    écrite, qui sont comptés depuis le cache. Le total vient d'un comptage mis en cache."""
+    pending = [key[1] for key in xp_accumulator.dirty if key[0] == guild_id and key[1] != user_id]
+    pending_ahead = 0
+    for pending_id in pending:
+        data = xp_accumulator.cache.get((guild_id, pending_id))
+        if data is not None and (data['level'], data['xp']) > (level, xp):
+            pending_ahead += 1
+    counted = guild_player_counts.get(guild_id)
+    async with db_pool.acquire() as conn:
+        ahead = await conn.fetchval(
+            'SELECT count(*) FROM users WHERE guild_id = $1 AND (level, xp) > ($2, $3) '
+            'AND user_id <> ALL($4::bigint[])',
+            guild_id, level, xp, pending + [user_id]
+        )
+        if counted is None or time.monotonic() - counted[1] > RANK_TOTAL_TTL:
+            counted = guild_player_counts[guild_id] = (
+                await conn.fetchval('SELECT count(*) FROM users WHERE guild_id = $1', guild_id), time.monotonic()
+            )
+    position = ahead + pending_ahead + 1
+    return position, max(counted[0], position)
+
+
+# ========== ACCUMULATEUR D'XP (write-behind) ==========
+# Au lieu de 2-3 requêtes par message, l'XP est gardée en mémoire et écrite par lots
+XP_FLUSH_INTERVAL = float(os.getenv('XP_FLUSH_INTERVAL', '5'))        # secondes entre deux écritures
+XP_FLUSH_BATCH_SIZE = int(os.getenv('XP_FLUSH_BATCH_SIZE', '500'))    # flush anticipé au-delà de N joueurs modifiés
+XP_CACHE_SIZE = int(os.getenv('XP_CACHE_SIZE', '50000'))              # joueurs gardés en mémoire (les moins récents sont oubliés)
+
+class WriteBehindBuffer(abc.ABC):
+    """Base des tampons écrits en base en arrière-plan : flush toutes les N secondes,
+    ou plus tôt si le lot est plein"""
+
+    def __init__(self, flush_interval, batch_size):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._flush_lock = asyncio.Lock()
+        self._flush_needed = asyncio.Event()
+        self._task = None
+
+    @abc.abstractmethod
+    def _pending_count(self):
+        """Nombre d'éléments en attente d'écriture"""
+
+    @abc.abstractmethod
+    async def _write(self):
+        """Écrit le contenu du tampon (appelé sous verrou, base disponible)"""
+
+    def _notify(self):
+        if self._pending_count() >= self.batch_size:
+            self._flush_needed.set()
+
+    async def flush(self):
+        if not self._pending_count() or db_pool is None:
+            return 0
+        async with self._flush_lock:
+            start = time.perf_counter()
+            status = 'error'
+            try:
+                written = await self._write()
+                status = 'ok'
+            finally:
+                metrics.observe('db_query_seconds', time.perf_counter() - start,
+                                query=f'{type(self).__name__}.flush', status=status)
+            metrics.inc('db_rows_flushed_total', written, buffer=type(self).__name__)
+            return written
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f'❌ Écriture en arrière-plan échouée ({type(self).__name__}): {e}')
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Arrête la boucle et vide le tampon (appelé à l'arrêt du bot)"""
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            # Un flush interrompu remet son lot dans le tampon : attendre qu'il l'ait fait
+            await asyncio.gather(task, return_exceptions=True)
+        await self.flush()
+
+
+class XPAccumulator(WriteBehindBuffer):
+    """Cache mémoire de l'XP des joueurs, écrit en base par lots (un seul upsert multi-lignes)"""
+
+    def __init__(self, flush_interval, batch_size, max_size):
+        super().__init__(flush_interval, batch_size)
+        self.max_size = max_size
+        # Du moins récent au plus récent. Format: {(guild_id, user_id): {"xp": int, "level": int, "username": str}}
+        self.cache = OrderedDict()
+        self.dirty = set()
+        # Incrémenté après chaque mise à jour en masse : une lecture commencée avant est jetée
+        self.generation = 0
+        # Pendant un import : XP gagnée par joueur à ré-appliquer ensuite (None = valeur posée avec set)
+        self._deltas = None
+        # Une seule mise à jour en masse (bulk, reload) à la fois
+        self._bulk_lock = asyncio.Lock()
+
+    async def get(self, guild_id, user_id, username=None):
+        """Retourne les données du joueur sur ce serveur (une seule requête SQL au premier message)"""
+        key = (guild_id, user_id)
+        data = self.cache.get(key)
+        if data is None:
+            while True:
+                generation = self.generation
+                loaded = await get_user_data(guild_id, user_id, username)
+                if generation == self.generation:
+                    break
+                # Une mise à jour en masse est passée pendant la lecture : la ligne lue est périmée
+            # Un autre message a pu charger le joueur pendant l'attente
+            data = self.cache.setdefault(key, loaded)
+        else:
+            self.cache.move_to_end(key)
+            if username and data['username'] != username:
+                data['username'] = username
+                self._mark_dirty(key)
+                leaderboard_cache.observe(guild_id, user_id, username, data['xp'], data['level'])
+        return data
+
+    def set(self, guild_id, user_id, xp, level, username=None):
+        """Remplace l'XP et le niveau d'un joueur (écrit au prochain flush)"""
+        key = (guild_id, user_id)
+        data = self.cache.setdefault(key, {"xp": xp, "level": level, "username": username})
+        data['xp'] = xp
+        data['level'] = level
+        if username:
+            data['username'] = username
+        if self._deltas is not None:
+            self._deltas[key] = None
+        self._mark_dirty(key)
+        leaderboard_cache.observe(guild_id, user_id, data['username'], xp, level)
+        return data
+
+    async def add_xp(self, guild_id, user_id, username, amount):
+        """Ajoute de l'XP et retourne (données, level_up) sans attendre la base"""
+        data = await self.get(guild_id, user_id, username)
+        # Même courbe que !giveXP et l'import : plusieurs niveaux d'un coup si le gain le permet
+        data['level'], data['xp'], gained = apply_xp_gain(data['level'], data['xp'], amount)
+        key = (guild_id, user_id)
+        if self._deltas is not None and self._deltas.get(key, 0) is not None:
+            self._deltas[key] = self._deltas.get(key, 0) + amount
+        self._mark_dirty(key)
+        leaderboard_cache.observe(guild_id, user_id, data['username'], data['xp'], data['level'])
+        return data, gained > 0
+
+    def _mark_dirty(self, key):
+        self.dirty.add(key)
+        self._notify()
+
+    def _pending_count(self):
+        # Pendant un import, rien n'est écrit : les valeurs en cache datent d'avant l'import
+        return len(self.dirty) if self._deltas is None else 0
+
+    async def _write(self):
+        """Écrit tous les joueurs modifiés en une seule requête"""
+        keys = list(self.dirty)
+        self.dirty.clear()
+        # Photo des valeurs au moment du flush
+        rows = [self.cache[key] for key in keys]
+        guild_ids = [key[0] for key in keys]
+        user_ids = [key[1] for key in keys]
+        usernames = [row['username'] for row in rows]
+        xps = [row['xp'] for row in rows]
+        levels = [row['level'] for row in rows]
+        try:
+            async with db_pool.acquire() as conn:
+                await conn.execute('''
+                    INSERT INTO users (guild_id, user_id, username, xp, level)
+                    SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::text[], $4::int[], $5::int[])
+                    ON CONFLICT (guild_id, user_id) DO UPDATE SET
+                        username = COALESCE(EXCLUDED.username, users.username),
+                        xp = EXCLUDED.xp,
+                        level = EXCLUDED.level,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', guild_ids, user_ids, usernames, xps, levels)
+        except BaseException:
+            # On garde les modifications pour le prochain essai (aussi si le flush est annulé à l'arrêt)
+            self.dirty.update(keys)
+            raise
+        self._evict()
+        return len(keys)
+
+    def _evict(self):
+        """Oublie les joueurs les moins récents déjà écrits en base au-delà de max_size"""
+        excess = len(self.cache) - self.max_size
+        if excess <= 0:
+            return
+        oldest = [key for key, _ in zip(self.cache, range(excess + len(self.dirty)))]
+        for key in oldest:
+            if key not in self.dirty:
+                del self.cache[key]
+                excess -= 1
+                if not excess:
+                    break
+
+    async def bulk(self, operation, guild_id, *args):
+        """Mise à jour SQL en masse (give_xp_bulk, reset_xp_bulk) : l'XP en attente est écrite avant,
+        sinon le prochain flush écraserait le résultat, puis le cache est recalé sur les lignes renvoyées
+        (plus l'XP gagnée pendant la requête)"""
+        async with self._bulk_lock:
+            async with self._flush_lock:
+                if self.dirty:
+                    await self._write()
+                self._deltas = {}
+                try:
+                    rows = await operation(guild_id, *args)
+                finally:
+                    deltas, self._deltas = self._deltas, None
+                    self.generation += 1
+            for row in rows:
+                key = (guild_id, row['user_id'])
+                data = self.cache.get(key)
+                delta = deltas.get(key, 0)
+                if data is None or delta is None:
+                    continue  # Pas en cache, ou valeur posée avec set pendant la requête : gardée
+                data['level'], data['xp'], _ = apply_xp_gain(row['level'], row['xp'], delta)
+                if delta:
+                    self._mark_dirty(key)
+            leaderboard_cache.invalidate(guild_id)
+            return rows
+
+    async def reload(self, operation, *args):
+        """Comme bulk, pour les opérations trop grosses pour renvoyer les lignes (import). Les flush sont
+        suspendus pendant l'opération sans bloquer personne, l'XP gagnée entre-temps est notée puis
+        ré-appliquée sur les valeurs relues en base, et le reste du cache est oublié."""
+        async with self._bulk_lock:
+            async with self._flush_lock:
+                if self.dirty:
+                    await self._write()
+                self._deltas = {}
+            try:
+                return await operation(*args)
+            finally:
+                deltas, self._deltas = self._deltas, None
+                self.generation += 1
+                # Valeurs posées avec set pendant l'opération : gardées telles quelles
+                kept = {key: self.cache[key] for key, delta in deltas.items() if delta is None and key in self.cache}
+                self.cache.clear()
+                self.dirty.clear()
+                self.cache.update(kept)
+                self.dirty.update(kept)
+                leaderboard_cache.invalidate()
+                earned = {key: delta for key, delta in deltas.items() if delta is not None}
+                if earned:
+                    try:
+                        await self._reapply(earned)
+                    except Exception as e:
+                        print(f"❌ XP gagnée pendant l'import perdue ({len(earned)} joueurs): {e}")
+                self._notify()
+
+    async def _reapply(self, earned):
+        """Ajoute l'XP gagnée pendant un import aux valeurs maintenant en base"""
+        async with db_pool.acquire() as conn:
+            rows = await conn.fetch('''
+                SELECT v.guild_id, v.user_id, u.username, u.xp, u.level
+                FROM unnest($1::bigint[], $2::bigint[]) AS v(guild_id, user_id)
+                JOIN users u ON u.guild_id = v.guild_id AND u.user_id = v.user_id
+            ''', [key[0] for key in earned], [key[1] for key in earned])
+        for row in rows:
+            key = (row['guild_id'], row['user_id'])
+            # Déjà relu par un message après l'import : la valeur en cache est à jour, on ajoute dessus
+            data = self.cache.get(key)
+            if data is None:
+                data = self.cache[key] = {'xp': row['xp'], 'level': row['level'], 'username': row['username']}
+            data['level'], data['xp'], _ = apply_xp_gain(data['level'], data['xp'], earned[key])
+            self._mark_dirty(key)
+
+
+xp_accumulator = XPAccumulator(XP_FLUSH_INTERVAL, XP_FLUSH_BATCH_SIZE, XP_CACHE_SIZE)
+
+
+# ========== ANTI-FARM DE L'XP ==========
+# Vérifié dans on_message avant tout accès à la base : un message qui ne rapporte rien ne coûte qu'une
+# recherche en mémoire. État compact (tableaux typés, ~18 octets par joueur) pour tenir 100k+ membres actifs.
+
+def parse_channel_multipliers(spec):
+    """'123:2,456:0' -> {123: 2.0, 456: 0.0}"""
+    multipliers = {}
+    for item in spec.split(','):
+        if item.strip():
+            channel_id, _, value = item.partition(':')
+            multipliers[int(channel_id)] = float(value)
+    return multipliers
+
+
+XP_PER_MESSAGE = int(os.getenv('XP_PER_MESSAGE', '10'))          # XP de base par message récompensé
+XP_MIN_INTERVAL = int(os.getenv('XP_MIN_INTERVAL', '60'))        # secondes min entre deux messages récompensés
+XP_WINDOW = int(os.getenv('XP_WINDOW', '3600'))                  # fenêtre du plafond en secondes...
+XP_WINDOW_CAP = int(os.getenv('XP_WINDOW_CAP', '30'))            # ...et messages récompensés max dans la fenêtre
+# Multiplicateurs par salon (ou salon parent d'un fil) : "id:multiplicateur,...", 0 = pas d'XP
+XP_CHANNEL_MULTIPLIERS = parse_channel_multipliers(os.getenv('XP_CHANNEL_MULTIPLIERS', ''))
+COOLDOWN_MIN_CAPACITY = 1024
+COOLDOWN_MAX_LOAD = 0.7
+
+FIBONACCI_HASH = 11400714819323198485   # 2^64 / nombre d'or : disperse les snowflakes
+
+
+class CooldownTable:
+    """Table de hachage à adressage ouvert d'un serveur, sur des tableaux typés :
+    id du joueur, dernier message récompensé, début de fenêtre, messages récompensés dans la fenêtre"""
+    __slots__ = ('bits', 'mask', 'used', 'users', 'last', 'window', 'count')
+
+    def __init__(self, capacity):
+        self.bits = capacity.bit_length() - 1
+        self.mask = capacity - 1
+        self.used = 0
+        self.users = array('Q', bytes(8 * capacity))   # 0 = case libre (aucun snowflake ne vaut 0)
+        self.last = array('I', bytes(4 * capacity))
+        self.window = array('I', bytes(4 * capacity))
+        self.count = array('H', bytes(2 * capacity))
+
+    def slot(self, user_id):
+        """Case du joueur, ou case libre où l'insérer (sondage linéaire)"""
+        users = self.users
+        i = ((user_id * FIBONACCI_HASH) & 0xFFFFFFFFFFFFFFFF) >> (64 - self.bits)
+        while users[i] and users[i] != user_id:
+            i = (i + 1) & self.mask
+        return i
+
+    def nbytes(self):
+        return sum(len(a) * a.itemsize for a in (self.users, self.last, self.window, self.count))
+
+
+class XPCooldowns:
+    """Décide si un message rapporte de l'XP : intervalle minimal par joueur, plafond par fenêtre,
+    multiplicateur par salon. Une table par serveur (l'XP est par serveur)."""
+
+    def __init__(self, interval, window, cap, multipliers):
+        self.interval = interval
+        self.window = window
+        self.cap = min(cap, 0xFFFF)
+        self.multipliers = multipliers
+        self._epoch = time.monotonic()
+        # Format: {guild_id: CooldownTable}
+        self._tables = {}
+        self.awarded = 0
+        self.cooldown = 0
+        self.capped = 0
+
+    def xp_for(self, message, now=None):
+        """XP que rapporte ce message (0 = rien, ne pas toucher à la base)"""
+        channel = message.channel
+        multiplier = self.multipliers.get(channel.id)
+        if multiplier is None:
+            multiplier = self.multipliers.get(getattr(channel, 'parent_id', None), 1)
+        if multiplier <= 0:
+            return 0
+        if not self.allow(message.guild.id, message.author.id, now):
+            return 0
+        return max(1, round(XP_PER_MESSAGE * multiplier))
+
+    def allow(self, guild_id, user_id, now=None):
+        """True si le joueur peut gagner de l'XP maintenant (et l'enregistre)"""
+        # Secondes depuis le démarrage, +1 pour ne jamais valoir 0 (= jamais récompensé).
+        # Présent arrondi vers le bas, instants enregistrés vers le haut : un délai n'est jamais écoulé en avance
+        elapsed = (time.monotonic() if now is None else now) - self._epoch
+        now = int(elapsed) + 1
+        stamp = math.ceil(elapsed) + 1
+        table = self._tables.get(guild_id)
+        if table is None:
+            table = self._tables[guild_id] = CooldownTable(COOLDOWN_MIN_CAPACITY)
+        i = table.slot(user_id)
+        if table.users[i]:
+            if now - table.last[i] < self.interval:
+                self.cooldown += 1
+                return False
+            if now - table.window[i] >= self.window:
+                table.window[i] = stamp
+                table.count[i] = 0
+            elif table.count[i] >= self.cap:
+                self.capped += 1
+                return False
+            table.last[i] = stamp
+            table.count[i] += 1
+        else:
+            table.users[i] = user_id
+            table.last[i] = table.window[i] = stamp
+            table.count[i] = 1
+            table.used += 1
+            if table.used > COOLDOWN_MAX_LOAD * len(table.users):
+                self._tables[guild_id] = self._rebuild(table, now)
+        self.awarded += 1
+        return True
+
+    def _rebuild(self, table, now):
+        """Nouvelle table sans les joueurs dont l'intervalle et la fenêtre sont écoulés,
+        agrandie seulement si les joueurs encore actifs la remplissent"""
+        horizon = max(self.interval, self.window)
+        live = [i for i, user_id in enumerate(table.users)
+                if user_id and (now - table.last[i] < horizon or now - table.window[i] < horizon)]
+        capacity = COOLDOWN_MIN_CAPACITY
+        while len(live) > capacity * COOLDOWN_MAX_LOAD / 2:
+            capacity *= 2
+        rebuilt = CooldownTable(capacity)
+        for i in live:
+            j = rebuilt.slot(table.users[i])
+            rebuilt.users[j] = table.users[i]
+            rebuilt.last[j] = table.last[i]
+            rebuilt.window[j] = table.window[i]
+            rebuilt.count[j] = table.count[i]
+        rebuilt.used = len(live)
+        return rebuilt
+
+    def stats(self):
+        return {
+            'tracked': sum(table.used for table in self._tables.values()),
+            'bytes': sum(table.nbytes() for table in self._tables.values()),
+        }
+
+
+xp_cooldowns = XPCooldowns(XP_MIN_INTERVAL, XP_WINDOW, XP_WINDOW_CAP, XP_CHANNEL_MULTIPLIERS)
+metrics.collector('xp_messages_total', 'counter', "Messages reçus par l'anti-farm de l'XP", lambda: {
+    (('result', 'awarded'),): xp_cooldowns.awarded,
+    (('result', 'cooldown'),): xp_cooldowns.cooldown,
+    (('result', 'capped'),): xp_cooldowns.capped,
+})
+metrics.collector('xp_cooldown_bytes', 'gauge', "Mémoire des tables de l'anti-farm", lambda: xp_cooldowns.stats()['bytes'])
+
+
+# ========== COURBE DES NIVEAUX ==========
+# Passer du niveau L au niveau L+1 coûte L*100 XP (l'XP restante est gardée)
+
+def xp_for_levels(level, count):
+    """XP nécessaire pour monter de count niveaux à partir de level"""
+    return 100 * count * level + 50 * count * (count - 1)
+
+
+def apply_xp_gain(level, xp, amount):
+    """(niveau, XP restante, niveaux gagnés) après un gain d'XP, sans boucle :
+    plus grand k tel que 50k² + 50(2L-1)k <= xp"""
+    xp += amount
+    b = 2 * level - 1
+    gained = max(0, (math.isqrt(b * b + 2 * xp // 25) - b) // 2)
+    # Corrige l'arrondi de la racine entière (au plus un pas)
+    while xp_for_levels(level, gained + 1) <= xp:
+        gained += 1
+    while gained and xp_for_levels(level, gained) > xp:
+        gained -= 1
+    return level + gained, xp - xp_for_levels(level, gained), gained
+
+
+def sql_levels_gained(level, xp):
+    """Même calcul que apply_xp_gain, en SQL (expressions level et xp déjà additionnées)"""
+    return f"floor((1 - 2 * {level} + sqrt(((2 * {level} - 1)::numeric) ^ 2 + {xp} * 2 / 25.0)) / 2)::int"
+
+
+@metrics.timed('db_query_seconds', query='give_xp_bulk')
+async def give_xp_bulk(guild_id, user_ids, usernames, amount):
+    """Donne amount XP à tous ces joueurs en une requête (même formule que apply_xp_gain).
+    Retourne (user_id, xp, level, gained) par joueur."""
+    async with db_pool.acquire() as conn:
+        return await conn.fetch(f'''
+            WITH targets AS (
+                SELECT t.user_id, t.username, COALESCE(u.level, 1) AS level, COALESCE(u.xp, 0) + $4 AS xp
+                FROM unnest($2::bigint[], $3::text[]) AS t(user_id, username)
+                LEFT JOIN users u ON u.guild_id = $1 AND u.user_id = t.user_id
+            ), gains AS (
+                SELECT targets.*, {sql_levels_gained('level', 'xp')} AS gained FROM targets
+            ), written AS (
+                INSERT INTO users AS u (guild_id, user_id, username, xp, level)
+                SELECT $1, user_id, username, xp - (100 * gained * level + 50 * gained * (gained - 1)), level + gained
+                FROM gains
+                ON CONFLICT (guild_id, user_id) DO UPDATE SET
+                    username = EXCLUDED.username,
+                    xp = EXCLUDED.xp,
+                    level = EXCLUDED.level,
+                    updated_at = CURRENT_TIMESTAMP
+                RETURNING u.user_id, u.xp, u.level
+            )
+            SELECT written.*, gains.gained FROM written JOIN gains USING (user_id)
+        ''', guild_id, user_ids, usernames, amount)
+
+
+@metrics.timed('db_query_seconds', query='reset_xp_bulk')
+async def reset_xp_bulk(guild_id, user_ids=None):
+    """Remet à zéro ces joueurs (ou tout le serveur si user_ids est None) en une requête.
+    Retourne (user_id, xp, level, old_xp, old_level) par joueur remis à zéro."""
+    async with db_pool.acquire() as conn:
+        return await conn.fetch('''
+            WITH old AS (
+                SELECT user_id, xp, level FROM users
+                WHERE guild_id = $1 AND ($2::bigint[] IS NULL OR user_id = ANY($2::bigint[]))
+                  AND (xp, level) <> (0, 1)
+                FOR UPDATE
+            )
+            UPDATE users u SET xp = 0, level = 1, updated_at = CURRENT_TIMESTAMP
+            FROM old
+            WHERE u.guild_id = $1 AND u.user_id = old.user_id
+            RETURNING u.user_id, u.xp, u.level, old.xp AS old_xp, old.level AS old_level
+        ''', guild_id, user_ids)
+
+
+# ========== EXPORT / IMPORT DE L'XP ==========
+# Sauvegardes et reprise des niveaux d'un autre bot : tout passe par COPY, en flux, pour une mémoire
+# bornée quelle que soit la taille des tables
+EXPORT_DIR = os.getenv('EXPORT_DIR', 'exports')                    # dossier des exports et des fichiers importés
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '10000'))   # lignes NDJSON envoyées par COPY à la fois
+IMPORT_MAX_LEVEL = int(os.getenv('IMPORT_MAX_LEVEL', '1000'))      # niveau max accepté (au-delà : ligne rejetée)
+IMPORT_MAX_BYTES = int(os.getenv('IMPORT_MAX_BYTES', str(100 << 20)))  # taille max d'un fichier importé
+EXPORT_KEEP = int(os.getenv('EXPORT_KEEP', '3'))                   # exports trop gros pour Discord gardés sur le disque
+DOWNLOAD_CHUNK_SIZE = 1 << 20                                       # morceaux écrits sur le disque au téléchargement
+
+# Tables exportées : (colonnes, filtre sur le serveur $1 ou tout si $1 est NULL)
+EXPORT_TABLES = {
+    'users': ('guild_id, user_id, username, xp, level', '$1::bigint IS NULL OR guild_id = $1'),
+    'playtime_daily': (
+        'day, game, user_id, seconds',
+        '$1::bigint IS NULL OR user_id IN (SELECT user_id FROM users WHERE guild_id = $1)'
+    ),
+    'playtime_monthly': (
+        'month, game, user_id, seconds',
+        '$1::bigint IS NULL OR user_id IN (SELECT user_id FROM users WHERE guild_id = $1)'
+    ),
+}
+
+# Colonnes de users remplies à l'import, et les noms reconnus dans les exports d'autres bots
+IMPORT_COLUMNS = ('guild_id', 'user_id', 'username', 'xp', 'level')
+IMPORT_COLUMN_ALIASES = {
+    'guild_id': 'guild_id', 'guild': 'guild_id', 'server_id': 'guild_id',
+    'user_id': 'user_id', 'id': 'user_id', 'userid': 'user_id', 'member_id': 'user_id', 'discord_id': 'user_id',
+    'username': 'username', 'name': 'username', 'pseudo': 'username',
+    'xp': 'xp', 'exp': 'xp', 'experience': 'xp', 'total_xp': 'xp',
+    'level': 'level', 'lvl': 'level', 'niveau': 'level',
+}
+
+
+def sql_bigint(expression):
+    """Texte -> BIGINT en SQL, NULL si ce n'est pas un identifiant Discord valide"""
+    return (f"CASE WHEN btrim({expression}) ~ '^[0-9]{{1,19}}$' "
+            f"AND btrim({expression})::numeric <= 9223372036854775807 THEN btrim({expression})::bigint END")
+
+
+# Fusion de la table temporaire dans users. $1 : serveur par défaut, $2 : niveau max,
+# $3 : recalculer les niveaux (xp = XP totale), $4 : écraser même les joueurs plus avancés ici
+IMPORT_MERGE_SQL = f'''
+    WITH typed AS (
+        SELECT {sql_bigint("COALESCE(NULLIF(btrim(guild_id), ''), $1::bigint::text)")} AS guild_id,
+               {sql_bigint('user_id')} AS user_id,
+               NULLIF(btrim(username), '') AS username,
+               CASE WHEN NULLIF(btrim(xp), '') IS NULL THEN 0
+                    WHEN btrim(xp) ~ '^[0-9]{{1,9}}$' THEN btrim(xp)::int END AS xp,
+               -- 0 = niveau absent, à déduire de l'XP
+               CASE WHEN NULLIF(btrim(level), '') IS NULL THEN 0
+                    WHEN btrim(level) ~ '^[0-9]{{1,9}}$' AND btrim(level)::int BETWEEN 1 AND $2 THEN btrim(level)::int
+               END AS level
+        FROM xp_import
+    ), valid AS (
+        SELECT DISTINCT ON (guild_id, user_id) * FROM typed
+        WHERE guild_id IS NOT NULL AND user_id IS NOT NULL AND xp IS NOT NULL AND level IS NOT NULL
+        ORDER BY guild_id, user_id, level DESC, xp DESC
+    ), gains AS (
+        SELECT valid.*, $3 OR level = 0 AS recalculate, {sql_levels_gained('1', 'xp')} AS gained FROM valid
+    ), mapped AS (
+        SELECT guild_id, user_id, username,
+               CASE WHEN recalculate THEN xp - (100 * gained + 50 * gained * (gained - 1)) ELSE xp END AS xp,
+               CASE WHEN recalculate THEN 1 + gained ELSE level END AS level
+        FROM gains
+    ), written AS (
+        INSERT INTO users AS u (guild_id, user_id, username, xp, level)
+        SELECT * FROM mapped WHERE level <= $2
+        ON CONFLICT (guild_id, user_id) DO UPDATE SET
+            username = COALESCE(EXCLUDED.username, u.username),
+            xp = EXCLUDED.xp,
+            level = EXCLUDED.level
+        WHERE $4 OR (EXCLUDED.level, EXCLUDED.xp) > (u.level, u.xp)
+        RETURNING 1
+    )
+    SELECT (SELECT count(*) FROM xp_import) AS staged,
+           (SELECT count(*) FROM mapped WHERE level <= $2) AS valid,
+           (SELECT count(*) FROM written) AS written,
+           (SELECT count(*) FROM xp_import WHERE $1::bigint IS NULL AND NULLIF(btrim(guild_id), '') IS NULL) AS no_guild
+'''
+
+
+class XPImportError(Exception):
+    """Fichier d'import inutilisable (message affiché tel quel)"""
+
+
+def import_columns(names):
+    """Colonne de users pour chaque colonne du fichier (None = ignorée)"""
+    columns = []
+    for name in names:
+        column = IMPORT_COLUMN_ALIASES.get(name.strip().casefold())
+        columns.append(column if column not in columns else None)
+    if 'user_id' not in columns:
+        raise XPImportError("colonne `user_id` (ou `id`) introuvable")
+    if 'xp' not in columns and 'level' not in columns:
+        raise XPImportError("il faut au moins une colonne `xp` ou `level`")
+    return columns
+
+
+def read_ndjson_batch(f, size):
+    """Jusqu'à size lignes NDJSON -> tuples de textes (ordre de IMPORT_COLUMNS), lignes illisibles, fin du fichier.
+    Appelé dans un thread."""
+    records = []
+    unreadable = 0
+    while len(records) < size:
+        line = f.readline()
+        if not line:
+            return records, unreadable, True
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            unreadable += 1
+            continue
+        if not isinstance(item, dict):
+            unreadable += 1
+            continue
+        row = dict.fromkeys(IMPORT_COLUMNS)
+        for key, value in item.items():
+            column = IMPORT_COLUMN_ALIASES.get(str(key).casefold())
+            if column is not None and value is not None and row[column] is None:
+                # 1234.0 -> '1234' (JSON de certains bots), le reste est validé en SQL
+                row[column] = str(int(value)) if isinstance(value, float) and value.is_integer() else str(value)
+        records.append(tuple(row[column] for column in IMPORT_COLUMNS))
+    return records, unreadable, False
+
+
+@metrics.timed('db_query_seconds', query='export_xp')
+async def export_xp(guild_id, stamp):
+    """Écrit chaque table de EXPORT_TABLES (un serveur, ou tout si guild_id est None) en CSV gzip
+    dans EXPORT_DIR, par COPY. Retourne [(chemin, lignes)]."""
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    await xp_accumulator.flush()
+    exported = []
+    async with db_pool.acquire() as conn:
+        for table, (columns, where) in EXPORT_TABLES.items():
+            if await conn.fetchval('SELECT to_regclass($1)', table) is None:
+                continue
+            path = os.path.join(EXPORT_DIR, f"xp-{guild_id or 'tout'}-{stamp}.{table}.csv.gz")
+            f = await asyncio.to_thread(gzip.open, path, 'wb')
+            try:
+                status = await conn.copy_from_query(
+                    f'SELECT {columns} FROM {table} WHERE {where}', guild_id,
+                    output=f, format='csv', header=True
+                )
+            finally:
+                await asyncio.to_thread(f.close)
+            rows = int(status.split()[-1])
+            if rows == 0 and table != 'users':
+                # Pas de temps de jeu enregistré : inutile de joindre un fichier vide
+                os.remove(path)
+                continue
+            exported.append((path, rows))
+    return exported
+
+
+def prune_exports(keep):
+    """Garde seulement les keep derniers exports (tous les fichiers d'un même export comptent pour un)"""
+    exports = {}
+    for entry in os.scandir(EXPORT_DIR):
+        if entry.name.startswith('xp-') and entry.name.endswith('.csv.gz'):
+            files = exports.setdefault(entry.name.split('.', 1)[0], [])
+            files.append((entry.stat().st_mtime, entry.path))
+    oldest_first = sorted(exports.values(), key=lambda files: max(files)[0])
+    for files in oldest_first[:max(0, len(oldest_first) - keep)]:
+        for _, path in files:
+            os.remove(path)
+
+
+@metrics.timed('db_query_seconds', query='import_xp')
+async def import_xp(path, guild_id, recalculate, replace):
+    """Importe un fichier CSV (avec en-tête) ou NDJSON, compressé en gzip ou non : COPY vers une table
+    temporaire puis une seule fusion validée. Tout ou rien. guild_id : serveur des lignes sans guild_id
+    (None en message privé). Retourne (lues, valides, écrites, illisibles, sans serveur)."""
+    ndjson = path.removesuffix('.gz').endswith(('.ndjson', '.jsonl', '.json'))
+    opener = gzip.open if path.endswith('.gz') else open
+    f = await asyncio.to_thread(opener, path, 'rb')
+    unreadable = 0
+    try:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                if ndjson:
+                    await conn.execute(
+                        f"CREATE TEMP TABLE xp_import ({', '.join(f'{c} TEXT' for c in IMPORT_COLUMNS)}) ON COMMIT DROP"
+                    )
+                    done = False
+                    while not done:
+                        records, skipped, done = await asyncio.to_thread(read_ndjson_batch, f, IMPORT_BATCH_SIZE)
+                        unreadable += skipped
+                        if records:
+                            await conn.copy_records_to_table('xp_import', records=records, columns=IMPORT_COLUMNS)
+                else:
+                    header = (await asyncio.to_thread(f.readline)).decode('utf-8-sig')
+                    delimiter = ';' if header.count(';') > header.count(',') else ','
+                    columns = import_columns(next(csv.reader([header], delimiter=delimiter), []))
+                    if guild_id is None and 'guild_id' not in columns:
+                        raise XPImportError("en message privé, le fichier doit avoir une colonne `guild_id` "
+                                            "(ou lance l'import depuis le serveur concerné)")
+                    # Les colonnes inconnues sont chargées puis ignorées (COPY ne sait pas en sauter)
+                    staged = [column or f'ignored_{i}' for i, column in enumerate(columns)]
+                    missing = [column for column in IMPORT_COLUMNS if column not in staged]
+                    await conn.execute(
+                        f"CREATE TEMP TABLE xp_import ({', '.join(f'{c} TEXT' for c in staged + missing)}) ON COMMIT DROP"
+                    )
+                    await conn.copy_to_table('xp_import', source=f, columns=staged, format='csv', delimiter=delimiter)
+                result = await conn.fetchrow(IMPORT_MERGE_SQL, guild_id, IMPORT_MAX_LEVEL, recalculate, replace)
+                if result['staged'] and result['no_guild'] == result['staged']:
+                    # NDJSON sans aucun guild_id en message privé : annulé comme pour un CSV
+                    raise XPImportError("en message privé, les lignes doivent avoir un `guild_id` "
+                                        "(ou lance l'import depuis le serveur concerné)")
+    finally:
+        await asyncio.to_thread(f.close)
+    return result['staged'], result['valid'], result['written'], unreadable, result['no_guild']
+
+
+def too_big_error(size):
+    return XPImportError(f"fichier trop gros ({size / (1 << 20):,.1f} Mo, max {IMPORT_MAX_BYTES / (1 << 20):,.0f} Mo)")
+
+
+async def download_attachment(attachment, path):
+    """Enregistre une pièce jointe sur le disque par morceaux (Attachment.save la charge entière en mémoire),
+    sans dépasser IMPORT_MAX_BYTES"""
+    if attachment.size > IMPORT_MAX_BYTES:
+        raise too_big_error(attachment.size)
+    async with ClientSession() as session:
+        async with session.get(attachment.url) as response:
+            response.raise_for_status()
+            f = await asyncio.to_thread(open, path, 'wb')
+            try:
+                received = 0
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    # La taille annoncée peut mentir : on compte aussi ce qui arrive vraiment
+                    received += len(chunk)
+                    if received > IMPORT_MAX_BYTES:
+                        raise too_big_error(received)
+                    await asyncio.to_thread(f.write, chunk)
+            finally:
+                await asyncio.to_thread(f.close)
+
+
+# ========== COMMANDES SLASH ==========
+# La synchronisation globale est très limitée par Discord et ne change rien tant que les commandes
+# ne changent pas : à faire à la main avec !sync, ou au démarrage si SYNC_COMMANDS_ON_START est activé
+SYNC_COMMANDS_ON_START = os.getenv('SYNC_COMMANDS_ON_START', 'false').lower() in ('1', 'true', 'yes', 'oui')
+DEV_GUILD_ID = int(os.getenv('DEV_GUILD_ID', '0')) or None   # serveur de test : commandes synchronisées là seulement (instantané)
+
+async def sync_app_commands(guild_id=DEV_GUILD_ID):
+    """Enregistre les commandes slash auprès de Discord (sur un seul serveur si guild_id). Retourne leur nombre."""
+    if guild_id is None:
+        return len(await bot.tree.sync())
+    guild = discord.Object(guild_id)
+    bot.tree.copy_global_to(guild=guild)
+    return len(await bot.tree.sync(guild=guild))
+
+
+class DiscordBot(commands.Bot):
+    async def setup_hook(self):
+        # Appelé une seule fois, avant la connexion à Discord (contrairement à on_ready,
+        # rappelé à chaque reconnexion)
+        await init_db()
+        await metrics_server.start()
+        xp_accumulator.start()
+        session_log.start()
+        joke_pool.refill()
+        if SYNC_COMMANDS_ON_START or DEV_GUILD_ID:
+            # Enregistre les commandes slash (/gamestats) auprès de Discord
+            try:
+                await sync_app_commands()
+            except discord.HTTPException as e:
+                print(f'❌ Impossible de synchroniser les commandes slash: {e}')
+
+    stopping = False
+
+    def dispatch(self, event_name, /, *args, **kwargs):
+        # Arrêt en cours : plus aucun événement, la base va être fermée
+        if not self.stopping:
+            super().dispatch(event_name, *args, **kwargs)
+
+    async def close(self):
+        self.stopping = True
+        try:
+            await purge_engine.stop()
+        except Exception as e:
+            print(f'❌ Impossible d\'interrompre les purges en cours: {e}')
+        await role_grants.stop()
+        # Dernières annonces envoyées tant que la connexion à Discord est ouverte
+        await outbound.close(OUTBOUND_CLOSE_TIMEOUT)
+        await super().close()
+        # Ne rien perdre de l'XP en attente avant de fermer la base
+        try:
+            await xp_accumulator.stop()
+        except Exception as e:
+            print(f'❌ Impossible de sauvegarder l\'XP en attente: {e}')
+        try:
+            await session_log.stop()
+        except Exception as e:
+            print(f'❌ Impossible de sauvegarder les sessions de jeu: {e}')
+        await close_db()
+        await metrics_server.stop()
+
+
+# ========== ENVOI DES MESSAGES DU BOT ==========
+# Tous les messages automatiques passent par une file par salon qui respecte les limites de Discord
+# et regroupe les annonces proches (5 lancements de jeu en 10s = 1 seul embed)
+SEND_RATE = int(os.getenv('SEND_RATE', '5'))                      # messages max par salon...
+SEND_PER = float(os.getenv('SEND_PER', '5'))                      # ...sur cette durée en secondes
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', '10'))       # secondes de regroupement des annonces
+COALESCE_MAX_LINES = int(os.getenv('COALESCE_MAX_LINES', '30'))   # annonces max par message groupé
+DISCORD_MAX_LENGTH = 2000             # caractères max d'un message
+EMBED_MAX_DESCRIPTION = 4096          # caractères max de la description d'un embed
+OUTBOUND_CLOSE_TIMEOUT = float(os.getenv('OUTBOUND_CLOSE_TIMEOUT', '5'))  # secondes pour vider les files à l'arrêt
+
+PRIORITY_HIGH = 0     # réponses de modération
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2      # annonces automatiques
+
+
+def combine_game_starts(lines):
+    embed = discord.Embed(
+        title="🎮 Sessions de Jeu Démarrées",
+        description="\n".join(lines),
+        color=discord.Color.green(),
+        timestamp=datetime.now()
+    )
+    embed.set_footer(text=f"{len(lines)} lancement(s) de jeu")
+    return {'embed': embed}
+
+
+# Comment fusionner plusieurs annonces du même type en un seul message
+COALESCE_FORMATS = {
+    'game_start': combine_game_starts,
+    'game_stop': lambda lines: {'content': "\n".join(lines)},
+    'level_up': lambda lines: {'content': "🎉 GG " + ", ".join(lines) + " !"},
+    'welcome': lambda lines: {'content': f"Yooo {', '.join(lines)}, bienvenue dans la team!"},
+}
+
+
+def fits_discord_limits(payload):
+    embed = payload.get('embed')
+    return (len(payload.get('content') or '') <= DISCORD_MAX_LENGTH
+            and (embed is None or len(embed.description or '') <= EMBED_MAX_DESCRIPTION))
+
+
+def coalesced_payloads(kind, lines):
+    """Fusionne des annonces en aussi peu de messages que possible, chacun sous les limites de Discord"""
+    combine = COALESCE_FORMATS[kind]
+    batch = []
+    for line in lines:
+        if batch and not fits_discord_limits(combine(batch + [line])):
+            yield combine(batch)
+            batch = []
+        batch.append(line)
+    if batch:
+        yield combine(batch)
+
+
+class ChannelQueue:
+    """File d'envoi d'un salon : seau à jetons + priorités"""
+    __slots__ = ('channel', 'tokens', 'updated', 'heap', 'worker', 'groups')
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.tokens = float(SEND_RATE)
+        self.updated = time.monotonic()
+        self.heap = []
+        self.worker = None
+        # Annonces en cours de regroupement. Format: {type: [lignes]}
+        self.groups = {}
+
+
+class OutboundScheduler:
+    """Planificateur d'envoi par salon : respecte ~SEND_RATE messages / SEND_PER secondes,
+    sert les messages prioritaires d'abord et regroupe les annonces"""
+
+    def __init__(self, rate, per, coalesce_window, max_lines):
+        self.rate = rate
+        self.per = per
+        self.coalesce_window = coalesce_window
+        self.max_lines = max_lines
+        # Format: {channel_id: ChannelQueue}
+        self._queues = {}
+        self._seq = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.rate_limit_failures = 0
+        self.closing = False
+
+    def send(self, channel, priority=PRIORITY_NORMAL, **kwargs):
+        """Met un message en file. Le résultat (discord.Message) peut être attendu."""
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queue(channel)
+        self._seq += 1
+        heapq.heappush(queue.heap, (priority, self._seq, channel, kwargs, future))
+        if queue.worker is None:
+            queue.worker = asyncio.create_task(self._drain(channel.id, queue))
+        return future
+
+    def announce(self, channel, kind, line, **single):
+        """Annonce automatique : envoyée tout de suite si c'est la première,
+        sinon regroupée avec les suivantes pendant COALESCE_WINDOW secondes"""
+        queue = self._queue(channel)
+        group = queue.groups.get(kind)
+        if group is None:
+            # Première annonce : on l'envoie et on ouvre une fenêtre de regroupement
+            queue.groups[kind] = []
+            self._discard(self.send(channel, PRIORITY_LOW, **single))
+            asyncio.get_running_loop().call_later(self.coalesce_window, self._flush_group, channel, kind)
+        else:
+            group.append(line)
+            if len(group) >= self.max_lines:
+                # Groupe plein (un raid de 300 arrivées) : envoyé sans attendre la fin de la fenêtre
+                queue.groups[kind] = []
+                self._send_group(channel, kind, group)
+
+    def _flush_group(self, channel, kind):
+        if self.closing:
+            return  # Déjà envoyé par close()
+        queue = self._queue(channel)
+        lines = queue.groups.pop(kind, None)
+        if not lines:
+            if not queue.heap and not queue.groups and queue.worker is None:
+                self._queues.pop(channel.id, None)
+            return
+        self._send_group(channel, kind, lines)
+        # Nouvelle fenêtre pour continuer à regrouper si ça continue d'arriver
+        queue.groups[kind] = []
+        asyncio.get_running_loop().call_later(self.coalesce_window, self._flush_group, channel, kind)
+
+    def _send_group(self, channel, kind, lines):
+        payloads = list(coalesced_payloads(kind, lines))
+        self.coalesced += len(lines) - len(payloads)
+        for payload in payloads:
+            self._discard(self.send(channel, PRIORITY_LOW, **payload))
+
+    @staticmethod
+    def _discard(future):
+        # Annonces "fire and forget" : personne n'attend le résultat, on journalise les échecs
+        future.add_done_callback(OutboundScheduler._log_failure)
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f'⚠️ Annonce non envoyée: {future.exception()}')
+
+    def _queue(self, channel):
+        queue = self._queues.get(channel.id)
+        if queue is None:
+            queue = self._queues[channel.id] = ChannelQueue(channel)
+        return queue
+
+    async def _drain(self, channel_id, queue):
+        try:
+            while queue.heap:
+                await self._take_token(queue)
+                priority, seq, channel, kwargs, future = heapq.heappop(queue.heap)
+                if future.done():
+                    continue
+                try:
+                    message = await channel.send(**kwargs)
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+                except discord.HTTPException as e:
+                    if e.status == 429:
+                        # 429 encore après les nouvelles tentatives de discord.py : on attend et on remet en tête
+                        self.rate_limit_failures += 1
+                        heapq.heappush(queue.heap, (priority, seq, channel, kwargs, future))
+                        await asyncio.sleep(getattr(e, 'retry_after', None) or self.per / self.rate)
+                        continue
+                    future.set_exception(e)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    self.sent += 1
+                    future.set_result(message)
+        finally:
+            queue.worker = None
+            if not queue.heap and not queue.groups:
+                self._queues.pop(channel_id, None)
+
+    async def close(self, timeout):
+        """Arrêt du bot : envoie les annonces en cours de regroupement et vide les files pendant
+        au plus timeout secondes, puis abandonne le reste (les futures en attente sont annulées)"""
+        self.closing = True
+        for queue in list(self._queues.values()):
+            groups, queue.groups = queue.groups, {}
+            for kind, lines in groups.items():
+                if lines:
+                    self._send_group(queue.channel, kind, lines)
+        workers = [queue.worker for queue in self._queues.values() if queue.worker is not None]
+        if workers:
+            _, pending = await asyncio.wait(workers, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        for queue in self._queues.values():
+            for *_, future in queue.heap:
+                future.cancel()
+        self._queues.clear()
+
+    async def _take_token(self, queue):
+        while True:
+            now = time.monotonic()
+            queue.tokens = min(self.rate, queue.tokens + (now - queue.updated) * self.rate / self.per)
+            queue.updated = now
+            if queue.tokens >= 1:
+                queue.tokens -= 1
+                return
+            await asyncio.sleep((1 - queue.tokens) * self.per / self.rate)
+
+    def stats(self):
+        depths = {channel_id: len(queue.heap) for channel_id, queue in self._queues.items()}
+        return {
+            'queued': sum(depths.values()),
+            'max_depth': max(depths.values(), default=0),
+            'channels': len(depths),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'rate_limit_failures': self.rate_limit_failures,
+        }
+
+
+outbound = OutboundScheduler(SEND_RATE, SEND_PER, COALESCE_WINDOW, COALESCE_MAX_LINES)
+metrics.collector('outbound_messages_sent_total', 'counter', 'Messages envoyés par le bot', lambda: outbound.sent)
+metrics.collector('outbound_coalesced_total', 'counter', 'Annonces fusionnées dans un message groupé', lambda: outbound.coalesced)
+metrics.collector('outbound_rate_limit_failures_total', 'counter',
+                  'Envois refusés en 429 même après les nouvelles tentatives de discord.py',
+                  lambda: outbound.rate_limit_failures)
+
+
+class RateLimitCounter(logging.Handler):
+    """Compte les réponses 429 de Discord : discord.py les gère lui-même (attente puis nouvel essai)
+    et ne les signale que par un avertissement du logger discord.http"""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.total = 0
+        self.global_hits = 0
+
+    def emit(self, record):
+        message = str(record.msg)
+        if 'responded with 429' in message:
+            self.total += 1
+        elif message.startswith('Global rate limit has been hit'):
+            self.global_hits += 1
+
+
+rate_limits = RateLimitCounter()
+logging.getLogger('discord.http').addHandler(rate_limits)
+metrics.collector('discord_rate_limited_total', 'counter', 'Réponses 429 de Discord (toutes requêtes du bot)', lambda: {
+    (('scope', 'bucket'),): rate_limits.total - rate_limits.global_hits,
+    (('scope', 'global'),): rate_limits.global_hits,
+})
+metrics.collector('outbound_queued', 'gauge', "Messages en file d'envoi", lambda: outbound.stats()['queued'])
+
+
+# ========== PURGE DES SALONS EN ARRIÈRE-PLAN ==========
+# !clear et !clearchannel lancent une tâche de fond : suppression groupée par 100 pour les messages
+# récents, une par une (au rythme de Discord) pour les plus vieux, avec reprise après redémarrage
+PURGE_MAX_PER_GUILD = int(os.getenv('PURGE_MAX_PER_GUILD', '1'))             # purges simultanées par serveur
+PURGE_SINGLE_DELAY = float(os.getenv('PURGE_SINGLE_DELAY', '1.2'))          # secondes entre deux suppressions unitaires
+PURGE_PROGRESS_INTERVAL = float(os.getenv('PURGE_PROGRESS_INTERVAL', '5'))  # secondes entre deux mises à jour du statut
+PURGE_BULK_SIZE = 100                                # max de Discord pour une suppression groupée
+BULK_DELETE_MAX_AGE = timedelta(days=14, minutes=-5)  # au-delà, Discord refuse la suppression groupée
+
+PURGE_PERMISSIONS = {
+    'manage_messages': "Gérer les messages",    # !clear
+    'manage_channels': "Gérer les salons",      # !clearchannel
+}
+
+class PurgeError(Exception):
+    """Purge impossible (déjà en cours, trop de purges sur le serveur, rien à reprendre...)"""
+
+
+class PurgeJob:
+    """Une purge en cours, avec son point de reprise (plus ancien message déjà traité)"""
+    __slots__ = ('guild_id', 'channel', 'status', 'remaining', 'before_id', 'deleted', 'old_deleted',
+                 'ephemeral', 'permission', 'cancelled', 'task', 'last_progress')
+
+    def __init__(self, channel, status, remaining, before_id, deleted=0, ephemeral=False,
+                 permission='manage_messages'):
+        self.guild_id = channel.guild.id
+        self.channel = channel
+        self.status = status              # message de statut édité au fil de la purge
+        self.remaining = remaining        # None = tout le salon
+        self.before_id = before_id
+        self.deleted = deleted
+        self.old_deleted = 0
+        self.ephemeral = ephemeral        # statut final effacé après quelques secondes (!clear)
+        self.permission = permission      # permission de la commande qui l'a lancée
+        self.cancelled = False
+        self.task = None
+        self.last_progress = 0.0
+
+
+class PurgeEngine:
+    """Purges en tâches de fond, limitées par serveur, sauvegardées dans purge_jobs après chaque lot"""
+
+    def __init__(self, max_per_guild):
+        self.max_per_guild = max_per_guild
+        # Format: {channel_id: PurgeJob}
+        self._jobs = {}
+
+    def running(self, guild_id):
+        return [job for job in self._jobs.values() if job.guild_id == guild_id]
+
+    async def start(self, channel, status, limit=None, before_id=None, ephemeral=False, deleted=0,
+                    permission='manage_messages', permissions=None, resuming=False):
+        """Lance une purge. permissions : celles de l'auteur de la commande dans le salon purgé
+        (None : le bot lui-même). Refuse d'écraser le point de reprise d'une purge arrêtée."""
+        if channel.id in self._jobs:
+            raise PurgeError(f"Une purge est déjà en cours dans {channel.mention}")
+        if len(self.running(channel.guild.id)) >= self.max_per_guild:
+            raise PurgeError("Trop de purges en cours sur ce serveur, réessaie plus tard")
+        self.check_permission(permission, permissions)
+        if not channel.permissions_for(channel.guild.me).manage_messages:
+            raise PurgeError(f"Il me faut la permission « Gérer les messages » dans {channel.mention}")
+        job = PurgeJob(channel, status, limit, before_id or status.id, deleted, ephemeral, permission)
+        # Réservé avant les requêtes pour refuser une 2e purge du salon pendant l'attente
+        self._jobs[channel.id] = job
+        try:
+            if not resuming:
+                async with db_pool.acquire() as conn:
+                    paused = await conn.fetchval(
+                        "SELECT 1 FROM purge_jobs WHERE channel_id = $1 AND state = 'paused'", channel.id
+                    )
+                if paused:
+                    raise PurgeError(f"Une purge arrêtée attend dans {channel.mention} : `!purge resume` pour la "
+                                     f"reprendre, ou `!purge cancel` pour l'oublier")
+            await self._save(job, 'running')
+        except BaseException:
+            self._jobs.pop(channel.id, None)
+            raise
+        job.task = asyncio.create_task(self._run(job))
+        return job
+
+    @staticmethod
+    def check_permission(permission, permissions):
+        """Seul qui pourrait lancer la purge peut l'arrêter ou la reprendre (permissions=None : le bot lui-même)"""
+        if permissions is not None and not getattr(permissions, permission):
+            raise PurgeError(f"Il faut la permission « {PURGE_PERMISSIONS[permission]} » pour cette purge")
+
+    async def forget(self, channel_id, permissions=None):
+        """Oublie le point de reprise d'une purge arrêtée. Retourne False s'il n'y en avait pas."""
+        async with db_pool.acquire() as conn:
+            permission = await conn.fetchval(
+                "SELECT permission FROM purge_jobs WHERE channel_id = $1 AND state = 'paused'", channel_id
+            )
+            if permission is None:
+                return False
+            self.check_permission(permission, permissions)
+            await conn.execute("DELETE FROM purge_jobs WHERE channel_id = $1 AND state = 'paused'", channel_id)
+        return True
+
+    async def cancel(self, channel_id, permissions=None):
+        """Arrête une purge en gardant son point de reprise"""
+        job = self._jobs.get(channel_id)
+        if job is None:
+            return None
+        self.check_permission(job.permission, permissions)
+        job.cancelled = True
+        job.task.cancel()
+        await asyncio.gather(job.task, return_exceptions=True)
+        if self._jobs.get(channel_id) is job:
+            # Annulée avant son premier lot : _run n'a pas pu la retirer ni la mettre en pause
+            self._jobs.pop(channel_id)
+            await self._save(job, 'paused')
+        return job
+
+    async def resume(self, channel, status, permissions=None):
+        """Reprend une purge arrêtée (!purge cancel ou erreur) depuis son dernier point de reprise"""
+        async with db_pool.acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT * FROM purge_jobs WHERE channel_id = $1 AND state = 'paused'", channel.id
+            )
+        if row is None:
+            raise PurgeError(f"Aucune purge à reprendre dans {channel.mention}")
+        return await self.start(channel, status, row['remaining'], row['before_id'], row['ephemeral'], row['deleted'],
+                                row['permission'], permissions, resuming=True)
+
+    async def paused(self, guild_id):
+        async with db_pool.acquire() as conn:
+            return await conn.fetch(
+                "SELECT channel_id, deleted, remaining FROM purge_jobs WHERE guild_id = $1 AND state = 'paused'",
+                guild_id
+            )
+
+    async def resume_all(self):
+        """Au démarrage : relance les purges interrompues par un arrêt du bot"""
+        async with db_pool.acquire() as conn:
+            rows = await conn.fetch("SELECT * FROM purge_jobs WHERE state = 'running'")
+        for row in rows:
+            channel = bot.get_channel(row['channel_id'])
+            status_channel = bot.get_channel(row['status_channel_id'])
+            if channel is None or status_channel is None:
+                continue
+            status = status_channel.get_partial_message(row['status_message_id'])
+            try:
+                await self.start(channel, status, row['remaining'], row['before_id'], row['ephemeral'], row['deleted'],
+                                 row['permission'], resuming=True)
+            except PurgeError:
+                continue  # Limite par serveur atteinte ou permission perdue : elle restera à reprendre à la main
+        if rows:
+            print(f'🧹 {len(self._jobs)} purge(s) reprise(s)')
+
+    async def stop(self):
+        """Arrêt du bot : les purges s'interrompent et reprendront au prochain démarrage"""
+        tasks = [job.task for job in self._jobs.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, job):
+        channel = job.channel
+        state = 'running'
+        try:
+            while job.remaining is None or job.remaining > 0:
+                limit = PURGE_BULK_SIZE if job.remaining is None else min(PURGE_BULK_SIZE, job.remaining)
+                messages = [m async for m in channel.history(limit=limit, before=discord.Object(job.before_id))]
+                if not messages:
+                    break
+                # L'historique va du plus récent au plus ancien : les vieux messages sont en fin de lot
+                cutoff = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+                recent = [m for m in messages if m.created_at > cutoff]
+                old = messages[len(recent):]
+                if len(recent) > 1:
+                    await channel.delete_messages(recent)
+                elif recent:
+                    await recent[0].delete()
+                if recent:
+                    self._advance(job, recent[-1].id, len(recent))
+                for message in old:
+                    try:
+                        await message.delete()
+                    except discord.NotFound:
+                        pass
+                    self._advance(job, message.id, 1)
+                    job.old_deleted += 1
+                    await self._progress(job)
+                    await asyncio.sleep(PURGE_SINGLE_DELAY)
+                await self._save(job, 'running')
+                await self._progress(job)
+            state = 'done'
+            await self._finish(job, f"✅ {job.deleted:,} message(s) supprimé(s) dans {channel.mention}")
+        except asyncio.CancelledError:
+            if job.cancelled:
+                state = 'paused'
+                await self._finish(job, f"⏸️ Purge arrêtée après {job.deleted:,} message(s) "
+                                        f"(`!purge resume {channel.mention}` pour reprendre)")
+            # Sinon arrêt du bot : reste 'running' et reprendra au démarrage depuis ce point
+        except discord.HTTPException as e:
+            state = 'paused'
+            await self._finish(job, f"❌ Purge interrompue après {job.deleted:,} message(s) : {e} "
+                                    f"(`!purge resume {channel.mention}` pour reprendre)")
+        finally:
+            self._jobs.pop(channel.id, None)
+            # Personne n'attend cette tâche : une erreur ici ne doit pas remonter
+            try:
+                await asyncio.shield(self._save(job, state))
+            except Exception as e:
+                print(f'❌ Impossible de sauvegarder la purge de #{channel}: {e}')
+
+    def _advance(self, job, message_id, count):
+        """Déplace le point de reprise après des messages supprimés"""
+        job.before_id = message_id
+        job.deleted += count
+        if job.remaining is not None:
+            job.remaining -= count
+
+    async def _progress(self, job):
+        now = time.monotonic()
+        if now - job.last_progress < PURGE_PROGRESS_INTERVAL:
+            return
+        job.last_progress = now
+        text = f"🧹 Purge de {job.channel.mention} : {job.deleted:,} message(s) supprimé(s)"
+        if job.old_deleted:
+            text += f", dont {job.old_deleted:,} de plus de 14 jours (un par un)"
+        try:
+            await job.status.edit(content=text + "… `!purge cancel` pour arrêter")
+        except discord.HTTPException:
+            pass
+
+    async def _finish(self, job, text):
+        try:
+            await job.status.edit(content=text, delete_after=3 if job.ephemeral else None)
+        except discord.HTTPException:
+            pass
+
+    async def _save(self, job, state):
+        async with db_pool.acquire() as conn:
+            if state == 'done':
+                await conn.execute('DELETE FROM purge_jobs WHERE channel_id = $1', job.channel.id)
+                return
+            await conn.execute('''
+                INSERT INTO purge_jobs (channel_id, guild_id, status_channel_id, status_message_id,
+                                        remaining, before_id, deleted, ephemeral, state, permission)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+                ON CONFLICT (channel_id) DO UPDATE SET
+                    status_channel_id = EXCLUDED.status_channel_id,
+                    status_message_id = EXCLUDED.status_message_id,
+                    remaining = EXCLUDED.remaining, before_id = EXCLUDED.before_id,
+                    deleted = EXCLUDED.deleted, ephemeral = EXCLUDED.ephemeral,
+                    state = EXCLUDED.state, permission = EXCLUDED.permission, updated_at = CURRENT_TIMESTAMP
+            ''', job.channel.id, job.guild_id, job.status.channel.id, job.status.id,
+                job.remaining, job.before_id, job.deleted, job.ephemeral, state, job.permission)
+
+
+async def clone_and_replace(channel, reason):
+    """Option rapide de !clearchannel : recrée le salon à l'identique (permissions, sujet...)
+    à la même place et supprime l'ancien, au lieu d'effacer les messages un par un"""
+    new_channel = await channel.clone(reason=reason)
+    await new_channel.edit(position=channel.position)
+    await channel.delete(reason=reason)
+    return new_channel
+
+
+purge_engine = PurgeEngine(PURGE_MAX_PER_GUILD)
+
+
+# ========== INDEX DES BANNIS ==========
+BANLIST_PAGE_SIZE = 20          # bannis affichés par page de !banlist
+BANLIST_TIMEOUT = 180           # secondes avant de désactiver les boutons de !banlist
+
+
+def ban_name_keys(user):
+    """Clés de recherche d'un utilisateur banni : pseudo, nom global et ancien nom#1234"""
+    keys = {user.name.casefold()}
+    if user.global_name:
+        keys.add(user.global_name.casefold())
+    if user.discriminator not in ('0', '0000'):
+        keys.add(f"{user.name}#{user.discriminator}".casefold())
+    return keys
+
+
+class GuildBans:
+    """Bannis d'un serveur, indexés par id et par nom"""
+    __slots__ = ('users', 'names')
+
+    def __init__(self):
+        # Format: {user_id: (utilisateur, raison)}
+        self.users = {}
+        # Format: {nom en minuscules: {user_ids}} (plusieurs comptes peuvent avoir le même nom global)
+        self.names = {}
+
+    def add(self, user, reason=None):
+        self.remove(user.id)
+        self.users[user.id] = (user, reason)
+        for key in ban_name_keys(user):
+            self.names.setdefault(key, set()).add(user.id)
+
+    def remove(self, user_id):
+        entry = self.users.pop(user_id, None)
+        if entry is None:
+            return
+        for key in ban_name_keys(entry[0]):
+            ids = self.names.get(key)
+            if ids is not None:
+                ids.discard(user_id)
+                if not ids:
+                    del self.names[key]
+
+    def find(self, query):
+        """Utilisateurs bannis correspondant à un id, une mention ou un nom"""
+        query = query.strip()
+        digits = query.strip('<@!>')
+        if digits.isdigit():
+            entry = self.users.get(int(digits))
+            if entry is not None:
+                return [entry[0]]
+        return [self.users[user_id][0] for user_id in self.names.get(query.casefold(), ())]
+
+    def sorted_entries(self):
+        return sorted(self.users.values(), key=lambda entry: entry[0].name.casefold())
+
+
+class BanIndex:
+    """Cache des bannis par serveur : chargé une fois à la première demande,
+    puis tenu à jour par on_member_ban / on_member_unban"""
+
+    def __init__(self):
+        # Format: {guild_id: GuildBans}
+        self._guilds = {}
+        # Chargements en cours. Format: {guild_id: Task}
+        self._loading = {}
+        # Événements reçus pendant un chargement, rejoués à la fin. Format: {guild_id: [(user, banni)]}
+        self._pending = {}
+
+    def __len__(self):
+        return sum(len(bans.users) for bans in self._guilds.values())
+
+    async def get(self, guild):
+        """Bannis du serveur (un seul parcours de guild.bans() même si plusieurs commandes attendent)"""
+        bans = self._guilds.get(guild.id)
+        if bans is not None:
+            return bans
+        task = self._loading.get(guild.id)
+        if task is None:
+            self._pending[guild.id] = []
+            task = asyncio.create_task(self._load(guild))
+            self._loading[guild.id] = task
+        return await asyncio.shield(task)
+
+    async def _load(self, guild):
+        try:
+            bans = GuildBans()
+            async for ban_entry in guild.bans(limit=None):
+                bans.add(ban_entry.user, ban_entry.reason)
+            for user, banned in self._pending[guild.id]:
+                if banned:
+                    bans.add(user)
+                else:
+                    bans.remove(user.id)
+            self._guilds[guild.id] = bans
+            return bans
+        finally:
+            del self._pending[guild.id]
+            del self._loading[guild.id]
+
+    def banned(self, guild, user):
+        self._apply(guild.id, user, True)
+
+    def unbanned(self, guild, user):
+        self._apply(guild.id, user, False)
+
+    def _apply(self, guild_id, user, banned):
+        pending = self._pending.get(guild_id)
+        if pending is not None:
+            pending.append((user, banned))
+        bans = self._guilds.get(guild_id)
+        if bans is None:
+            # Pas encore chargé : guild.bans() donnera l'état à jour
+            return
+        if banned:
+            bans.add(user)
+        else:
+            bans.remove(user.id)
+
+    def forget(self, guild_id):
+        self._guilds.pop(guild_id, None)
+
+
+class BanListView(discord.ui.View):
+    """Pages de !banlist, navigables avec des boutons par l'auteur de la commande"""
+
+    def __init__(self, author_id, entries, total):
+        super().__init__(timeout=BANLIST_TIMEOUT)
+        self.author_id = author_id
+        self.entries = entries
+        self.total = total
+        self.page = 0
+        self.pages = max(1, -(-len(entries) // BANLIST_PAGE_SIZE))
+        self.message = None
+        self._update_buttons()
+
+    def embed(self):
+        start = self.page * BANLIST_PAGE_SIZE
+        lines = []
+        for user, reason in self.entries[start:start + BANLIST_PAGE_SIZE]:
+            line = f"**{discord.utils.escape_markdown(user.name)}** (`{user.id}`)"
+            if reason:
+                line += f" - {discord.utils.escape_markdown(reason[:80])}"
+            lines.append(line)
+        embed = discord.Embed(
+            title=f"Liste des bannis ({self.total:,})",
+            description="\n".join(lines),
+            color=discord.Color.red()
+        )
+        embed.set_footer(text=f"Page {self.page + 1}/{self.pages}")
+        return embed
+
+    def _update_buttons(self):
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= self.pages - 1
+
+    async def interaction_check(self, interaction):
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message("Lance ton propre `!banlist` 😉", ephemeral=True)
+            return False
+        return True
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        self.page -= 1
+        self._update_buttons()
+        await interaction.response.edit_message(embed=self.embed(), view=self)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        self.page += 1
+        self._update_buttons()
+        await interaction.response.edit_message(embed=self.embed(), view=self)
+
+    async def on_timeout(self):
+        if self.message is None:
+            return
+        for child in self.children:
+            child.disabled = True
+        try:
+            await self.message.edit(view=self)
+        except discord.HTTPException:
+            pass
+
+
+ban_index = BanIndex()
+
+
+# ========== ARRIVÉES DES MEMBRES ==========
+# Les bienvenues passent par outbound.announce (regroupées), les rôles par une file cadencée par serveur
+WELCOME_CHANNEL_NAME = 'arrivage'
+WELCOME_ROLE_NAME = 'LES BG'
+ROLE_GRANT_INTERVAL = float(os.getenv('ROLE_GRANT_INTERVAL', '0.5'))  # secondes entre deux attributions de rôle par serveur
+ROLE_GRANT_RETRIES = int(os.getenv('ROLE_GRANT_RETRIES', '3'))         # nouvelles tentatives après une erreur Discord
+JOIN_BURST_WINDOW = float(os.getenv('JOIN_BURST_WINDOW', '60'))        # fenêtre glissante de détection des vagues d'arrivées
+JOIN_BURST_THRESHOLD = int(os.getenv('JOIN_BURST_THRESHOLD', '20'))    # arrivées dans la fenêtre pour signaler une vague
+
+
+class RoleGrantQueue:
+    """Attribution du rôle d'arrivée : une file par serveur, cadencée, sans doublons,
+    avec nouvelles tentatives si Discord répond par une erreur"""
+
+    def __init__(self, interval, retries):
+        self.interval = interval
+        self.retries = retries
+        # Format: {guild_id: deque[(membre, rôle, tentative)]}
+        self._queues = {}
+        # Format: {guild_id: Task}
+        self._workers = {}
+        # Membres en attente, pour ne pas les mettre deux fois en file. Format: {(guild_id, user_id)}
+        self._pending = set()
+        self.granted = 0
+        self.retried = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def grant(self, member, role):
+        """Met le membre en file. False s'il y est déjà ou a déjà le rôle."""
+        key = (member.guild.id, member.id)
+        if key in self._pending or role in member.roles:
+            return False
+        self._pending.add(key)
+        self._queues.setdefault(member.guild.id, deque()).append((member, role, 0))
+        if member.guild.id not in self._workers:
+            self._workers[member.guild.id] = asyncio.create_task(self._drain(member.guild.id))
+        return True
+
+    async def _drain(self, guild_id):
+        queue = self._queues[guild_id]
+        try:
+            while queue:
+                member, role, attempt = queue.popleft()
+                key = (guild_id, member.id)
+                if member.guild.get_member(member.id) is None:
+                    # Reparti avant son tour (fréquent pendant un raid)
+                    self._pending.discard(key)
+                    continue
+                try:
+                    await member.add_roles(role, reason="Arrivée sur le serveur")
+                except (discord.NotFound, discord.Forbidden):
+                    # Membre ou rôle disparu, ou rôle au-dessus de celui du bot : inutile de réessayer
+                    self.failed += 1
+                    self._pending.discard(key)
+                except discord.HTTPException as e:
+                    if attempt < self.retries:
+                        self.retried += 1
+                        queue.append((member, role, attempt + 1))
+                        await asyncio.sleep(getattr(e, 'retry_after', None) or self.interval * 2 ** (attempt + 1))
+                        continue
+                    self.failed += 1
+                    self._pending.discard(key)
+                    print(f"❌ Rôle {role.name} non donné à {member} après {attempt + 1} essais: {e}")
+                else:
+                    self.granted += 1
+                    self._pending.discard(key)
+                await asyncio.sleep(self.interval)
+        finally:
+            del self._workers[guild_id]
+            del self._queues[guild_id]
+            # Arrêté en cours de route : ces membres n'auront pas le rôle cette fois-ci
+            for member, role, attempt in queue:
+                self._pending.discard((guild_id, member.id))
+
+    async def stop(self):
+        workers = list(self._workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+class JoinBurstMonitor:
+    """Arrivées récentes par serveur (fenêtre glissante) : signale le début et la fin d'une vague"""
+
+    def __init__(self, window, threshold):
+        self.window = window
+        self.threshold = threshold
+        # Format: {guild_id: deque[instant d'arrivée]}
+        self._joins = {}
+        # Serveurs en pleine vague d'arrivées
+        self.bursting = set()
+        self.bursts = 0
+
+    def record(self, guild_id):
+        """Note une arrivée. True si elle déclenche une nouvelle vague."""
+        joins = self._joins.setdefault(guild_id, deque())
+        joins.append(time.monotonic())
+        count = self.count(guild_id)
+        if count >= self.threshold and guild_id not in self.bursting:
+            self.bursting.add(guild_id)
+            self.bursts += 1
+            return True
+        return False
+
+    def count(self, guild_id):
+        """Arrivées dans la fenêtre. La vague se termine quand on repasse sous la moitié du seuil."""
+        joins = self._joins.get(guild_id)
+        if joins is None:
+            return 0
+        limit = time.monotonic() - self.window
+        while joins and joins[0] < limit:
+            joins.popleft()
+        if not joins:
+            del self._joins[guild_id]
+        if len(joins) < self.threshold / 2:
+            self.bursting.discard(guild_id)
+        return len(joins)
+
+    def active(self):
+        """Nombre de serveurs en pleine vague (les vagues terminées sont retirées au passage)"""
+        for guild_id in list(self.bursting):
+            self.count(guild_id)
+        return len(self.bursting)
+
+
+role_grants = RoleGrantQueue(ROLE_GRANT_INTERVAL, ROLE_GRANT_RETRIES)
+join_monitor = JoinBurstMonitor(JOIN_BURST_WINDOW, JOIN_BURST_THRESHOLD)
+metrics.describe('member_joins_total', 'counter', 'Arrivées de membres')
+metrics.collector('join_bursts_total', 'counter', "Vagues d'arrivées détectées", lambda: join_monitor.bursts)
+metrics.collector('join_burst_active', 'gauge', "Serveurs en pleine vague d'arrivées", join_monitor.active)
+metrics.collector('role_grants_queued', 'gauge', "Rôles d'arrivée en attente", lambda: len(role_grants))
+metrics.collector('role_grants_total', 'counter', "Rôles d'arrivée traités", lambda: {
+    (('status', 'ok'),): role_grants.granted,
+    (('status', 'retry'),): role_grants.retried,
+    (('status', 'failed'),): role_grants.failed,
+})
+
+
+intents = discord.Intents.default()
+intents.message_content = True
+intents.members = True
+intents.presences = True  # Nécessaire pour détecter les activités
+
+groq_client = Groq(api_key=os.getenv('GROQ_API_KEY'))
+
+
+# ========== CLIENT IA ASYNCHRONE ==========
+# Le client Groq est synchrone : on l'exécute dans des threads dédiés pour ne jamais bloquer la boucle
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '4'))   # requêtes Groq simultanées max
+LLM_MAX_QUEUE = int(os.getenv('LLM_MAX_QUEUE', '20'))              # requêtes en attente max avant "occupé"
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '30'))                # secondes max par requête
+
+class LLMBusyError(Exception):
+    """Trop de requêtes IA en attente"""
+
+
+class AsyncLLM:
+    """Enveloppe asynchrone du client Groq avec limite de concurrence, file bornée et timeout"""
+
+    def __init__(self, client, max_concurrency, max_queue, timeout):
+        self.client = client
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='groq')
+        # Format: {message_id: asyncio.Task} pour annuler si le message d'origine disparaît
+        self._tasks_by_message = {}
+        self.waiting = 0
+        self.in_flight = 0
+
+    async def complete(self, messages, model="llama-3.1-8b-instant", max_tokens=1000,
+                       temperature=0.7, message_id=None, **kwargs):
+        """Appelle Groq sans bloquer la boucle. Lève LLMBusyError ou asyncio.TimeoutError."""
+        if self.waiting >= self.max_queue:
+            raise LLMBusyError()
+
+        task = self._track(message_id)
+        try:
+            await self._acquire()
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._executor, partial(
+                self.client.chat.completions.create,
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                timeout=self.timeout,
+                **kwargs
+            ))
+            # La place n'est libérée que quand le thread a vraiment fini,
+            # même si on arrête d'attendre (timeout ou annulation)
+            future.add_done_callback(self._release)
+            start = time.perf_counter()
+            status = 'error'
+            try:
+                response = await asyncio.wait_for(asyncio.shield(future), timeout=self.timeout)
+                status = 'ok'
+            except asyncio.TimeoutError:
+                status = 'timeout'
+                raise
+            except asyncio.CancelledError:
+                status = 'cancelled'
+                raise
+            finally:
+                metrics.observe('llm_request_seconds', time.perf_counter() - start,
+                                model=model, mode='complete', status=status)
+            record_llm_usage(model, getattr(response, 'usage', None))
+            return response
+        finally:
+            self._untrack(message_id, task)
+
+    async def stream(self, messages, model="llama-3.1-8b-instant", max_tokens=1000,
+                     temperature=0.7, message_id=None):
+        """Comme complete() mais renvoie le texte morceau par morceau (API streaming de Groq).
+        Le timeout s'applique entre deux morceaux."""
+        if self.waiting >= self.max_queue:
+            raise LLMBusyError()
+
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        stop = threading.Event()
+        # Consommation de tokens envoyée par Groq dans le dernier morceau
+        usage = []
+
+        def push(item):
+            try:
+                loop.call_soon_threadsafe(chunks.put_nowait, item)
+            except RuntimeError:
+                pass  # La boucle est fermée (arrêt du bot)
+
+        def worker():
+            # Tourne dans un thread : lit le flux Groq et transmet les morceaux à la boucle
+            try:
+                response = self.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    timeout=self.timeout,
+                    stream=True
+                )
+                try:
+                    for chunk in response:
+                        if stop.is_set():
+                            break
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            push(chunk.choices[0].delta.content)
+                        x_groq = getattr(chunk, 'x_groq', None)
+                        if x_groq is not None and getattr(x_groq, 'usage', None) is not None:
+                            usage.append(x_groq.usage)
+                finally:
+                    response.close()
+            except Exception as e:
+                push(e)
+            finally:
+                push(None)
+
+        task = self._track(message_id)
+        try:
+            await self._acquire()
+            future = loop.run_in_executor(self._executor, worker)
+            future.add_done_callback(self._release)
+            start = time.perf_counter()
+            first = True
+            status = 'error'
+            try:
+                while True:
+                    item = await asyncio.wait_for(chunks.get(), timeout=self.timeout)
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    if first:
+                        first = False
+                        metrics.observe('llm_first_token_seconds', time.perf_counter() - start, model=model)
+                    yield item
+                status = 'ok'
+            except asyncio.TimeoutError:
+                status = 'timeout'
+                raise
+            except (asyncio.CancelledError, GeneratorExit):
+                status = 'cancelled'
+                raise
+            finally:
+                metrics.observe('llm_request_seconds', time.perf_counter() - start,
+                                model=model, mode='stream', status=status)
+            record_llm_usage(model, usage[-1] if usage else None)
+        finally:
+            # Prévenir le thread qu'on n'écoute plus (annulation, timeout...)
+            stop.set()
+            self._untrack(message_id, task)
+
+    def _track(self, message_id):
+        task = asyncio.current_task()
+        if message_id is not None:
+            self._tasks_by_message[message_id] = task
+        return task
+
+    def _untrack(self, message_id, task):
+        if message_id is not None and self._tasks_by_message.get(message_id) is task:
+            del self._tasks_by_message[message_id]
+
+    async def _acquire(self):
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        metrics.observe('llm_queue_wait_seconds', time.perf_counter() - start)
+        self.in_flight += 1
+
+    def _release(self, future):
+        self.in_flight -= 1
+        self._semaphore.release()
+        if not future.cancelled():
+            # Évite l'avertissement "exception was never retrieved"
+            future.exception()
+
+    def cancel_for_message(self, message_id):
+        """Annule la requête liée à un message supprimé"""
+        task = self._tasks_by_message.pop(message_id, None)
+        if task is not None:
+            task.cancel()
+
+
+def record_llm_usage(model, usage):
+    if usage is not None:
+        metrics.inc('llm_tokens_total', usage.prompt_tokens or 0, model=model, kind='prompt')
+        metrics.inc('llm_tokens_total', usage.completion_tokens or 0, model=model, kind='completion')
+
+
+llm_client = AsyncLLM(groq_client, LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE, LLM_TIMEOUT)
+metrics.describe('llm_queue_wait_seconds', 'histogram', "Attente d'une place libre pour appeler Groq")
+metrics.collector('llm_requests_waiting', 'gauge', 'Requêtes IA en attente', lambda: llm_client.waiting)
+metrics.collector('llm_requests_in_flight', 'gauge', 'Requêtes IA en cours', lambda: llm_client.in_flight)
+
+
+# ========== RÉPONSES EN STREAMING ==========
+ASK_STREAMING = os.getenv('ASK_STREAMING', 'true').lower() in ('1', 'true', 'yes', 'oui')
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.2'))   # secondes min entre deux edits
+
+def split_message(text, limit=DISCORD_MAX_LENGTH):
+    """Coupe un texte trop long pour Discord, de préférence sur un retour à la ligne ou un espace.
+    Retourne (début, reste)."""
+    if len(text) <= limit:
+        return text, ""
+    cut = text.rfind('\n', limit // 2, limit)
+    if cut == -1:
+        cut = text.rfind(' ', limit // 2, limit)
+    if cut == -1:
+        cut = limit
+    return text[:cut], text[cut:].lstrip()
+
+
+class StreamingReply:
+    """Affiche une réponse au fur et à mesure en éditant un message, avec des edits regroupés
+    pour rester sous les limites de Discord et un nouveau message tous les 2000 caractères"""
+
+    def __init__(self, channel, edit_interval=STREAM_EDIT_INTERVAL):
+        self.channel = channel
+        self.edit_interval = edit_interval
+        self.message = None
+        self.current = ""       # texte du message en cours d'édition
+        self.shown = ""         # dernier texte réellement affiché
+        self.last_edit = 0.0
+
+    async def start(self):
+        self.message = await self.channel.send("💭 ...")
+        self.last_edit = time.monotonic()
+
+    async def feed(self, text):
+        self.current += text
+        # Message plein : on le fige, la suite partira dans un nouveau message dès qu'elle aura du texte
+        while len(self.current) > DISCORD_MAX_LENGTH:
+            head, self.current = split_message(self.current)
+            await self._edit(head)
+            self.message = None
+            self.shown = ""
+        if self.current.strip() and time.monotonic() - self.last_edit >= self.edit_interval:
+            await self._edit(self.current + " ▌")
+
+    async def finish(self):
+        if self.message is None and not self.current.strip():
+            return  # Coupure tombée pile à la fin : la réponse est déjà complète
+        await self._edit(self.current.strip() or "🤷")
+
+    async def fail(self, text):
+        await self._edit(f"{self.current}\n\n{text}" if self.current else text)
+
+    async def _edit(self, text):
+        if text == self.shown:
+            return
+        if self.message is None:
+            self.message = await self.channel.send(text[:DISCORD_MAX_LENGTH])
+        else:
+            await self.message.edit(content=text[:DISCORD_MAX_LENGTH])
+        self.shown = text
+        self.last_edit = time.monotonic()
+
+
+async def stream_answer(ctx, messages):
+    """Envoie la réponse de l'IA en streaming dans le salon. Retourne le texte complet,
+    ou None si l'IA n'a pas pu répondre (l'erreur est déjà affichée)."""
+    reply = StreamingReply(ctx.channel)
+    await reply.start()
+    parts = []
+    try:
+        # aclosing : si l'envoi sur Discord échoue ou est annulé, le flux est fermé tout de suite
+        # (le thread arrête de lire Groq et libère sa place)
+        async with aclosing(llm_client.stream(messages, message_id=ctx.message.id)) as stream:
+            async for text in stream:
+                parts.append(text)
+                await reply.feed(text)
+    except (LLMBusyError, asyncio.TimeoutError) as e:
+        await reply.fail(llm_error_message(e))
+        return None
+    except asyncio.CancelledError:
+        await reply.fail("🚫 Question supprimée, j'arrête là.")
+        raise
+    except Exception as e:
+        # Erreur de l'API Groq (clé, quota, réseau...) : le message ne doit pas rester bloqué sur "💭 ..."
+        print(f'⚠️ Réponse en streaming interrompue: {e}')
+        await reply.fail(llm_error_message(e))
+        return None
+    await reply.finish()
+    return "".join(parts).strip()
+
+
+def llm_error_message(error):
+    """Message à afficher quand l'IA ne peut pas répondre"""
+    if isinstance(error, LLMBusyError):
+        return "🚦 L'IA est débordée là, réessaie dans un instant!"
+    if isinstance(error, asyncio.TimeoutError):
+        return "⏱️ L'IA met trop de temps à répondre, réessaie plus tard!"
+    return "❌ L'IA a planté, réessaie plus tard!"
+
+
+# ========== RÉSERVE DE BLAGUES ==========
+# Les blagues sont générées à l'avance par lots : !joke répond instantanément
+JOKE_POOL_SIZE = int(os.getenv('JOKE_POOL_SIZE', '20'))            # blagues gardées en réserve
+JOKE_POOL_LOW_WATER = int(os.getenv('JOKE_POOL_LOW_WATER', '5'))   # recharge sous ce seuil
+JOKE_BATCH_SIZE = int(os.getenv('JOKE_BATCH_SIZE', '5'))           # blagues demandées par appel IA
+JOKE_RECENT_MEMORY = int(os.getenv('JOKE_RECENT_MEMORY', '200'))   # blagues récentes à ne pas resservir
+JOKE_REFILL_RETRIES = int(os.getenv('JOKE_REFILL_RETRIES', '3'))   # lots ratés d'affilée avant d'abandonner
+JOKE_REFILL_BACKOFF = float(os.getenv('JOKE_REFILL_BACKOFF', '2'))  # secondes d'attente, doublées à chaque échec
+
+JOKE_SYSTEM_PROMPT = "Tu es une assistante sur Discord. Réponds de manière drôle et décontractée avec un air jeune."
+JOKE_SEPARATOR = "---"
+
+def joke_key(text):
+    """Forme normalisée d'une blague pour repérer les doublons"""
+    return "".join(c for c in text.lower() if c.isalnum())[:120]
+
+
+class JokePool:
+    """File bornée de blagues pré-générées, rechargée en arrière-plan"""
+
+    def __init__(self, size, low_water, batch_size, recent_memory):
+        self.size = size
+        self.low_water = low_water
+        self.batch_size = batch_size
+        self.jokes = deque()
+        self._pool_keys = set()
+        self._recent = deque(maxlen=recent_memory)
+        self._recent_keys = set()
+        self._refill_task = None
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, message_id=None):
+        """Retourne une blague de la réserve, ou en génère une en direct si elle est vide"""
+        if self.jokes:
+            joke_text = self.jokes.popleft()
+            self._pool_keys.discard(joke_key(joke_text))
+            self.hits += 1
+        else:
+            self.misses += 1
+            response = await llm_client.complete([
+                {"role": "system", "content": JOKE_SYSTEM_PROMPT},
+                {"role": "user", "content": "Raconte-moi une blague."}
+            ], message_id=message_id)
+            joke_text = response.choices[0].message.content.strip()
+        self._remember(joke_text)
+        if len(self.jokes) < self.low_water:
+            self.refill()
+        return joke_text
+
+    def refill(self):
+        """Lance la recharge en arrière-plan (une seule à la fois)"""
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._refill())
+
+    async def _refill(self):
+        failures = 0
+        while len(self.jokes) < self.size:
+            if failures:
+                # Lot raté : on patiente de plus en plus avant de redemander
+                if failures > JOKE_REFILL_RETRIES:
+                    return  # On réessaiera au prochain !joke
+                await asyncio.sleep(JOKE_REFILL_BACKOFF * 2 ** (failures - 1))
+            try:
+                new_jokes = await self._generate_batch()
+            except Exception as e:
+                # IA occupée ou en panne
+                print(f'⚠️ Recharge des blagues impossible: {e}')
+                failures += 1
+                continue
+            added = 0
+            for joke_text in new_jokes:
+                key = joke_key(joke_text)
+                if not key or key in self._pool_keys or key in self._recent_keys:
+                    continue
+                if len(self.jokes) >= self.size:
+                    break
+                self.jokes.append(joke_text)
+                self._pool_keys.add(key)
+                added += 1
+            # Que des doublons : compte comme un échec
+            failures = 0 if added else failures + 1
+
+    async def _generate_batch(self):
+        response = await llm_client.complete([
+            {"role": "system", "content": JOKE_SYSTEM_PROMPT},
+            {"role": "user", "content": (
+                f"Raconte-moi {self.batch_size} blagues différentes et courtes. "
+                f"Sépare chaque blague par une ligne contenant uniquement {JOKE_SEPARATOR}, sans numéroter."
+            )}
+        ], temperature=1.0)
+        text = response.choices[0].message.content
+        return [part.strip() for part in text.split(JOKE_SEPARATOR) if part.strip()]
+
+    def _remember(self, joke_text):
+        # Garder les N dernières blagues servies pour ne pas les resservir
+        if len(self._recent) == self._recent.maxlen:
+            self._recent_keys.discard(joke_key(self._recent[0]))
+        self._recent.append(joke_text)
+        self._recent_keys.add(joke_key(joke_text))
+
+    def stats(self):
+        return {
+            'available': len(self.jokes),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+joke_pool = JokePool(JOKE_POOL_SIZE, JOKE_POOL_LOW_WATER, JOKE_BATCH_SIZE, JOKE_RECENT_MEMORY)
+
+
+# ========== CACHE DES RÉPONSES !ask ==========
+# Désactivé par défaut : les questions identiques (sans contexte ou avec un contexte court) partagent la réponse
+ASK_CACHE_ENABLED = os.getenv('ASK_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes', 'oui')
+ASK_CACHE_TTL = float(os.getenv('ASK_CACHE_TTL', '3600'))                 # secondes avant expiration
+ASK_CACHE_SIZE = int(os.getenv('ASK_CACHE_SIZE', '500'))                  # réponses gardées max
+ASK_CACHE_MAX_CONTEXT = int(os.getenv('ASK_CACHE_MAX_CONTEXT', '200'))    # tokens de contexte max pour être cachable
+
+def normalize_text(text):
+    """Minuscules, sans accents, sans ponctuation ni espaces multiples"""
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = "".join(c if c.isalnum() else " " for c in text if not unicodedata.combining(c))
+    return " ".join(text.split())
+
+
+class AnswerUnavailable(Exception):
+    """La même question, posée juste avant par quelqu'un d'autre, n'a pas eu de réponse"""
+
+
+class AnswerCache:
+    """Cache LRU avec expiration des réponses de l'IA, qui regroupe aussi les questions identiques
+    posées en même temps en un seul appel"""
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        # Format: {clé: (réponse, expiration, durée de génération)}
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def key_for(question, context_fingerprint):
+        return f"{context_fingerprint}:{normalize_text(question)}"
+
+    async def fetch(self, key, compute):
+        """Retourne (réponse, vient_du_cache). `compute` est appelé seulement si besoin."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            answer, expires_at, latency = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.saved_seconds += latency
+                return answer, True
+            del self._entries[key]
+
+        while True:
+            pending = self._inflight.get(key)
+            if pending is None:
+                break
+            # La même question est déjà en cours : on attend sa réponse (AnswerUnavailable si elle échoue)
+            started = time.monotonic()
+            answer = await asyncio.shield(pending)
+            if answer is not None:
+                self.coalesced += 1
+                self.saved_seconds += max(self._latency(key) - (time.monotonic() - started), 0)
+                return answer, True
+            # Question d'origine supprimée : le premier réveillé la repose, les suivants l'attendent
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        started = time.monotonic()
+        try:
+            answer = await compute()
+        except asyncio.CancelledError:
+            self._settle(key, future, None)
+            raise
+        except Exception:
+            self._settle(key, future, error=AnswerUnavailable())
+            raise
+        if answer is None:
+            # L'IA a échoué : ceux qui attendaient échouent aussi au lieu de relancer chacun un appel
+            self._settle(key, future, error=AnswerUnavailable())
+        else:
+            self._settle(key, future, answer)
+            self._store(key, answer, time.monotonic() - started)
+        return answer, False
+
+    def _settle(self, key, future, answer=None, error=None):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        if error is None:
+            future.set_result(answer)
+        else:
+            future.set_exception(error)
+            future.exception()  # Pas d'avertissement si personne n'attendait
+
+    def _latency(self, key):
+        entry = self._entries.get(key)
+        return entry[2] if entry else 0.0
+
+    def _store(self, key, answer, latency):
+        self._entries[key] = (answer, time.monotonic() + self.ttl, latency)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'saved_seconds': self.saved_seconds,
+        }
+
+
+ask_cache = AnswerCache(ASK_CACHE_TTL, ASK_CACHE_SIZE)
+metrics.collector('ask_cache_requests_total', 'counter', 'Questions !ask servies par le cache des réponses', lambda: {
+    (('result', 'hit'),): ask_cache.hits,
+    (('result', 'coalesced'),): ask_cache.coalesced,
+    (('result', 'miss'),): ask_cache.misses,
+})
+metrics.collector('ask_cache_saved_seconds_total', 'counter', "Attente de l'IA évitée grâce au cache", lambda: ask_cache.saved_seconds)
+metrics.collector('ask_cache_entries', 'gauge', 'Réponses !ask en cache', lambda: len(ask_cache._entries))
+
+bot = DiscordBot(command_prefix='!', intents=intents)
+
+# ========== MÉMOIRE DES CONVERSATIONS ==========
+CONVO_MAX_BYTES = int(os.getenv('CONVO_MAX_BYTES', str(16 * 1024 * 1024)))   # mémoire max de toutes les conversations
+CONVO_IDLE_TTL = float(os.getenv('CONVO_IDLE_TTL', '3600'))                 # oubli après N secondes sans message
+CONVO_TOKEN_BUDGET = int(os.getenv('CONVO_TOKEN_BUDGET', '2000'))            # tokens d'historique max envoyés à l'IA
+CONVO_SUMMARY_THRESHOLD = int(os.getenv('CONVO_SUMMARY_THRESHOLD', '1200'))  # au-delà, les vieux messages sont résumés
+CONVO_KEEP_RECENT = int(os.getenv('CONVO_KEEP_RECENT', '4'))                 # messages récents jamais résumés
+CONVO_SUMMARY_MODEL = os.getenv('CONVO_SUMMARY_MODEL', 'llama-3.1-8b-instant')
+
+def estimate_tokens(text):
+    """Estimation rapide du nombre de tokens (~4 caractères par token)"""
+    return len(text) // 4 + 1
+
+
+class ChatMessage:
+    """Un message de conversation, stocké de manière compacte"""
+    __slots__ = ('role', 'content', 'tokens', 'size')
+
+    def __init__(self, role, content):
+        self.role = sys.intern(role)   # "user"/"assistant" partagés par tous les messages
+        self.content = content
+        self.tokens = estimate_tokens(content)
+        self.size = sys.getsizeof(content) + sys.getsizeof(self)
+
+
+class Conversation:
+    __slots__ = ('messages', 'tokens', 'size', 'last_used',
+                 'summary', 'summary_tokens', 'folded_tokens', 'summarizing')
+
+    def __init__(self):
+        self.messages = deque()
+        self.tokens = 0
+        self.size = 0
+        self.last_used = time.monotonic()
+        self.summary = None         # résumé des anciens messages
+        self.summary_tokens = 0
+        self.folded_tokens = 0      # tokens des messages remplacés par le résumé
+        self.summarizing = False
+
+
+class ConversationStore:
+    """Historique des conversations !ask : taille mémoire bornée, éviction LRU/inactivité
+    et historique limité en tokens plutôt qu'en nombre de messages"""
+
+    def __init__(self, max_bytes, idle_ttl, token_budget, summary_threshold):
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.token_budget = token_budget
+        self.summary_threshold = summary_threshold
+        # Format: {user_id: Conversation}, du moins récemment utilisé au plus récent
+        self._conversations = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self.summaries = 0
+        self.prompt_requests = 0
+        self.prompt_tokens_saved = 0
+        self._background = set()
+
+    def __contains__(self, user_id):
+        return user_id in self._conversations
+
+    def append(self, user_id, role, content):
+        """Ajoute un message et coupe le début de la conversation si elle dépasse le budget"""
+        convo = self._conversations.get(user_id)
+        if convo is None:
+            convo = self._conversations[user_id] = Conversation()
+        self._conversations.move_to_end(user_id)
+        convo.last_used = time.monotonic()
+
+        message = ChatMessage(role, content)
+        convo.messages.append(message)
+        convo.tokens += message.tokens
+        convo.size += message.size
+        self.bytes += message.size
+
+        # Garder au moins le dernier message, et ne jamais commencer par une réponse du bot
+        while len(convo.messages) > 1 and (convo.tokens > self.token_budget
+                                           or convo.messages[0].role != 'user'):
+            self._drop_oldest(convo)
+        self._evict()
+
+    def pop_last(self, user_id):
+        """Retire le dernier message (question restée sans réponse)"""
+        convo = self._conversations.get(user_id)
+        if convo and convo.messages:
+            message = convo.messages.pop()
+            convo.tokens -= message.tokens
+            convo.size -= message.size
+            self.bytes -= message.size
+
+    def messages(self, user_id):
+        """Historique au format de l'API (liste de {"role", "content"}), résumé compris"""
+        convo = self._conversations.get(user_id)
+        if convo is None:
+            return []
+        history = [{"role": m.role, "content": m.content} for m in convo.messages]
+        self.prompt_requests += 1
+        if convo.summary:
+            history.insert(0, {"role": "system", "content": f"Résumé de la conversation précédente : {convo.summary}"})
+            self.prompt_tokens_saved += max(convo.folded_tokens - convo.summary_tokens, 0)
+        return history
+
+    def context_fingerprint(self, user_id, max_tokens):
+        """Empreinte du contexte de la conversation ("" si vide, None s'il est trop long pour le cache)"""
+        convo = self._conversations.get(user_id)
+        if convo is None or (not convo.messages and not convo.summary):
+            return ""
+        if convo.tokens + convo.summary_tokens > max_tokens:
+            return None
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update((convo.summary or "").encode())
+        for m in convo.messages:
+            digest.update(f"\0{m.role}\0{m.content}".encode())
+        return digest.hexdigest()
+
+    def maybe_summarize(self, user_id, summarize):
+        """Lance en arrière-plan le résumé des anciens messages si la conversation devient longue.
+        `summarize(ancien_résumé, messages)` est une coroutine qui renvoie le nouveau résumé."""
+        convo = self._conversations.get(user_id)
+        if (convo is None or convo.summarizing or convo.tokens <= self.summary_threshold
+                or len(convo.messages) <= CONVO_KEEP_RECENT):
+            return
+        folded = list(convo.messages)[:-CONVO_KEEP_RECENT]
+        convo.summarizing = True
+        task = asyncio.create_task(self._summarize(user_id, convo, folded, summarize))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _summarize(self, user_id, convo, folded, summarize):
+        try:
+            summary = await summarize(convo.summary, folded)
+        except Exception as e:
+            print(f'⚠️ Résumé de conversation impossible: {e}')
+            return
+        finally:
+            convo.summarizing = False
+        if not summary or self._conversations.get(user_id) is not convo:
+            return  # Conversation oubliée entre-temps
+        # Retirer les messages résumés qui sont encore en tête de la conversation
+        folded_ids = {id(m) for m in folded}
+        while convo.messages and id(convo.messages[0]) in folded_ids:
+            message = convo.messages[0]
+            self._drop_oldest(convo)
+            convo.folded_tokens += message.tokens
+        if convo.summary:
+            convo.size -= sys.getsizeof(convo.summary)
+            self.bytes -= sys.getsizeof(convo.summary)
+        convo.summary = summary
+        convo.summary_tokens = estimate_tokens(summary)
+        convo.size += sys.getsizeof(summary)
+        self.bytes += sys.getsizeof(summary)
+        self.summaries += 1
+
+    def clear(self, user_id):
+        """Oublie une conversation. Retourne False si elle n'existait pas."""
+        convo = self._conversations.pop(user_id, None)
+        if convo is None:
+            return False
+        self.bytes -= convo.size
+        return True
+
+    def _drop_oldest(self, convo):
+        message = convo.messages.popleft()
+        convo.tokens -= message.tokens
+        convo.size -= message.size
+        self.bytes -= message.size
+
+    def _evict(self):
+        # Les conversations sont triées par dernière utilisation : on évince par le début
+        now = time.monotonic()
+        while self._conversations:
+            user_id, convo = next(iter(self._conversations.items()))
+            if now - convo.last_used < self.idle_ttl and self.bytes <= self.max_bytes:
+                break
+            if len(self._conversations) == 1 and now - convo.last_used < self.idle_ttl:
+                break  # Ne jamais évincer la conversation en cours
+            self.clear(user_id)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'conversations': len(self._conversations),
+            'messages': sum(len(c.messages) for c in self._conversations.values()),
+            'bytes': self.bytes,
+            'evictions': self.evictions,
+            'summaries': self.summaries,
+            'prompt_tokens_saved': self.prompt_tokens_saved,
+            'prompt_requests': self.prompt_requests,
+        }
+
+
+conversations = ConversationStore(CONVO_MAX_BYTES, CONVO_IDLE_TTL, CONVO_TOKEN_BUDGET, CONVO_SUMMARY_THRESHOLD)
+
+# Dictionnaire pour tracker les sessions de jeu
+# Format: {user_id: {'game': 'nom_jeu', 'start_time': datetime}}
+game_sessions = {}
+
+# Dictionnaire pour tracker les statistiques de jeu
+# Format: {game_name: {'current_players': {user_id: None}, 'total_time': timedelta}}
+# (current_players est un dict pour des ajouts/retraits en O(1) en gardant l'ordre d'arrivée)
+game_stats = {}
+
+
+def get_game_stats(game_name):
+    """Statistiques d'un jeu, créées (et indexées pour la recherche) à la première apparition"""
+    stats = game_stats.get(game_name)
+    if stats is None:
+        stats = game_stats[game_name] = {'current_players': {}, 'total_time': timedelta()}
+        game_index.add(game_name)
+    return stats
+
+
+# ========== INDEX DES NOMS DE JEUX ==========
+GAME_SEARCH_LIMIT = 25          # suggestions max (limite de l'autocomplétion Discord)
+GAME_FUZZY_THRESHOLD = 0.4      # similarité minimale (trigrammes) pour accepter une faute de frappe
+GAME_PREFIX_SCAN = 200          # entrées max parcourues pour une recherche par préfixe
+GAME_NAME_MARKS = str.maketrans('', '', '™®©')
+
+def normalize_game_name(name):
+    """Comme normalize_text, sans les ™ / ® des noms d'activités"""
+    return normalize_text(name.translate(GAME_NAME_MARKS))
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class GameIndex:
+    """Index des jeux vus : nom normalisé -> nom d'origine, avec recherche par préfixe
+    (liste triée + bisect) et tolérance aux fautes de frappe (trigrammes)"""
+
+    def __init__(self):
+        # Format: {nom normalisé: nom d'origine}
+        self._names = {}
+        # Chaque fin de nom à partir d'un début de mot, triée. Format: [(fin du nom, nom normalisé)]
+        self._prefixes = []
+        # Format: {trigramme: {noms normalisés}}
+        self._trigrams = {}
+        # Format: {nom normalisé: nombre de trigrammes}
+        self._sizes = {}
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, name):
+        key = normalize_game_name(name)
+        if not key or key in self._names:
+            return
+        self._names[key] = name
+        words = key.split(' ')
+        for i in range(len(words)):
+            bisect.insort(self._prefixes, (' '.join(words[i:]), key))
+        grams = trigrams(key)
+        self._sizes[key] = len(grams)
+        for gram in grams:
+            self._trigrams.setdefault(gram, set()).add(key)
+
+    def lookup(self, query):
+        """Le jeu le plus proche de query, ou None"""
+        if not normalize_game_name(query):
+            return None
+        results = self.search(query, 1)
+        return results[0] if results else None
+
+    def search(self, query, limit=GAME_SEARCH_LIMIT):
+        """Noms d'origine correspondant à query, le meilleur en premier :
+        nom exact, puis début du nom, puis début d'un mot, puis fautes de frappe"""
+        key = normalize_game_name(query)
+        if not key:
+            return list(self._names.values())[:limit]
+        ranked = {}
+        if key in self._names:
+            ranked[key] = (0, 0)
+
+        start = bisect.bisect_left(self._prefixes, (key,))
+        for suffix, name_key in self._prefixes[start:start + GAME_PREFIX_SCAN]:
+            if not suffix.startswith(key):
+                break
+            rank = (1 if suffix == name_key else 2, len(name_key))
+            if rank < ranked.get(name_key, (3,)):
+                ranked[name_key] = rank
+
+        if len(ranked) < limit:
+            grams = trigrams(key)
+            shared = {}
+            for gram in grams:
+                for name_key in self._trigrams.get(gram, ()):
+                    shared[name_key] = shared.get(name_key, 0) + 1
+            for name_key, count in shared.items():
+                # Coefficient de Dice sur les trigrammes
+                score = 2 * count / (len(grams) + self._sizes[name_key])
+                if score >= GAME_FUZZY_THRESHOLD and name_key not in ranked:
+                    ranked[name_key] = (3, -score)
+
+        best = heapq.nsmallest(limit, ranked, key=ranked.get)
+        return [self._names[name_key] for name_key in best]
+
+
+game_index = GameIndex()
+
+
+# ========== HISTORIQUE DES SESSIONS DE JEU (PostgreSQL) ==========
+GAME_FLUSH_INTERVAL = float(os.getenv('GAME_FLUSH_INTERVAL', '10'))      # secondes entre deux écritures
+GAME_FLUSH_BATCH_SIZE = int(os.getenv('GAME_FLUSH_BATCH_SIZE', '200'))   # flush anticipé au-delà de N événements
+PLAYTIME_HOURLY_RETENTION_DAYS = int(os.getenv('PLAYTIME_HOURLY_RETENTION_DAYS', '14'))   # ensuite seul le détail par jour reste
+PLAYTIME_DAILY_RETENTION_DAYS = int(os.getenv('PLAYTIME_DAILY_RETENTION_DAYS', '365'))   # ensuite regroupé par mois
+ROLLUP_MAINTENANCE_INTERVAL = 3600                                                       # secondes entre deux nettoyages
+HEARTBEAT_INTERVAL = float(os.getenv('HEARTBEAT_INTERVAL', '60'))   # secondes entre deux signes de vie en base (fin des sessions orphelines)
+
+def split_by_hour(start, end):
+    """Découpe une période en tranches horaires. Retourne [(début_de_l_heure, secondes)]"""
+    bucket = start.replace(minute=0, second=0, microsecond=0)
+    while bucket < end:
+        next_bucket = bucket + timedelta(hours=1)
+        seconds = (min(end, next_bucket) - max(start, bucket)).total_seconds()
+        if seconds > 0:
+            yield bucket, seconds
+        bucket = next_bucket
+
+
+class GameSessionLog(WriteBehindBuffer):
+    """Journal des sessions de jeu écrit par lots : les débuts/fins de session sont mis en file
+    et écrits en quelques requêtes, avec les totaux par jeu incrémentés au passage"""
+
+    def __init__(self, flush_interval, batch_size):
+        super().__init__(flush_interval, batch_size)
+        # Sessions démarrées pas encore écrites. Format: {(user_id, start_time): game}
+        self._new_sessions = {}
+        # Sessions terminées à écrire. Format: [(user_id, game, start_time, end_time)]
+        self._ended_sessions = []
+        # Temps de jeu à ajouter aux agrégats. Format: {(heure, game, user_id): secondes}
+        self._hourly = {}
+        # Pics de joueurs simultanés. Format: {(heure, game): joueurs}
+        self._peaks = {}
+        self._last_maintenance = None
+        self._heartbeat_task = None
+
+    def record_start(self, user_id, game_name, start_time):
+        self._new_sessions[(user_id, start_time)] = game_name
+        self._notify()
+
+    def record_stop(self, user_id, game_name, start_time, end_time):
+        self._ended_sessions.append((user_id, game_name, start_time, end_time))
+        for bucket, seconds in split_by_hour(start_time, end_time):
+            key = (bucket, game_name, user_id)
+            self._hourly[key] = self._hourly.get(key, 0.0) + seconds
+        self._notify()
+
+    def record_players(self, game_name, player_count, when):
+        """Note le nombre de joueurs simultanés d'un jeu (on ne garde que le pic de chaque heure)"""
+        key = (when.replace(minute=0, second=0, microsecond=0), game_name)
+        if player_count > self._peaks.get(key, 0):
+            self._peaks[key] = player_count
+
+    def _pending_count(self):
+        return len(self._new_sessions) + len(self._ended_sessions)
+
+    async def _write(self):
+        new_sessions, self._new_sessions = self._new_sessions, {}
+        ended_sessions, self._ended_sessions = self._ended_sessions, []
+        hourly, self._hourly = self._hourly, {}
+        peaks, self._peaks = self._peaks, {}
+
+        # Nouvelles sessions (déjà terminées ou non) : un seul INSERT
+        insert_rows = {key: [key[0], game, key[1], None] for key, game in new_sessions.items()}
+        # Sessions déjà en base qui se terminent : un seul UPDATE
+        closed_users, closed_starts, closed_ends = [], [], []
+        # Totaux par jeu à incrémenter
+        totals = {}
+        for user_id, game_name, start_time, end_time in ended_sessions:
+            row = insert_rows.get((user_id, start_time))
+            if row is not None:
+                row[3] = end_time
+            else:
+                closed_users.append(user_id)
+                closed_starts.append(start_time)
+                closed_ends.append(end_time)
+            totals[game_name] = totals.get(game_name, 0.0) + (end_time - start_time).total_seconds()
+
+        rows = list(insert_rows.values())
+        committed = False
+        try:
+            async with db_pool.acquire() as conn:
+                async with conn.transaction():
+                    if rows:
+                        await conn.execute('''
+                            INSERT INTO game_sessions (user_id, game, started_at, ended_at)
+                            SELECT * FROM unnest($1::bigint[], $2::text[], $3::timestamp[], $4::timestamp[])
+                        ''', *zip(*rows))
+                    if closed_users:
+                        await conn.execute('''
+                            UPDATE game_sessions s SET ended_at = v.ended_at
+                            FROM unnest($1::bigint[], $2::timestamp[], $3::timestamp[]) AS v(user_id, started_at, ended_at)
+                            WHERE s.user_id = v.user_id AND s.started_at = v.started_at AND s.ended_at IS NULL
+                        ''', closed_users, closed_starts, closed_ends)
+                    if totals:
+                        await conn.execute('''
+                            INSERT INTO game_totals (game, total_seconds)
+                            SELECT * FROM unnest($1::text[], $2::float8[])
+                            ON CONFLICT (game) DO UPDATE SET
+                                total_seconds = game_totals.total_seconds + EXCLUDED.total_seconds,
+                                updated_at = CURRENT_TIMESTAMP
+                        ''', list(totals), list(totals.values()))
+                    if hourly:
+                        await self._write_rollups(conn, hourly)
+                    if peaks:
+                        await self._write_peaks(conn, peaks)
+                committed = True
+                if (self._last_maintenance is None
+                        or time.monotonic() - self._last_maintenance > ROLLUP_MAINTENANCE_INTERVAL):
+                    await self._downsample(conn)
+                    self._last_maintenance = time.monotonic()
+        except BaseException:
+            if committed:
+                # Seul le nettoyage a échoué : les événements sont déjà en base
+                raise
+            # Remettre les événements en file pour le prochain essai (aussi si le flush est annulé à l'arrêt)
+            new_sessions.update(self._new_sessions)
+            self._new_sessions = new_sessions
+            self._ended_sessions = ended_sessions + self._ended_sessions
+            for key, seconds in hourly.items():
+                self._hourly[key] = self._hourly.get(key, 0.0) + seconds
+            for key, players in peaks.items():
+                self._peaks[key] = max(players, self._peaks.get(key, 0))
+            raise
+        return len(new_sessions) + len(ended_sessions)
+
+    async def beat(self):
+        """Note en base que le bot tourne, à l'heure du bot comme started_at / ended_at"""
+        async with db_pool.acquire() as conn:
+            await conn.execute('''
+                INSERT INTO bot_heartbeat (id, seen_at) VALUES (TRUE, $1)
+                ON CONFLICT (id) DO UPDATE SET seen_at = EXCLUDED.seen_at
+            ''', datetime.now())
+
+    async def _heartbeat(self):
+        while True:
+            try:
+                await self.beat()
+            except Exception as e:
+                print(f'❌ Signe de vie non écrit: {e}')
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    def start_heartbeat(self):
+        """À lancer une fois le signe de vie précédent lu par restore_game_state"""
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self):
+        heartbeat, self._heartbeat_task = self._heartbeat_task, None
+        if heartbeat is not None:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+        await super().stop()
+        if heartbeat is not None and db_pool is not None:
+            # Dernier signe de vie : les sessions encore ouvertes se fermeront à cette heure-ci
+            await self.beat()
+
+    async def _write_rollups(self, conn, hourly):
+        daily = {}
+        for (bucket, game_name, user_id), seconds in hourly.items():
+            key = (bucket.date(), game_name, user_id)
+            daily[key] = daily.get(key, 0.0) + seconds
+        buckets, games, users = zip(*hourly)
+        await conn.execute('''
+            INSERT INTO playtime_hourly (bucket, game, user_id, seconds)
+            SELECT * FROM unnest($1::timestamp[], $2::text[], $3::bigint[], $4::float8[])
+            ON CONFLICT (bucket, game, user_id) DO UPDATE SET seconds = playtime_hourly.seconds + EXCLUDED.seconds
+        ''', buckets, games, users, list(hourly.values()))
+        days, games, users = zip(*daily)
+        await conn.execute('''
+            INSERT INTO playtime_daily (day, game, user_id, seconds)
+            SELECT * FROM unnest($1::date[], $2::text[], $3::bigint[], $4::float8[])
+            ON CONFLICT (day, game, user_id) DO UPDATE SET seconds = playtime_daily.seconds + EXCLUDED.seconds
+        ''', days, games, users, list(daily.values()))
+
+    async def _write_peaks(self, conn, peaks):
+        buckets, games = zip(*peaks)
+        await conn.execute('''
+            INSERT INTO game_peak_hourly (bucket, game, peak_players)
+            SELECT * FROM unnest($1::timestamp[], $2::text[], $3::int[])
+            ON CONFLICT (bucket, game) DO UPDATE
+                SET peak_players = GREATEST(game_peak_hourly.peak_players, EXCLUDED.peak_players)
+        ''', buckets, games, list(peaks.values()))
+        await conn.execute('''
+            INSERT INTO game_peak_daily (day, game, peak_players)
+            SELECT bucket::date, game, MAX(peak_players)
+            FROM unnest($1::timestamp[], $2::text[], $3::int[]) AS v(bucket, game, peak_players)
+            GROUP BY 1, 2
+            ON CONFLICT (day, game) DO UPDATE
+                SET peak_players = GREATEST(game_peak_daily.peak_players, EXCLUDED.peak_players)
+        ''', buckets, games, list(peaks.values()))
+
+    async def _downsample(self, conn):
+        """Garde le stockage borné : le détail horaire expire (le détail par jour reste),
+        et les vieux jours sont regroupés par mois"""
+        hourly_limit = datetime.now() - timedelta(days=PLAYTIME_HOURLY_RETENTION_DAYS)
+        daily_limit = (datetime.now() - timedelta(days=PLAYTIME_DAILY_RETENTION_DAYS)).date()
+        async with conn.transaction():
+            await conn.execute('DELETE FROM playtime_hourly WHERE bucket < $1', hourly_limit)
+            await conn.execute('DELETE FROM game_peak_hourly WHERE bucket < $1', hourly_limit)
+            await conn.execute('''
+                WITH old AS (
+                    DELETE FROM playtime_daily WHERE day < $1
+                    RETURNING day, game, user_id, seconds
+                )
+                INSERT INTO playtime_monthly (month, game, user_id, seconds)
+                SELECT date_trunc('month', day)::date, game, user_id, SUM(seconds)
+                FROM old GROUP BY 1, 2, 3
+                ON CONFLICT (month, game, user_id) DO UPDATE
+                    SET seconds = playtime_monthly.seconds + EXCLUDED.seconds
+            ''', daily_limit)
+
+
+session_log = GameSessionLog(GAME_FLUSH_INTERVAL, GAME_FLUSH_BATCH_SIZE)
+
+
+class PlaytimeWindow(commands.Converter):
+    """Période comme "24h", "7d"/"7j" ou "30d" pour les stats de temps de jeu"""
+
+    async def convert(self, ctx, argument):
+        match = re.fullmatch(r'(\d{1,4})([hdj])', argument.lower())
+        if not match:
+            raise commands.BadArgument(f"Période invalide: {argument}")
+        amount = int(match.group(1))
+        return timedelta(hours=amount) if match.group(2) == 'h' else timedelta(days=amount)
+
+
+def format_window(window):
+    if window < timedelta(days=2):
+        return f"{window.total_seconds() / 3600:.0f}h"
+    return f"{window.days}j"
+
+
+@metrics.timed('db_query_seconds', query='get_top_games')
+async def get_top_games(since, limit=10):
+    """Jeux les plus joués depuis `since`, lus dans les agrégats (pas dans les sessions)"""
+    # Les sessions en attente d'écriture doivent être comptées
+    await session_log.flush()
+    async with db_pool.acquire() as conn:
+        if datetime.now() - since <= timedelta(days=2):
+            return await conn.fetch('''
+                SELECT game, SUM(seconds) AS seconds FROM playtime_hourly
+                WHERE bucket >= $1 GROUP BY game ORDER BY seconds DESC LIMIT $2
+            ''', since.replace(minute=0, second=0, microsecond=0), limit)
+        return await conn.fetch('''
+            SELECT game, SUM(seconds) AS seconds FROM (
+                SELECT game, seconds FROM playtime_daily WHERE day >= $1
+                UNION ALL
+                SELECT game, seconds FROM playtime_monthly WHERE month >= date_trunc('month', $1::date)
+            ) t GROUP BY game ORDER BY seconds DESC LIMIT $2
+        ''', since.date(), limit)
+
+
+@metrics.timed('db_query_seconds', query='get_user_playtime')
+async def get_user_playtime(user_id, since, limit=10):
+    """Temps de jeu d'un utilisateur par jeu depuis `since`"""
+    await session_log.flush()
+    async with db_pool.acquire() as conn:
+        return await conn.fetch('''
+            SELECT game, SUM(seconds) AS seconds FROM (
+                SELECT game, seconds FROM playtime_daily WHERE user_id = $1 AND day >= $2
+                UNION ALL
+                SELECT game, seconds FROM playtime_monthly WHERE user_id = $1 AND month >= date_trunc('month', $2::date)
+            ) t GROUP BY game ORDER BY seconds DESC LIMIT $3
+        ''', user_id, since.date(), limit)
+
+
+@metrics.timed('db_query_seconds', query='get_game_peak')
+async def get_game_peak(game_name, since):
+    """Pic de joueurs simultanés d'un jeu depuis `since`"""
     async with db_pool.acquire() as conn:
-        await conn.execute(
-            'UPDATE users SET xp = $1, level = $2, updated_at = CURRENT_TIMESTAMP WHERE user_id = $3',
-            xp, level, user_id
+        return await conn.fetchval(
+            'SELECT MAX(peak_players) FROM game_peak_daily WHERE game = $1 AND day >= $2',
+            game_name, since.date()
         )
 
-async def get_leaderboard(limit=10):
+
+def format_duration(seconds, long=False):
+    hours = seconds / 3600
+    if hours >= 1:
+        return f"{hours:.1f} heures" if long else f"{hours:.1f}h"
+    return f"{seconds / 60:.0f} minutes" if long else f"{seconds / 60:.0f}min"
+
+
+def playing_activity(member):
+    """Nom du jeu auquel joue le membre, ou None"""
+    for activity in member.activities:
+        if activity.type == discord.ActivityType.playing:
+            return activity.name
+    return None
+
+
+async def restore_game_state():
+    """Reconstruit game_sessions/game_stats au démarrage : 3 requêtes de lecture, puis comparaison
+    avec les présences actuelles (aucune requête par joueur)"""
     async with db_pool.acquire() as conn:
-        results = await conn.fetch(
-            'SELECT user_id, username, xp, level FROM users ORDER BY level DESC, xp DESC LIMIT $1',
-            limit
-        )
-        return results
+        totals = await conn.fetch('SELECT game, total_seconds FROM game_totals')
+        open_sessions = await conn.fetch('SELECT user_id, game, started_at FROM game_sessions WHERE ended_at IS NULL')
+        # Dernière fois que le bot tournait (None si jamais noté)
+        last_seen = await conn.fetchval('SELECT seen_at FROM bot_heartbeat')
+    session_log.start_heartbeat()
 
-intents = discord.Intents.default()
-intents.message_content = True
-intents.members = True
-intents.presences = True  # Nécessaire pour détecter les activités
+    for record in totals:
+        get_game_stats(record['game'])['total_time'] = timedelta(seconds=record['total_seconds'])
 
-groq_client = Groq(api_key=os.getenv('GROQ_API_KEY'))
+    # Ce que font les membres en ce moment
+    playing_now = {}
+    for guild in bot.guilds:
+        for member in guild.members:
+            if not member.bot:
+                game_name = playing_activity(member)
+                if game_name:
+                    playing_now[member.id] = game_name
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+    resumed = 0
+    for record in open_sessions:
+        user_id = record['user_id']
+        game_name = record['game']
+        if playing_now.get(user_id) == game_name and user_id not in game_sessions:
+            # Toujours en train de jouer : on reprend la session là où elle en était
+            game_sessions[user_id] = {'game': game_name, 'start_time': record['started_at']}
+            stats = get_game_stats(game_name)
+            stats['current_players'][user_id] = None
+            resumed += 1
+        else:
+            # A arrêté pendant que le bot était éteint : on ferme à la dernière date connue
+            end_time = max(last_seen or record['started_at'], record['started_at'])
+            stats = get_game_stats(game_name)
+            stats['total_time'] += end_time - record['started_at']
+            session_log.record_stop(user_id, game_name, record['started_at'], end_time)
 
-# Dictionnaire pour stocker l'historique des conversations
-# Format: {user_id: [{"role": "user/assistant", "content": "message"}]}
-conversation_history = {}
+    # Ceux qui jouaient déjà sans session ouverte en base
+    now = datetime.now()
+    for user_id, game_name in playing_now.items():
+        if user_id not in game_sessions:
+            game_sessions[user_id] = {'game': game_name, 'start_time': now}
+            stats = get_game_stats(game_name)
+            stats['current_players'][user_id] = None
+            session_log.record_start(user_id, game_name, now)
 
-# Dictionnaire pour tracker les sessions de jeu
-# Format: {user_id: {'game': 'nom_jeu', 'start_time': datetime}}
-game_sessions = {}
+    print(f'🎮 Sessions de jeu restaurées: {resumed} reprises, {len(game_sessions) - resumed} nouvelles')
 
-# Dictionnaire pour tracker les statistiques de jeu
-# Format: {game_name: {'current_players': [user_ids], 'total_time': timedelta}}
-game_stats = {}
+# True une fois les sessions de jeu restaurées (on_ready est rappelé à chaque reconnexion)
+game_state_restored = False
+game_state_lock = asyncio.Lock()
 
 @bot.event
 async def on_ready():
-    await init_db()
+    global game_state_restored
+    async with game_state_lock:
+        if not game_state_restored:
+            # Besoin des membres des serveurs : ne peut pas se faire dans setup_hook
+            try:
+                await restore_game_state()
+            except Exception as e:
+                print(f'❌ Impossible de restaurer les sessions de jeu (nouvel essai à la reconnexion): {e}')
+            else:
+                game_state_restored = True
+                await purge_engine.resume_all()
     print(f'{bot.user} est en ligne! Ready to go!')
     print(f'Groq API Key: {"Configurée" if groq_client.api_key else "Manquante"}')
     print('-------------------')
 
 
 @bot.event
+@metrics.timed('discord_event_seconds', event='on_member_join')
 async def on_member_join(member):
-    channel = discord.utils.get(member.guild.text_channels, name='arrivage')
+    guild = member.guild
+    metrics.inc('member_joins_total')
+    if join_monitor.record(guild.id):
+        # Signal pour la modération : les extensions peuvent écouter on_join_burst
+        count = join_monitor.count(guild.id)
+        print(f"⚠️ Vague d'arrivées sur {guild.name}: {count} en {JOIN_BURST_WINDOW:.0f}s")
+        bot.dispatch('join_burst', guild, count)
+    
+    # Pendant une vague, les bienvenues sont regroupées par outbound (30 arrivées = 1 message)
+    channel = get_named_channel(guild, WELCOME_CHANNEL_NAME)
     if channel:
-        await channel.send(f'Yooo {member.mention}, bienvenue dans la team!')
+        outbound.announce(channel, 'welcome', line=member.mention, content=f'Yooo {member.mention}, bienvenue dans la team!')
     
-    role = discord.utils.get(member.guild.roles, name='LES BG')
+    role = get_named_role(guild, WELCOME_ROLE_NAME)
     if role:
-        await member.add_roles(role)
+        role_grants.grant(member, role)
 
 
 @bot.event
+@metrics.timed('discord_event_seconds', event='on_message')
 async def on_message(message):
-    if not message.author.bot:
-        user_id = str(message.author.id)
+    # L'XP est propre à chaque serveur (pas d'XP en message privé)
+    amount = 0
+    if not message.author.bot and message.guild is not None:
+        # Anti-farm : vérifié en mémoire, un message sans XP ne touche pas à la base
+        amount = xp_cooldowns.xp_for(message)
+    if amount:
+        guild_id = message.guild.id
+        user_id = message.author.id
         username = message.author.name
-        data = await get_user_data(user_id, username)
-        
-        data["xp"] += 10
-        xp_needed = data["level"] * 100
-        if data["xp"] >= xp_needed:
-            data["level"] += 1
-            await update_user_data(user_id, data["xp"], data["level"])
-            await message.channel.send(f"GG {message.author.mention}! Level {data['level']}")
-        else:
-            await update_user_data(user_id, data["xp"], data["level"])
+        # L'XP est écrite en base par lots, le level up reste instantané
+        data, leveled_up = await xp_accumulator.add_xp(guild_id, user_id, username, amount)
+        if leveled_up:
+            outbound.announce(
+                message.channel, 'level_up',
+                line=f"{message.author.mention} (Level {data['level']})",
+                content=f"GG {message.author.mention}! Level {data['level']}"
+            )
     
     await bot.process_commands(message)
 
 
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.metrics_start = time.perf_counter()
+
+
+@bot.after_invoke
+async def record_command_time(ctx):
+    """Durée de chaque commande (appelé même si elle a échoué)"""
+    metrics.observe('discord_command_seconds', time.perf_counter() - ctx.metrics_start,
+                    command=ctx.command.qualified_name, status='error' if ctx.command_failed else 'ok')
+
+
+@bot.event
+async def on_raw_message_delete(payload):
+    # Si la commande !ask/!joke est supprimée, inutile d'attendre la réponse de l'IA
+    llm_client.cancel_for_message(payload.message_id)
+
+
 @bot.event
+@metrics.timed('discord_event_seconds', event='on_presence_update')
 async def on_presence_update(before, after):
     """Détecte quand un membre commence ou arrête de jouer à un jeu"""
     if after.bot:
         return
     
-    user_id = str(after.id)
-    
     # Récupérer l'activité de jeu (si elle existe)
-    before_game = None
-    after_game = None
-    
-    # Chercher une activité de type "Playing" (jeu)
-    if before.activities:
-        for activity in before.activities:
-            if activity.type == discord.ActivityType.playing:
-                before_game = activity.name
-                break
+    before_game = playing_activity(before)
+    after_game = playing_activity(after)
     
-    if after.activities:
-        for activity in after.activities:
-            if activity.type == discord.ActivityType.playing:
-                after_game = activity.name
-                break
+    # Chemin rapide : statut, musique, etc. sans changement de jeu
+    if before_game == after_game:
+        return
+    
+    # Un membre présent dans plusieurs serveurs génère un événement par serveur
+    session = game_sessions.get(after.id)
+    if after_game and session is not None and session['game'] == after_game:
+        return
+    
+    # Si l'utilisateur change de jeu (à tester en premier pour bien fermer l'ancienne session)
+    if before_game and after_game:
+        await handle_game_stop(after, before_game)
+        await handle_game_start(after, after_game)
     
     # Si l'utilisateur commence à jouer à un nouveau jeu
-    if after_game and after_game != before_game:
+    elif after_game:
         await handle_game_start(after, after_game)
     
     # Si l'utilisateur arrête de jouer
-    elif before_game and not after_game:
-        await handle_game_stop(after, before_game)
-    
-    # Si l'utilisateur change de jeu
-    elif before_game and after_game and before_game != after_game:
+    else:
         await handle_game_stop(after, before_game)
-        await handle_game_start(after, after_game)
+
+
+# Cache des salons par nom. Format: {guild_id: {nom: salon ou None}}
+channel_cache = {}
+
+def get_named_channel(guild, name):
+    """Salon texte par nom, mis en cache par serveur (invalidé quand les salons changent)"""
+    channels = channel_cache.setdefault(guild.id, {})
+    if name not in channels:
+        channels[name] = discord.utils.get(guild.text_channels, name=name)
+    return channels[name]
+
+
+def game_channel(guild):
+    """Salon où annoncer les sessions de jeu : #gaming, sinon #général, sinon le premier salon"""
+    channel = get_named_channel(guild, 'gaming') or get_named_channel(guild, 'général')
+    if not channel and guild.text_channels:
+        channel = guild.text_channels[0]
+    return channel
+
+
+# Cache des rôles par nom. Format: {guild_id: {nom: rôle ou None}}
+role_cache = {}
+
+def get_named_role(guild, name):
+    """Rôle par nom, mis en cache par serveur (invalidé quand les rôles changent)"""
+    roles = role_cache.setdefault(guild.id, {})
+    if name not in roles:
+        roles[name] = discord.utils.get(guild.roles, name=name)
+    return roles[name]
+
+
+@bot.event
+async def on_guild_channel_create(channel):
+    channel_cache.pop(channel.guild.id, None)
+
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    if before.name != after.name:
+        channel_cache.pop(after.guild.id, None)
+
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    channel_cache.pop(channel.guild.id, None)
+
+
+@bot.event
+async def on_guild_role_create(role):
+    role_cache.pop(role.guild.id, None)
+
+
+@bot.event
+async def on_guild_role_update(before, after):
+    if before.name != after.name:
+        role_cache.pop(after.guild.id, None)
+
+
+@bot.event
+async def on_guild_role_delete(role):
+    role_cache.pop(role.guild.id, None)
+
+
+@bot.event
+async def on_member_ban(guild, user):
+    ban_index.banned(guild, user)
+
+
+@bot.event
+async def on_member_unban(guild, user):
+    ban_index.unbanned(guild, user)
+
+
+@bot.event
+async def on_guild_remove(guild):
+    ban_index.forget(guild.id)
+    channel_cache.pop(guild.id, None)
+    role_cache.pop(guild.id, None)
 
 
 async def handle_game_start(member, game_name):
     """Gère le début d'une session de jeu"""
-    user_id = str(member.id)
+    user_id = member.id
+    start_time = datetime.now()
     game_sessions[user_id] = {
         'game': game_name,
-        'start_time': datetime.now()
+        'start_time': start_time
     }
-    if game_name not in game_stats:
-        game_stats[game_name] = {
-            'current_players': [],
-            'total_time': timedelta()
-        }
-    if user_id not in game_stats[game_name]['current_players']:
-        game_stats[game_name]['current_players'].append(user_id)
-    player_count = len(game_stats[game_name]['current_players'])
-    channel = discord.utils.get(member.guild.text_channels, name='gaming')
-    if not channel:
-        channel = discord.utils.get(member.guild.text_channels, name='général')
+    session_log.record_start(user_id, game_name, start_time)
+    stats = get_game_stats(game_name)
+    stats['current_players'][user_id] = None
+    player_count = len(stats['current_players'])
+    session_log.record_players(game_name, player_count, start_time)
+    channel = game_channel(member.guild)
     if not channel:
-        channel = member.guild.text_channels[0]
+        return
     embed = discord.Embed(
         title="🎮 Session de Jeu Démarrée",
         description=f"{member.mention} joue à **{game_name}** !",
         color=discord.Color.green(),
-        timestamp=datetime.now()
+        timestamp=start_time
     )
     if player_count > 1:
+        # Seuls les 3 premiers sont affichés : inutile de parcourir tous les joueurs
         other_players = []
-        for uid in game_stats[game_name]['current_players']:
+        for uid in stats['current_players']:
             if uid != user_id:
-                try:
-                    other_member = member.guild.get_member(int(uid))
-                    if other_member:
-                        other_players.append(other_member.mention)
-                except:
-                    pass
+                other_member = member.guild.get_member(uid)
+                if other_member:
+                    other_players.append(other_member.mention)
+                    if len(other_players) == 3:
+                        break
         
         if other_players:
-            others_text = ", ".join(other_players[:3]) 
-            if len(other_players) > 3:
-                others_text += f" et {len(other_players) - 3} autre(s)"
+            others_text = ", ".join(other_players)
+            others_count = player_count - 1
+            if others_count > len(other_players):
+                others_text += f" et {others_count - len(other_players)} autre(s)"
             embed.add_field(
                 name="🔥 Joueurs en ligne",
                 value=f"{player_count} personne(s) jouent actuellement :\n{others_text}",
                 inline=False
             )
-    embed.set_footer(text=f"Lancé à {datetime.now().strftime('%H:%M')}")
-    await channel.send(embed=embed)
+    embed.set_footer(text=f"Lancé à {start_time.strftime('%H:%M')}")
+    # Les lancements rapprochés sont regroupés en un seul embed
+    outbound.announce(channel, 'game_start', line=f"{member.mention} joue à **{game_name}**", embed=embed)
 
 
 async def handle_game_stop(member, game_name):
     """Gère la fin d'une session de jeu"""
-    user_id = str(member.id)
-    if user_id not in game_sessions:
-        return
-    session = game_sessions[user_id]
-    play_duration = datetime.now() - session['start_time']
-    if game_name in game_stats:
-        game_stats[game_name]['total_time'] += play_duration
-        if user_id in game_stats[game_name]['current_players']:
-            game_stats[game_name]['current_players'].remove(user_id)
-    del game_sessions[user_id]
+    user_id = member.id
+    session = game_sessions.pop(user_id, None)
+    if session is None:
+        return
+    end_time = datetime.now()
+    play_duration = end_time - session['start_time']
+    session_log.record_stop(user_id, session['game'], session['start_time'], end_time)
+    stats = game_stats.get(game_name)
+    if stats is not None:
+        stats['total_time'] += play_duration
+        stats['current_players'].pop(user_id, None)
     if play_duration > timedelta(hours=1):
-        channel = discord.utils.get(member.guild.text_channels, name='gaming')
+        channel = get_named_channel(member.guild, 'gaming')
         if channel:
             hours = play_duration.total_seconds() / 3600
-            await channel.send(
-                f"👋 {member.mention} a fini de jouer à **{game_name}** "
-                f"après {hours:.1f}h de jeu ! 🎮"
-            )
+            text = f"👋 {member.mention} a fini de jouer à **{game_name}** après {hours:.1f}h de jeu ! 🎮"
+            outbound.announce(channel, 'game_stop', line=text, content=text)
 
 
 @bot.command(name='info')
@@ -259,28 +3945,31 @@ Serveur perso pour traîner entre potes
 
 
 @bot.command(name='level')
+@commands.guild_only()
 async def level(ctx, member: discord.Member = None):
     if not member:
         member = ctx.author
     
-    user_id = str(member.id)
-    data = await get_user_data(user_id, member.name)
+    user_id = member.id
+    data = await xp_accumulator.get(ctx.guild.id, user_id, member.name)
     await ctx.send(f"**{member.name}** - Level {data['level']} | {data['xp']} XP")
 
 
 @bot.command(name='leaderboard', aliases=['top', 'classement'])
+@commands.guild_only()
 async def leaderboard(ctx, limit: int = 10):
     if limit > 20:
         limit = 20
     
-    results = await get_leaderboard(limit)
+    # Classement en cache, tenu à jour à chaque gain d'XP
+    results = await leaderboard_cache.top(ctx.guild.id, limit)
     
     if not results:
         await ctx.send("Aucun utilisateur enregistré!")
         return
     
     embed = discord.Embed(
-        title="🏆 Classement des niveaux",
+        title=f"🏆 Classement des niveaux de {ctx.guild.name}",
         color=discord.Color.gold()
     )
     
@@ -298,6 +3987,23 @@ async def leaderboard(ctx, limit: int = 10):
     await ctx.send(embed=embed)
 
 
+@bot.command(name='rank', aliases=['rang'])
+@commands.guild_only()
+async def rank(ctx, member: discord.Member = None):
+    """Position exacte d'un membre dans le classement du serveur"""
+    if not member:
+        member = ctx.author
+    
+    guild_id = ctx.guild.id
+    data = await xp_accumulator.get(guild_id, member.id, member.name)
+    position, total = await get_rank(guild_id, member.id, data['xp'], data['level'])
+    medal = "🥇" if position == 1 else "🥈" if position == 2 else "🥉" if position == 3 else "🏅"
+    await ctx.send(
+        f"{medal} **{member.name}** est **#{position:,}** sur {total:,} "
+        f"- Level {data['level']} | {data['xp']} XP"
+    )
+
+
 @bot.command(name='role')
 async def role(ctx, member: discord.Member, *, role_name: str):
     role = discord.utils.get(ctx.guild.roles, name=role_name)
@@ -318,53 +4024,59 @@ async def role(ctx, member: discord.Member, *, role_name: str):
 @commands.has_permissions(kick_members=True)
 async def kick(ctx, member: discord.Member, *, reason=None):
     if member == ctx.author:
-        await ctx.send("Tu veux te kick toi-même? Malin!")
+        await outbound.send(ctx.channel, PRIORITY_HIGH, content="Tu veux te kick toi-même? Malin!")
         return
     
     try:
         await member.kick(reason=reason)
-        await ctx.send(f"{member.name} a pris la porte!")
+        await outbound.send(ctx.channel, PRIORITY_HIGH, content=f"{member.name} a pris la porte!")
         if reason:
-            await ctx.send(f"Raison: {reason}")
+            await outbound.send(ctx.channel, PRIORITY_HIGH, content=f"Raison: {reason}")
     except:
-        await ctx.send("J'ai pas pu le virer, désolé!")
+        await outbound.send(ctx.channel, PRIORITY_HIGH, content="J'ai pas pu le virer, désolé!")
 
 
 @bot.command(name='ban')
 @commands.has_permissions(ban_members=True)
 async def ban(ctx, member: discord.Member, *, reason=None):
     if member == ctx.author:
-        await ctx.send("Tu veux te ban toi-même? Bizarre...")
+        await outbound.send(ctx.channel, PRIORITY_HIGH, content="Tu veux te ban toi-même? Bizarre...")
         return
     
     try:
         await member.ban(reason=reason)
-        await ctx.send(f"{member.name} a été banni!")
+        await outbound.send(ctx.channel, PRIORITY_HIGH, content=f"{member.name} a été banni!")
         if reason:
-            await ctx.send(f"Raison: {reason}")
+            await outbound.send(ctx.channel, PRIORITY_HIGH, content=f"Raison: {reason}")
     except:
-        await ctx.send("Impossible de le ban!")
+        await outbound.send(ctx.channel, PRIORITY_HIGH, content="Impossible de le ban!")
 
 @bot.command(name='unban')
 @commands.has_permissions(ban_members=True)
 async def unban(ctx, *, member_name):
     try:
-        if '#' not in member_name:
-            await ctx.send("Écris comme ça: `!unban nom#1234`")
+        bans = await ban_index.get(ctx.guild)
+        users = bans.find(member_name)
+        if not users:
+            await outbound.send(ctx.channel, PRIORITY_HIGH, content=f"J'ai pas trouvé {member_name} dans les bannis")
+            return
+        if len(users) > 1:
+            choices = ", ".join(f"{user.name} (`{user.id}`)" for user in users[:10])
+            await outbound.send(ctx.channel, PRIORITY_HIGH, content=f"Plusieurs bannis s'appellent comme ça: {choices}. Utilise l'id!")
             return
         
-        member_name_part, member_discriminator = member_name.split('#')
-        
-        async for ban_entry in ctx.guild.bans():
-            user = ban_entry.user
-            if user.name == member_name_part and user.discriminator == member_discriminator:
-                await ctx.guild.unban(user)
-                await ctx.send(f"{user.name} est de retour!")
-                return
-        
-        await ctx.send(f"J'ai pas trouvé {member_name} dans les bannis")
+        user = users[0]
+        try:
+            await ctx.guild.unban(user)
+        except discord.NotFound:
+            # Débanni entre-temps sans qu'on ait reçu l'événement
+            bans.remove(user.id)
+            await outbound.send(ctx.channel, PRIORITY_HIGH, content=f"{user.name} n'est déjà plus banni")
+            return
+        bans.remove(user.id)
+        await outbound.send(ctx.channel, PRIORITY_HIGH, content=f"{user.name} est de retour!")
     except:
-        await ctx.send("Une erreur bizarre s'est produite...")
+        await outbound.send(ctx.channel, PRIORITY_HIGH, content="Une erreur bizarre s'est produite...")
 
 @bot.command(name='avatar')
 async def avatar(ctx, member: discord.Member = None):
@@ -377,8 +4089,8 @@ async def avatar(ctx, member: discord.Member = None):
 
 @bot.command(name='giveXP')
 @commands.has_permissions(manage_roles=True)
-async def give_xp(ctx, member: discord.Member, amount: int):
-    # Limite pour éviter les abus et les boucles infinies
+async def give_xp(ctx, target: Union[discord.Member, discord.Role], amount: int):
+    # Limite pour éviter les abus
     if amount > 10000:
         await ctx.send(f"❌ Maximum 10 000 XP par commande ! (demandé : {amount:,})")
         return
@@ -387,36 +4099,36 @@ async def give_xp(ctx, member: discord.Member, amount: int):
         await ctx.send("❌ On peut pas donner d'XP négatif !")
         return
     
-    user_id = str(member.id)
-    data = await get_user_data(user_id, member.name)
-    
-    data["xp"] += amount
-    xp_needed = data["level"] * 100
-    leveled_up = False
-    levels_gained = 0
-    
-    # Limiter aussi le nombre de level ups en une fois (sécurité supplémentaire)
-    max_iterations = 100
-    iterations = 0
-    
-    while data["xp"] >= xp_needed and iterations < max_iterations:
-        data["xp"] -= xp_needed 
-        data["level"] += 1
-        leveled_up = True
-        levels_gained += 1
-        xp_needed = data["level"] * 100
-        iterations += 1
+    guild_id = ctx.guild.id
+    if isinstance(target, discord.Role):
+        # Tout le rôle en une seule requête
+        members = [member for member in target.members if not member.bot]
+        if not members:
+            await ctx.send(f"❌ Personne dans le rôle **{target.name}** !")
+            return
+        rows = await xp_accumulator.bulk(
+            give_xp_bulk, guild_id, [member.id for member in members], [member.name for member in members], amount
+        )
+        leveled = [row['gained'] for row in rows if row['gained']]
+        message = f"✅ {len(rows):,} membre(s) de **{target.name}** ont reçu {amount:,} XP!"
+        if leveled:
+            message += (f"\n🎉 {len(leveled):,} ont monté de niveau : **{sum(leveled):,} niveau(x)** au total "
+                        f"(jusqu'à +{max(leveled)})")
+        await ctx.send(message)
+        return
     
-    await update_user_data(user_id, data["xp"], data["level"])
+    data = await xp_accumulator.get(guild_id, target.id, target.name)
+    level, xp, levels_gained = apply_xp_gain(data["level"], data["xp"], amount)
+    xp_accumulator.set(guild_id, target.id, xp, level)
     
     # Message avec plus d'infos
-    if leveled_up:
+    if levels_gained:
         await ctx.send(
-            f"🎉 {member.mention} a reçu {amount:,} XP et a monté **{levels_gained} niveau(x)** !\n"
-            f"**Nouveau niveau : {data['level']}** | XP restant : {data['xp']}"
+            f"🎉 {target.mention} a reçu {amount:,} XP et a monté **{levels_gained} niveau(x)** !\n"
+            f"**Nouveau niveau : {level}** | XP restant : {xp}"
         )
     else:
-        await ctx.send(f"✅ {member.mention} a reçu {amount:,} XP!")
+        await ctx.send(f"✅ {target.mention} a reçu {amount:,} XP!")
 
 @bot.command(name='clear')
 @commands.has_permissions(manage_messages=True)
@@ -425,35 +4137,44 @@ async def clear(ctx, amount: int = 5):
         await ctx.send("Max 50 messages!")
         return
 
+    # Même moteur que !clearchannel : la commande rend la main tout de suite
+    status = await ctx.send(f"🧹 Suppression de {amount} message(s)...")
     try:
-        deleted = await ctx.channel.purge(limit=amount + 1)
-        await ctx.send(f"Hop! {len(deleted)-1} messages supprimés", delete_after=3)
-    except:
-        await ctx.send("J'ai foiré, désolé!")
+        await purge_engine.start(ctx.channel, status, limit=amount, before_id=ctx.message.id, ephemeral=True,
+                                 permissions=ctx.channel.permissions_for(ctx.author))
+        await ctx.message.delete()
+    except PurgeError as e:
+        await status.edit(content=f"❌ {e}")
+    except discord.HTTPException:
+        await status.edit(content="J'ai foiré, désolé!")
 
 
 @bot.command(name='banlist')
 @commands.has_permissions(ban_members=True)
 async def banlist(ctx):
     try:
-        bans = []
-        async for ban_entry in ctx.guild.bans():
-            bans.append(ban_entry)
-        
-        if not bans:
+        bans = await ban_index.get(ctx.guild)
+        if not bans.users:
             await ctx.send("Aucun membre banni.")
             return
         
-        ban_list = "\n".join([f"{ban_entry.user.name}#{ban_entry.user.discriminator}" for ban_entry in bans])
-        embed = discord.Embed(
-            title="Liste des bannis",
-            description=ban_list,
-            color=discord.Color.red()
-        )
-        await ctx.send(embed=embed)
+        view = BanListView(ctx.author.id, bans.sorted_entries(), len(bans.users))
+        view.message = await ctx.send(embed=view.embed(), view=view)
     except Exception as e:
         await ctx.send(f"Erreur: {e}")
 
+@bot.command(name='joins')
+@commands.has_permissions(kick_members=True)
+async def joins(ctx):
+    """Arrivées récentes : pour repérer un raid"""
+    count = join_monitor.count(ctx.guild.id)
+    status = "🚨 **Vague d'arrivées en cours**" if ctx.guild.id in join_monitor.bursting else "✅ Calme"
+    await outbound.send(
+        ctx.channel, PRIORITY_HIGH,
+        content=f"{status}\n{count} arrivée(s) ces {JOIN_BURST_WINDOW:.0f} dernières secondes "
+                f"(seuil: {JOIN_BURST_THRESHOLD}) | {len(role_grants)} rôle(s) en attente"
+    )
+
 @bot.command(name='message')
 async def message(ctx, *, content, channel: discord.TextChannel = None):
     if channel is None:
@@ -463,56 +4184,200 @@ async def message(ctx, *, content, channel: discord.TextChannel = None):
 
 @bot.command(name='ask', aliases=['ia', 'groq'])
 async def ask_ai(ctx, *, question):
-    user_id = str(ctx.author.id)
+    user_id = ctx.author.id
     
-    # Initialiser l'historique si l'utilisateur est nouveau
-    if user_id not in conversation_history:
-        conversation_history[user_id] = []
+    # Seules les questions sans contexte (ou avec un contexte court) peuvent venir du cache
+    cache_key = None
+    if ASK_CACHE_ENABLED:
+        fingerprint = conversations.context_fingerprint(user_id, ASK_CACHE_MAX_CONTEXT)
+        if fingerprint is not None:
+            cache_key = AnswerCache.key_for(question, fingerprint)
     
-    # Ajouter le message de l'utilisateur à l'historique
-    conversation_history[user_id].append({
-        "role": "user",
-        "content": question
-    })
+    # Ajouter le message de l'utilisateur à l'historique (limité en tokens par le store)
+    conversations.append(user_id, "user", question)
     
-    # Limiter l'historique à 20 messages (10 échanges) pour éviter de dépasser la limite
-    if len(conversation_history[user_id]) > 20:
-        conversation_history[user_id] = conversation_history[user_id][-20:]
+    # Construire les messages avec le contexte système + historique
+    messages = [
+        {"role": "system", "content": "Tu es un assistant sur Discord. Réponds de manière concise avec un air décontracté et jeune. Tu te souviens de la conversation précédente avec l'utilisateur."}
+    ] + conversations.messages(user_id)
+    
+    answer = None
+    try:
+        if cache_key is None:
+            answer = await generate_answer(ctx, messages)
+        else:
+            try:
+                answer, from_cache = await ask_cache.fetch(cache_key, lambda: generate_answer(ctx, messages))
+            except AnswerUnavailable:
+                await ctx.send("❌ L'IA n'a pas pu répondre à cette question, réessaie plus tard!")
+                return
+            if from_cache:
+                await send_long(ctx, answer)
+    finally:
+        if answer is None:
+            # Retirer la question sans réponse de l'historique (erreur ou question supprimée)
+            conversations.pop_last(user_id)
+    if answer is None:
+        return
     
+    # Ajouter la réponse du bot à l'historique
+    conversations.append(user_id, "assistant", answer)
+    # Résumer les vieux messages en arrière-plan si la conversation s'allonge
+    conversations.maybe_summarize(user_id, summarize_conversation)
+
+
+async def generate_answer(ctx, messages):
+    """Demande la réponse à l'IA et l'envoie dans le salon. Retourne None en cas d'échec."""
+    if ASK_STREAMING:
+        # La réponse s'affiche au fur et à mesure
+        return await stream_answer(ctx, messages)
     async with ctx.typing():
-        # Construire les messages avec le contexte système + historique
-        messages = [
-            {"role": "system", "content": "Tu es un assistant sur Discord. Réponds de manière concise avec un air décontracté et jeune. Tu te souviens de la conversation précédente avec l'utilisateur."}
-        ] + conversation_history[user_id]
-        
-        response = groq_client.chat.completions.create(
-            model="llama-3.1-8b-instant", 
-            messages=messages,
-            max_tokens=1000,
-            temperature=0.7
-        )
-        answer = response.choices[0].message.content.strip()
-        
-        # Ajouter la réponse du bot à l'historique
-        conversation_history[user_id].append({
-            "role": "assistant",
-            "content": answer
-        })
-        
-        await ctx.send(answer)
+        try:
+            response = await llm_client.complete(messages, message_id=ctx.message.id)
+        except Exception as e:
+            if not isinstance(e, (LLMBusyError, asyncio.TimeoutError)):
+                print(f'⚠️ Réponse de l\'IA impossible: {e}')
+            await ctx.send(llm_error_message(e))
+            return None
+    answer = response.choices[0].message.content.strip()
+    await send_long(ctx, answer)
+    return answer
+
+
+async def send_long(ctx, text):
+    """Envoie un texte en plusieurs messages s'il dépasse la limite de Discord"""
+    while text:
+        part, text = split_message(text)
+        await ctx.send(part)
+
+
+async def summarize_conversation(previous_summary, messages):
+    """Condense les anciens messages d'une conversation (appel IA léger)"""
+    transcript = "\n".join(f"{m.role}: {m.content}" for m in messages)
+    if previous_summary:
+        transcript = f"Résumé précédent : {previous_summary}\n\n{transcript}"
+    response = await llm_client.complete([
+        {"role": "system", "content": "Résume cette conversation en quelques phrases, en gardant les faits importants, les préférences de l'utilisateur et les questions en cours."},
+        {"role": "user", "content": transcript}
+    ], model=CONVO_SUMMARY_MODEL, max_tokens=300, temperature=0.3)
+    return response.choices[0].message.content.strip()
 
 
 @bot.command(name='clearconvo', aliases=['resetconvo', 'oublie'])
 async def clear_conversation(ctx):
     """Efface l'historique de conversation avec le bot"""
-    user_id = str(ctx.author.id)
-    if user_id in conversation_history:
-        conversation_history[user_id] = []
+    user_id = ctx.author.id
+    if conversations.clear(user_id):
         await ctx.send("✅ J'ai oublié notre conversation, on repart de zéro!")
     else:
         await ctx.send("On n'avait pas encore parlé ensemble!")
+
+
+
+@bot.command(name='convostats')
+@commands.is_owner()
+async def convo_stats(ctx):
+    """Affiche l'occupation mémoire des conversations !ask"""
+    stats = conversations.stats()
+    embed = discord.Embed(title="🧠 Mémoire des conversations", color=discord.Color.blue())
+    embed.add_field(name="Conversations", value=str(stats['conversations']), inline=True)
+    embed.add_field(name="Messages", value=str(stats['messages']), inline=True)
+    embed.add_field(name="Mémoire", value=f"{stats['bytes'] / 1024:.1f} Ko / {conversations.max_bytes / 1024:.0f} Ko", inline=True)
+    embed.add_field(name="Évictions", value=str(stats['evictions']), inline=True)
+    embed.add_field(name="Résumés", value=str(stats['summaries']), inline=True)
+    average_saved = stats['prompt_tokens_saved'] / stats['prompt_requests'] if stats['prompt_requests'] else 0
+    embed.add_field(
+        name="Tokens économisés",
+        value=f"{stats['prompt_tokens_saved']:,} ({average_saved:.0f}/requête)",
+        inline=True
+    )
+    await ctx.send(embed=embed)
         
         
+@bot.command(name='sendstats')
+@commands.is_owner()
+async def send_stats(ctx):
+    """Affiche l'état des files d'envoi du bot"""
+    stats = outbound.stats()
+    embed = discord.Embed(title="📤 Files d'envoi", color=discord.Color.blue())
+    embed.add_field(name="En attente", value=f"{stats['queued']} (max {stats['max_depth']} sur un salon)", inline=True)
+    embed.add_field(name="Salons actifs", value=str(stats['channels']), inline=True)
+    embed.add_field(name="Envoyés", value=str(stats['sent']), inline=True)
+    embed.add_field(name="Annonces regroupées", value=str(stats['coalesced']), inline=True)
+    embed.add_field(
+        name="Rate limits (429)",
+        value=f"{rate_limits.total} reçus, {stats['rate_limit_failures']} encore refusés après nouvel essai",
+        inline=True
+    )
+    await ctx.send(embed=embed)
+
+
+# invoke_without_command : les vérifications du groupe ne s'appliquent pas aux sous-commandes
+@bot.group(name='profile', invoke_without_command=True)
+@commands.is_owner()
+async def profile_cmd(ctx):
+    """Profilage du bot en production : !profile start [secondes], !profile stop, !profile dump"""
+    if profiler.active:
+        elapsed = time.perf_counter() - profiler.started_at
+        await ctx.send(f"⏱️ Profilage en cours depuis {elapsed:.0f}s (arrêt auto à {profiler.duration}s)")
+    else:
+        await ctx.send("Usage : `!profile start [secondes]`, `!profile stop`, `!profile dump`")
+
+
+@profile_cmd.command(name='start')
+@commands.is_owner()
+async def profile_start(ctx, seconds: int = PROFILE_DEFAULT_SECONDS):
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    if not profiler.start(seconds):
+        await ctx.send("❌ Un profilage est déjà en cours")
+        return
+    await ctx.send(f"⏱️ Profilage démarré pour {seconds}s max (`!profile stop` pour arrêter avant)")
+
+
+@profile_cmd.command(name='stop')
+@commands.is_owner()
+async def profile_stop(ctx):
+    if not profiler.stop():
+        await ctx.send("❌ Aucun profilage en cours")
+        return
+    await ctx.send(f"✅ Profilage arrêté après {profiler.result[2]:.1f}s (`!profile dump` pour les résultats)")
+
+
+@profile_cmd.command(name='dump')
+@commands.is_owner()
+async def profile_dump(ctx):
+    """Résumé en embed + profil complet et rapport texte en pièces jointes compressées"""
+    profiler.stop()
+    if profiler.result is None:
+        await ctx.send("❌ Aucun profil disponible : lance d'abord `!profile start`")
+        return
+    # Le tri et la compression d'un gros profil ne doivent pas bloquer la boucle
+    profile_gz, report_gz, stats, traces = await asyncio.to_thread(profiler.dump)
+    embed = discord.Embed(
+        title="⏱️ Profil du bot",
+        description=f"{profiler.result[2]:.1f}s profilées • {stats.total_calls:,} appels • "
+                    f"{stats.total_tt:.2f}s de CPU sur la boucle",
+        color=discord.Color.blue()
+    )
+    top = sorted(stats.stats.items(), key=lambda item: -item[1][3])[:PROFILE_TOP]
+    functions = "\n".join(
+        f"`{cumtime * 1000:8.1f} ms` {os.path.basename(filename)}:{line} {name}"
+        for (filename, line, name), (_, _, _, cumtime, _) in top
+    )
+    embed.add_field(name="Temps cumulé", value=functions[:1024] or "—", inline=False)
+    if traces:
+        timings = "\n".join(
+            f"`{total * 1000:8.1f} ms` {tag} ({count}×, max {worst * 1000:.0f} ms)"
+            for tag, (count, total, worst) in traces[:PROFILE_TOP]
+        )
+        embed.add_field(name="Par handler / commande", value=timings[:1024], inline=False)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    await ctx.send(embed=embed, files=[
+        discord.File(io.BytesIO(profile_gz), filename=f'profile-{stamp}.prof.gz'),
+        discord.File(io.BytesIO(report_gz), filename=f'profile-{stamp}.txt.gz'),
+    ])
+
+
 @bot.command(name='poll')
 @commands.has_permissions(manage_messages=True)
 async def poll(ctx, *, question):
@@ -524,25 +4389,167 @@ async def poll(ctx, *, question):
     
 @bot.command(name='joke')
 async def joke(ctx):
-    async with ctx.typing():
-        response = groq_client.chat.completions.create(
-            model="llama-3.1-8b-instant", 
-            messages=[
-                {"role": "system", "content": "Tu es une assistante sur Discord. Réponds de manière drôle et décontractée avec un air jeune."},
-                {"role": "user", "content": "Raconte-moi une blague."}
-            ],
-            max_tokens=1000,
-            temperature=0.7
-        )
-        joke_text = response.choices[0].message.content.strip()
-        await ctx.send(joke_text)
+    try:
+        joke_text = await joke_pool.get(message_id=ctx.message.id)
+    except Exception as e:
+        if not isinstance(e, (LLMBusyError, asyncio.TimeoutError)):
+            print(f'⚠️ Blague impossible: {e}')
+        await ctx.send(llm_error_message(e))
+        return
+    await ctx.send(joke_text)
+
+
+@bot.command(name='cachestats')
+@commands.is_owner()
+async def cache_stats(ctx):
+    """Affiche l'efficacité des caches de l'IA"""
+    jokes = joke_pool.stats()
+    served = jokes['hits'] + jokes['misses']
+    hit_rate = jokes['hits'] / served * 100 if served else 0
+    embed = discord.Embed(title="📦 Caches de l'IA", color=discord.Color.blue())
+    embed.add_field(
+        name="Blagues",
+        value=f"{jokes['available']} en réserve\n{jokes['hits']} hits / {jokes['misses']} misses ({hit_rate:.0f}%)",
+        inline=True
+    )
+    answers = ask_cache.stats()
+    asked = answers['hits'] + answers['coalesced'] + answers['misses']
+    hit_rate = (answers['hits'] + answers['coalesced']) / asked * 100 if asked else 0
+    embed.add_field(
+        name=f"Réponses !ask ({'activé' if ASK_CACHE_ENABLED else 'désactivé'})",
+        value=(
+            f"{answers['entries']} en cache\n"
+            f"{answers['hits']} hits + {answers['coalesced']} regroupées / {answers['misses']} misses ({hit_rate:.0f}%)\n"
+            f"{answers['saved_seconds']:.1f}s d'attente économisées"
+        ),
+        inline=True
+    )
+    await ctx.send(embed=embed)
         
 @bot.command(name='resetxp')
 @commands.has_permissions(manage_roles=True)
-async def reset_xp(ctx, member: discord.Member):
-    user_id = str(member.id)
-    await update_user_data(user_id, 0, 1)
-    await ctx.send(f"XP et niveau de {member.mention} réinitialisés!")
+async def reset_xp(ctx, target: Union[discord.Member, discord.Role]):
+    if isinstance(target, discord.Member):
+        xp_accumulator.set(ctx.guild.id, target.id, 0, 1, target.name)
+        await ctx.send(f"XP et niveau de {target.mention} réinitialisés!")
+        return
+    
+    user_ids = [member.id for member in target.members]
+    rows = await xp_accumulator.bulk(reset_xp_bulk, ctx.guild.id, user_ids) if user_ids else []
+    levels = sum(row['old_level'] - 1 for row in rows)
+    await ctx.send(f"XP et niveau de {len(rows):,} membre(s) de **{target.name}** réinitialisés ({levels:,} niveau(x) effacés)!")
+
+
+@bot.command(name='newseason')
+@commands.has_permissions(administrator=True)
+async def new_season(ctx):
+    """Nouvelle saison : tout le serveur repart niveau 1, le podium de la saison est annoncé"""
+    rows = await xp_accumulator.bulk(reset_xp_bulk, ctx.guild.id, None)
+    if not rows:
+        await ctx.send("Rien à réinitialiser, la saison n'a pas encore commencé!")
+        return
+    
+    podium = heapq.nlargest(3, rows, key=lambda row: (row['old_level'], row['old_xp']))
+    embed = discord.Embed(
+        title="🏁 Fin de saison !",
+        description=f"{len(rows):,} joueur(s) repartent niveau 1. Bonne chance pour la nouvelle saison!",
+        color=discord.Color.gold()
+    )
+    for medal, row in zip(("🥇", "🥈", "🥉"), podium):
+        member = ctx.guild.get_member(row['user_id'])
+        name = member.display_name if member else f"Joueur {row['user_id']}"
+        embed.add_field(name=f"{medal} {name}", value=f"Level {row['old_level']} | {row['old_xp']} XP", inline=False)
+    await ctx.send(embed=embed)
+
+
+@bot.group(name='xpdata', invoke_without_command=True)
+@commands.is_owner()
+async def xpdata(ctx):
+    """Sauvegarde et import de l'XP : !xpdata export [tout], !xpdata import [recalculer] [remplacer] [fichier]"""
+    await ctx.send(
+        "Usage :\n"
+        "`!xpdata export [tout]` : XP du serveur (ou de tous) et temps de jeu en CSV gzip\n"
+        "`!xpdata import [recalculer] [remplacer] [fichier]` : fichier joint (ou déjà dans le dossier d'export), "
+        "CSV ou NDJSON, gzip accepté\n"
+        "• `recalculer` : la colonne xp est l'XP totale, le niveau est recalculé avec la courbe du bot\n"
+        "• `remplacer` : écrase aussi les joueurs déjà plus avancés ici"
+    )
+
+
+@xpdata.command(name='export')
+@commands.is_owner()
+async def xpdata_export(ctx, scope: str = 'serveur'):
+    everything = scope.casefold() in ('tout', 'all')
+    if not everything and ctx.guild is None:
+        await ctx.send("❌ En message privé, utilise `!xpdata export tout`")
+        return
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    async with ctx.typing():
+        exported = await export_xp(None if everything else ctx.guild.id, stamp)
+    sizes = [os.path.getsize(path) for path, _ in exported]
+    summary = "\n".join(
+        f"`{os.path.basename(path)}` : {rows:,} lignes ({size / 1024:,.0f} Ko)"
+        for (path, rows), size in zip(exported, sizes)
+    )
+    # Limite d'envoi du serveur (10 Mo en message privé)
+    limit = ctx.guild.filesize_limit if ctx.guild else 10 * 1024 * 1024
+    if sum(sizes) <= limit:
+        try:
+            await ctx.send(f"📦 Export terminé :\n{summary}", files=[discord.File(path) for path, _ in exported])
+        finally:
+            # Envoyé (ou à refaire) : rien à garder sur le disque
+            for path, _ in exported:
+                os.remove(path)
+    else:
+        await asyncio.to_thread(prune_exports, EXPORT_KEEP)
+        await ctx.send(f"📦 Export terminé, trop gros pour Discord : gardé dans `{EXPORT_DIR}/` "
+                       f"(les {EXPORT_KEEP} derniers sont conservés)\n{summary}")
+
+
+@xpdata.command(name='import')
+@commands.is_owner()
+async def xpdata_import(ctx, *options: str):
+    recalculate = any(option.casefold() == 'recalculer' for option in options)
+    replace = any(option.casefold() == 'remplacer' for option in options)
+    names = [option for option in options if option.casefold() not in ('recalculer', 'remplacer')]
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    downloaded = None
+    if ctx.message.attachments:
+        attachment = ctx.message.attachments[0]
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        path = downloaded = os.path.join(EXPORT_DIR, f"import-{stamp}-{os.path.basename(attachment.filename)}")
+    elif names:
+        # Seulement les fichiers du dossier d'export, pas un chemin quelconque
+        path = os.path.join(EXPORT_DIR, os.path.basename(names[0]))
+        if not os.path.isfile(path):
+            await ctx.send(f"❌ `{os.path.basename(path)}` introuvable dans `{EXPORT_DIR}/`")
+            return
+    else:
+        await ctx.send("❌ Joins un fichier CSV ou NDJSON à la commande (ou donne le nom d'un fichier exporté)")
+        return
+    
+    try:
+        async with ctx.typing():
+            if downloaded:
+                await download_attachment(attachment, path)
+            staged, valid, written, unreadable, no_guild = await xp_accumulator.reload(
+                import_xp, path, ctx.guild.id if ctx.guild else None, recalculate, replace
+            )
+    except (XPImportError, asyncpg.PostgresError, ClientError, UnicodeDecodeError, OSError) as e:
+        await ctx.send(f"❌ Import annulé, rien n'a été modifié : {e}")
+        return
+    finally:
+        if downloaded and os.path.exists(downloaded):
+            os.remove(downloaded)
+    
+    rejected = staged - valid + unreadable - no_guild
+    await ctx.send(
+        f"✅ Import terminé : {staged + unreadable:,} lignes lues, {valid:,} joueurs valides, "
+        f"**{written:,} mis à jour**"
+        + (f"\n⚠️ {rejected:,} lignes rejetées (identifiant ou niveau invalide, doublon, ligne illisible)" if rejected else "")
+        + (f"\n⚠️ {no_guild:,} lignes ignorées faute de `guild_id` (import en message privé)" if no_guild else "")
+        + ("" if replace else "\nLes joueurs déjà plus avancés ici ont été gardés (`remplacer` pour les écraser)")
+    )
 
 
 # ========== COMMANDES SYSTÈME DE JEU ==========
@@ -571,23 +4578,20 @@ async def current_games(ctx):
     for game_name, data in active_games.items():
         player_mentions = []
         for user_id in data['current_players']:
-            try:
-                member = ctx.guild.get_member(int(user_id))
-                if member:
-                    # Calculer le temps de jeu actuel
-                    if user_id in game_sessions:
-                        duration = datetime.now() - game_sessions[user_id]['start_time']
-                        hours = duration.total_seconds() / 3600
-                        if hours >= 1:
-                            time_str = f" ({hours:.1f}h)"
-                        else:
-                            minutes = duration.total_seconds() / 60
-                            time_str = f" ({minutes:.0f}min)"
-                        player_mentions.append(f"{member.mention}{time_str}")
+            member = ctx.guild.get_member(user_id)
+            if member:
+                # Calculer le temps de jeu actuel
+                if user_id in game_sessions:
+                    duration = datetime.now() - game_sessions[user_id]['start_time']
+                    hours = duration.total_seconds() / 3600
+                    if hours >= 1:
+                        time_str = f" ({hours:.1f}h)"
                     else:
-                        player_mentions.append(member.mention)
-            except:
-                pass
+                        minutes = duration.total_seconds() / 60
+                        time_str = f" ({minutes:.0f}min)"
+                    player_mentions.append(f"{member.mention}{time_str}")
+                else:
+                    player_mentions.append(member.mention)
         
         if player_mentions:
             players_text = "\n".join(player_mentions)
@@ -602,12 +4606,16 @@ async def current_games(ctx):
 
 
 @bot.command(name='playtime', aliases=['gametime', 'stats'])
-async def playtime_stats(ctx, member: discord.Member = None):
-    """Affiche le temps de jeu d'un utilisateur"""
+async def playtime_stats(ctx, member: Optional[discord.Member] = None, window: Optional[PlaytimeWindow] = None):
+    """Affiche le temps de jeu d'un utilisateur (ex: !playtime @membre 30d pour l'historique)"""
     if member is None:
         member = ctx.author
     
-    user_id = str(member.id)
+    user_id = member.id
+    
+    if window is not None:
+        await send_playtime_history(ctx, member, window)
+        return
     
     # Vérifier si l'utilisateur joue actuellement
     if user_id in game_sessions:
@@ -644,49 +4652,66 @@ async def playtime_stats(ctx, member: discord.Member = None):
         await ctx.send(f"😴 {member.mention} ne joue à rien actuellement!")
 
 
+async def send_playtime_history(ctx, member, window):
+    """Temps de jeu d'un membre par jeu sur une période"""
+    records = await get_user_playtime(member.id, datetime.now() - window)
+    if not records:
+        await ctx.send(f"😴 {member.mention} n'a pas joué ces {format_window(window)}!")
+        return
+    
+    embed = discord.Embed(
+        title=f"🎮 Temps de jeu de {member.name} ({format_window(window)})",
+        color=discord.Color.blue(),
+        timestamp=datetime.now()
+    )
+    embed.description = "\n".join(
+        f"**{record['game']}** - {format_duration(record['seconds'])}" for record in records
+    )
+    embed.set_footer(text=f"Total: {format_duration(sum(record['seconds'] for record in records))}")
+    await ctx.send(embed=embed)
+
+
 @bot.command(name='topgames', aliases=['populargames', 'gametop'])
-async def top_games(ctx, limit: int = 10):
-    """Affiche les jeux les plus populaires du serveur"""
+async def top_games(ctx, window: Optional[PlaytimeWindow] = None, limit: int = 10):
+    """Affiche les jeux les plus populaires du serveur (ex: !topgames 7d)"""
     if limit > 20:
         limit = 20
     
-    if not game_stats:
-        await ctx.send("❌ Aucune statistique de jeu disponible!")
-        return
-    
-    # Trier les jeux par temps total de jeu
-    sorted_games = sorted(
-        game_stats.items(),
-        key=lambda x: x[1]['total_time'],
-        reverse=True
-    )[:limit]
+    if window is not None:
+        # Sur une période : lu dans les agrégats horaires/journaliers
+        records = await get_top_games(datetime.now() - window, limit)
+        sorted_games = [(record['game'], record['seconds']) for record in records]
+    else:
+        # Trier les jeux par temps total de jeu
+        sorted_games = sorted(
+            ((game_name, data['total_time'].total_seconds()) for game_name, data in game_stats.items()),
+            key=lambda x: x[1],
+            reverse=True
+        )[:limit]
     
     if not sorted_games:
         await ctx.send("❌ Aucune statistique de jeu disponible!")
         return
     
+    title = "🏆 Top des Jeux les Plus Joués"
+    if window is not None:
+        title += f" ({format_window(window)})"
     embed = discord.Embed(
-        title="🏆 Top des Jeux les Plus Joués",
+        title=title,
         color=discord.Color.gold(),
         timestamp=datetime.now()
     )
     
     description = ""
-    for idx, (game_name, data) in enumerate(sorted_games, 1):
-        total_hours = data['total_time'].total_seconds() / 3600
-        
+    for idx, (game_name, total_seconds) in enumerate(sorted_games, 1):
         # Ajouter médailles pour le top 3
         medal = "🥇" if idx == 1 else "🥈" if idx == 2 else "🥉" if idx == 3 else f"**{idx}.**"
         
         # Afficher différemment selon le temps
-        if total_hours >= 1:
-            time_str = f"{total_hours:.1f}h"
-        else:
-            minutes = data['total_time'].total_seconds() / 60
-            time_str = f"{minutes:.0f}min"
+        time_str = format_duration(total_seconds)
         
         # Nombre de joueurs actuels
-        current = len(data['current_players'])
+        current = len(game_stats[game_name]['current_players']) if game_name in game_stats else 0
         current_str = f" • 🟢 {current} en ligne" if current > 0 else ""
         
         description += f"{medal} **{game_name}** - {time_str}{current_str}\n"
@@ -696,15 +4721,12 @@ async def top_games(ctx, limit: int = 10):
     await ctx.send(embed=embed)
 
 
-@bot.command(name='gamestats', aliases=['gameinfo'])
+@bot.hybrid_command(name='gamestats', aliases=['gameinfo'])
+@app_commands.describe(game_name="Nom du jeu (début du nom ou approximatif accepté)")
 async def game_stats_cmd(ctx, *, game_name: str):
     """Affiche les statistiques détaillées d'un jeu spécifique"""
-    # Rechercher le jeu (insensible à la casse)
-    found_game = None
-    for game in game_stats.keys():
-        if game.lower() == game_name.lower():
-            found_game = game
-            break
+    # Nom exact, début du nom ou faute de frappe : casse, accents et ™/® ignorés
+    found_game = game_index.lookup(game_name)
     
     if not found_game:
         await ctx.send(f"❌ Aucune statistique trouvée pour **{game_name}**")
@@ -737,16 +4759,22 @@ async def game_stats_cmd(ctx, *, game_name: str):
         inline=True
     )
     
+    # Pic de joueurs simultanés sur la dernière semaine (agrégat journalier)
+    peak = await get_game_peak(found_game, datetime.now() - timedelta(days=7))
+    if peak:
+        embed.add_field(
+            name="📈 Pic (7j)",
+            value=f"{peak} joueur(s)",
+            inline=True
+        )
+    
     # Lister les joueurs actuels
     if current_players > 0:
         player_list = []
         for user_id in data['current_players']:
-            try:
-                member = ctx.guild.get_member(int(user_id))
-                if member:
-                    player_list.append(member.mention)
-            except:
-                pass
+            member = ctx.guild.get_member(user_id)
+            if member:
+                player_list.append(member.mention)
         
         if player_list:
             embed.add_field(
@@ -757,18 +4785,109 @@ async def game_stats_cmd(ctx, *, game_name: str):
     
     await ctx.send(embed=embed)
 
+
+@game_stats_cmd.autocomplete('game_name')
+async def game_name_autocomplete(interaction, current):
+    """Suggestions de /gamestats au fil de la frappe"""
+    return [app_commands.Choice(name=name[:100], value=name[:100]) for name in game_index.search(current)]
+
+@bot.command(name='sync')
+@commands.is_owner()
+async def sync_commands(ctx, scope: str = None):
+    """Synchronise les commandes slash après les avoir modifiées.
+    `!sync` : serveur de test (DEV_GUILD_ID) ou global, `!sync ici` : ce serveur, `!sync global` : partout"""
+    if scope == 'ici' and ctx.guild is not None:
+        guild_id = ctx.guild.id
+    elif scope == 'global':
+        guild_id = None
+    else:
+        guild_id = DEV_GUILD_ID
+    try:
+        count = await sync_app_commands(guild_id)
+    except discord.HTTPException as e:
+        await ctx.send(f"❌ Synchronisation impossible: {e}")
+        return
+    where = "partout (jusqu'à une heure pour apparaître)" if guild_id is None else f"sur le serveur {guild_id}"
+    await ctx.send(f"✅ {count} commande(s) slash synchronisée(s) {where}")
+
 @bot.command(name='clearchannel')
 @commands.has_permissions(manage_channels=True)
-async def clear_channel(ctx, channel: discord.TextChannel = None):
-    """Supprime tous les messages d'un canal spécifique"""
+async def clear_channel(ctx, channel: Optional[discord.TextChannel] = None, mode: str = None):
+    """Supprime tous les messages d'un canal spécifique.
+    `!clearchannel #salon clone` recrée le salon vide à la place (instantané, mais l'ID du salon change)"""
     if channel is None:
         channel = ctx.channel
     
+    if mode == 'clone':
+        await purge_engine.cancel(channel.id)
+        try:
+            new_channel = await clone_and_replace(channel, reason=f"!clearchannel par {ctx.author}")
+        except discord.HTTPException as e:
+            await ctx.send(f"Erreur lors de la recréation du salon: {e}")
+            return
+        # L'ancien salon n'existe plus : son point de reprise ne sert plus à rien
+        await purge_engine.forget(channel.id)
+        reply_to = new_channel if channel == ctx.channel else ctx.channel
+        await reply_to.send(f"✅ {new_channel.mention} a été recréé vide!", delete_after=5)
+        return
+    
+    # Purge en arrière-plan avec progression dans le message de statut
+    status = await ctx.send(f"🧹 Purge de {channel.mention} en cours...")
     try:
-        await channel.purge()
-        await ctx.send(f"✅ Tous les messages dans {channel.mention} ont été supprimés!", delete_after=5)
-    except Exception as e:
-        await ctx.send(f"Erreur lors de la suppression des messages: {e}")
+        # Les IDs Discord sont chronologiques : tout ce qui précède la commande, quel que soit le salon
+        await purge_engine.start(channel, status, before_id=ctx.message.id, ephemeral=True,
+                                 permission='manage_channels', permissions=channel.permissions_for(ctx.author))
+        if channel == ctx.channel:
+            await ctx.message.delete()
+    except PurgeError as e:
+        await status.edit(content=f"❌ {e}")
+
+
+# Permission de !clear ou de !clearchannel : chaque purge vérifie ensuite celle de sa commande
+purge_check = commands.check_any(commands.has_permissions(manage_messages=True),
+                                 commands.has_permissions(manage_channels=True))
+
+@bot.group(name='purge', invoke_without_command=True)
+@purge_check
+async def purge_cmd(ctx):
+    """Purges en cours et à reprendre sur le serveur"""
+    running = purge_engine.running(ctx.guild.id)
+    paused = await purge_engine.paused(ctx.guild.id)
+    if not running and not paused:
+        await ctx.send("Aucune purge en cours ou à reprendre")
+        return
+    lines = [f"🧹 {job.channel.mention} : {job.deleted:,} supprimé(s), en cours" for job in running]
+    lines += [f"⏸️ <#{row['channel_id']}> : {row['deleted']:,} supprimé(s), `!purge resume <#{row['channel_id']}>`"
+              for row in paused]
+    await ctx.send("\n".join(lines))
+
+
+# invoke_without_command : les vérifications du groupe ne s'appliquent pas aux sous-commandes
+@purge_cmd.command(name='cancel', aliases=['stop'])
+@purge_check
+async def purge_cancel(ctx, channel: discord.TextChannel = None):
+    channel = channel or ctx.channel
+    permissions = channel.permissions_for(ctx.author)
+    try:
+        # Purge en cours : mise en pause. Purge déjà arrêtée : point de reprise oublié
+        if await purge_engine.cancel(channel.id, permissions) is None:
+            if await purge_engine.forget(channel.id, permissions):
+                await ctx.send(f"🗑️ Purge arrêtée de {channel.mention} oubliée")
+            else:
+                await ctx.send("❌ Aucune purge en cours ou arrêtée dans ce salon")
+    except PurgeError as e:
+        await ctx.send(f"❌ {e}")
+
+
+@purge_cmd.command(name='resume')
+@purge_check
+async def purge_resume(ctx, channel: discord.TextChannel = None):
+    channel = channel or ctx.channel
+    status = await ctx.send(f"🧹 Reprise de la purge de {channel.mention}...")
+    try:
+        await purge_engine.resume(channel, status, channel.permissions_for(ctx.author))
+    except PurgeError as e:
+        await status.edit(content=f"❌ {e}")
 
 if __name__ == '__main__':
     TOKEN = os.getenv('DISCORD_TOKEN')
@@ -1,22 +1,111 @@
 -- Script d'initialisation de la base de données PostgreSQL pour le Bot Discord
 -- Exécute ce script pour créer la base de données et les tables nécessaires
+-- (facultatif : le bot applique lui-même ce schéma au démarrage, via les migrations
+-- versionnées de bot.py enregistrées dans la table schema_migrations)
 
 -- Créer la base de données (à exécuter en tant que superuser)
 -- CREATE DATABASE discord_bot;
 
 -- Se connecter à la base de données discord_bot avant d'exécuter le reste
 
--- Créer la table users pour le système de niveau/XP
+-- Créer la table users pour le système de niveau/XP (XP propre à chaque serveur)
+-- Pour partitionner par serveur, voir DB_GUILD_PARTITIONS (le bot crée alors la table lui-même)
 CREATE TABLE IF NOT EXISTS users (
-    user_id TEXT PRIMARY KEY,
+    guild_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    username TEXT,
     xp INTEGER DEFAULT 0,
     level INTEGER DEFAULT 1,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (guild_id, user_id)
+);
+
+-- Index pour améliorer les performances des requêtes de classement par serveur
+CREATE INDEX IF NOT EXISTS idx_users_guild_rank ON users (guild_id, level DESC, xp DESC);
+
+-- Historique des sessions de jeu (une ligne par session, ended_at NULL = en cours)
+CREATE TABLE IF NOT EXISTS game_sessions (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    game TEXT NOT NULL,
+    started_at TIMESTAMP NOT NULL,
+    ended_at TIMESTAMP
+);
+
+-- Index pour retrouver rapidement les sessions en cours
+CREATE INDEX IF NOT EXISTS idx_game_sessions_open ON game_sessions (user_id, started_at) WHERE ended_at IS NULL;
+
+-- Temps de jeu total par jeu, incrémenté à chaque fin de session
+CREATE TABLE IF NOT EXISTS game_totals (
+    game TEXT PRIMARY KEY,
+    total_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
--- Index pour améliorer les performances des requêtes de classement
-CREATE INDEX IF NOT EXISTS idx_users_level_xp ON users (level DESC, xp DESC);
+-- Agrégats de temps de jeu (heure / jour / mois) par jeu et par utilisateur
+-- Le détail horaire est supprimé après 14 jours, les jours sont regroupés par mois après un an
+CREATE TABLE IF NOT EXISTS playtime_hourly (
+    bucket TIMESTAMP NOT NULL,
+    game TEXT NOT NULL,
+    user_id BIGINT NOT NULL,
+    seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, game, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS playtime_daily (
+    day DATE NOT NULL,
+    game TEXT NOT NULL,
+    user_id BIGINT NOT NULL,
+    seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, game, user_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_playtime_daily_user ON playtime_daily (user_id, day);
+
+CREATE TABLE IF NOT EXISTS playtime_monthly (
+    month DATE NOT NULL,
+    game TEXT NOT NULL,
+    user_id BIGINT NOT NULL,
+    seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+    PRIMARY KEY (month, game, user_id)
+);
+
+-- Pics de joueurs simultanés par jeu
+CREATE TABLE IF NOT EXISTS game_peak_hourly (
+    bucket TIMESTAMP NOT NULL,
+    game TEXT NOT NULL,
+    peak_players INTEGER NOT NULL,
+    PRIMARY KEY (bucket, game)
+);
+
+CREATE TABLE IF NOT EXISTS game_peak_daily (
+    day DATE NOT NULL,
+    game TEXT NOT NULL,
+    peak_players INTEGER NOT NULL,
+    PRIMARY KEY (day, game)
+);
+
+-- Points de reprise des purges de salons (!clear, !clearchannel)
+CREATE TABLE IF NOT EXISTS purge_jobs (
+    channel_id BIGINT PRIMARY KEY,
+    guild_id BIGINT NOT NULL,
+    status_channel_id BIGINT NOT NULL,
+    status_message_id BIGINT NOT NULL,
+    remaining INTEGER,
+    before_id BIGINT NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    ephemeral BOOLEAN NOT NULL DEFAULT FALSE,
+    state TEXT NOT NULL DEFAULT 'running',
+    permission TEXT NOT NULL DEFAULT 'manage_messages',  -- permission de la commande qui l'a lancée
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Dernier signe de vie du bot (heure du bot) : ferme les sessions restées ouvertes pendant un arrêt
+CREATE TABLE IF NOT EXISTS bot_heartbeat (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    seen_at TIMESTAMP NOT NULL
+);
 
 -- Fonction pour mettre à jour automatiquement updated_at
 CREATE OR REPLACE FUNCTION update_updated_at_column()